@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+import time
+
+try:
+	import brotli # `sudo pip3 install brotli`, optional
+except ImportError:
+	brotli = None
+
+# src="/static/x.js", href="/static/x.css" and url('/static/x.png'),
+# with or without an old "?v=..." cache breaker
+_REFERENCE_RE = re.compile(r'''(?P<before>(?:src="|href="|url\(['"]?)/static/)(?P<path>[^"'?)\s]+)(?:\?v=[^"')\s]*)?''')
+
+class Asset: # pylint: disable=too-few-public-methods
+	'''One file from the static directory, kept in memory,
+	together with its gzip (and, if available, brotli) compressed
+	versions, unless compressing it doesn't help, e.g. for images.'''
+
+	__slots__ = ['path', 'body', 'content_type', 'hash', 'etag', 'encodings']
+
+	MIN_COMPRESS_SIZE = 256 # bytes
+	PREFERRED_ENCODINGS = ['br', 'gzip']
+
+	def __init__(self, path, body):
+		self.path = path
+		self.body = body
+		self.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+		self.hash = hashlib.sha256(body).hexdigest()[:16]
+		self.etag = '"%s"' % self.hash
+		self.encodings = {} # encoding -> (compressed body, etag)
+		if len(body) >= self.MIN_COMPRESS_SIZE:
+			self._add_encoding('gzip', gzip.compress(body, compresslevel=9, mtime=0))
+			if brotli is not None:
+				self._add_encoding('br', brotli.compress(body))
+
+	def _add_encoding(self, encoding, body):
+		if len(body) < len(self.body) * 0.9:
+			self.encodings[encoding] = (body, '"%s-%s"' % (self.hash, encoding))
+
+	def get_variant(self, accepted_encodings):
+		'''Returns (encoding, body, etag) of the best version the
+		client accepts. Encoding is None for the uncompressed file.'''
+		for encoding in self.PREFERRED_ENCODINGS:
+			if encoding in accepted_encodings and encoding in self.encodings:
+				body, etag = self.encodings[encoding]
+				return encoding, body, etag
+		return None, self.body, self.etag
+
+class Assets:
+	'''
+	All files in the static directory, each with a hash of its content.
+
+	Pages and style sheets refer to "/static/file?v=<hash>",
+	so a URL changes exactly when the file behind it changes,
+	and browsers may cache fingerprinted URLs for good.
+	References in .css files are rewritten too, which is why
+	their hash is that of the rewritten content.
+
+	Files that have changed are read and compressed again (and style
+	sheets rewritten), which we check at most every CHECK_INTERVAL
+	seconds. The other files are left alone, so a change costs about
+	as much as the changed files, not all of them.
+	'''
+
+	CHECK_INTERVAL = 2 # seconds
+
+	def __init__(self, directory):
+		self._directory = directory
+		self._assets = {} # path relative to directory -> Asset
+		self._mtimes = {} # path relative to directory -> mtime
+		self._style_sheets = {} # path relative to directory -> content before rewriting
+		self._checked = 0
+		self._lock = threading.Lock()
+		self._version = 0 # changes whenever any file has changed
+		self._load()
+
+	def _list_files(self):
+		result = {}
+		for root, dirs, files in os.walk(self._directory):
+			dirs[:] = [i for i in dirs if not i.startswith('.')] # e.g. .well-known
+			for filename in files:
+				path = os.path.join(root, filename)
+				try:
+					result[os.path.relpath(path, self._directory)] = os.stat(path).st_mtime
+				except OSError:
+					pass
+		return result
+
+	def _load(self):
+		mtimes = self._list_files()
+		assets = {path: asset for path, asset in self._assets.items() if path in mtimes}
+		style_sheets = {path: css for path, css in self._style_sheets.items() if path in mtimes}
+
+		for path, mtime in mtimes.items():
+			if self._mtimes.get(path, None) == mtime:
+				continue
+			with open(os.path.join(self._directory, path), 'rb') as f:
+				body = f.read()
+			if path.endswith('.css'):
+				style_sheets[path] = body.decode('utf-8')
+			else:
+				assets[path] = Asset(path, body)
+
+		# style sheets last, because they refer to the other files
+		for path, css in style_sheets.items():
+			body = self._rewrite(css, assets).encode('utf-8')
+			if path not in assets or assets[path].body != body:
+				assets[path] = Asset(path, body)
+
+		self._assets = assets
+		self._style_sheets = style_sheets
+		self._mtimes = mtimes
+		self._checked = time.monotonic()
+		self._version += 1
+
+	def _check(self):
+		now = time.monotonic()
+		if now - self._checked < self.CHECK_INTERVAL:
+			return
+		with self._lock:
+			if now - self._checked < self.CHECK_INTERVAL:
+				return
+			if self._list_files() != self._mtimes:
+				self._load()
+			else:
+				self._checked = now
+
+	def get_version(self):
+		'''Changes whenever any file has changed, so that whatever
+		was built from the fingerprinted URLs knows when to rebuild.'''
+		self._check()
+		return self._version
+
+	def get(self, path):
+		'''Returns the Asset, or None if there is no such file.'''
+		self._check()
+		return self._assets.get(path, None)
+
+	def get_manifest(self):
+		'''Returns {path: hash} of all files.'''
+		self._check()
+		return {path: asset.hash for path, asset in self._assets.items()}
+
+	@staticmethod
+	def _rewrite(content, assets):
+		def _replace(match):
+			path = match.group('path')
+			asset = assets.get(path, None)
+			if asset is None:
+				return match.group(0)
+			return '%s%s?v=%s' % (match.group('before'), path, asset.hash)
+		return _REFERENCE_RE.sub(_replace, content)
+
+	def rewrite(self, content):
+		'''Points all references to static files in `content`
+		(html or css) to their fingerprinted URLs.'''
+		self._check()
+		return self._rewrite(content, self._assets)
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+
+'''
+Benchmarks for the hot paths of the logic layer.
+
+They run on made-up offers, charities and countries and need
+neither a database nor network access:
+
+`./benchmark.py automatch --sizes 50 100 200 400`
+`./benchmark.py convert --sizes 1000 10000 100000`
+`./benchmark.py templates --rounds 10000`
+`./benchmark.py requests --concurrency 50 --workers 1 4 8`
+'''
+
+import argparse
+import asyncio
+import concurrent.futures
+import datetime
+import json
+import random
+import statistics
+import time
+
+import currency
+import entities
+import main as webserver
+import matchscore
+import util
+
+import tornado.httpclient
+import tornado.httpserver
+import tornado.netutil
+import tornado.web
+
+RATES = {
+	'base': 'EUR',
+	'timestamp': 0,
+	'rates': {
+		'EUR': 1.0,
+		'AUD': 1.6,
+		'CAD': 1.5,
+		'CHF': 1.1,
+		'GBP': 0.9,
+		'NZD': 1.7,
+		'USD': 1.1,
+	},
+}
+
+def _create_entities(offer_count, seed=0):
+	'''Fills the entity caches with random, but plausible data.
+	Returns the offers.'''
+	rnd = random.Random(seed)
+
+	entities.Currency._by_id = {} # pylint: disable=protected-access
+	for i, iso in enumerate(sorted(RATES['rates']), 1):
+		entities.Currency._load_entity({'id': i, 'iso': iso, 'name': iso}) # pylint: disable=protected-access
+	currencies = entities.Currency.get_all()
+
+	entities.CharityCategory._by_id = {} # pylint: disable=protected-access
+	entities.CharityCategory._load_entity({'id': 1, 'name': 'category'}) # pylint: disable=protected-access
+
+	entities.Charity._by_id = {} # pylint: disable=protected-access
+	entities.Charity._by_name = {} # pylint: disable=protected-access
+	for i in range(1, 31):
+		entities.Charity._load_entity({'id': i, 'name': 'charity %s' % i, 'category_id': 1}) # pylint: disable=protected-access
+
+	entities.Country._by_id = {} # pylint: disable=protected-access
+	entities.Country._by_iso_name = {} # pylint: disable=protected-access
+	for i in range(1, 21):
+		entities.Country._load_entity({ # pylint: disable=protected-access
+			'id': i,
+			'name': 'country %s' % i,
+			'live_in_name': None,
+			'iso_name': '%02i' % i,
+			'currency_id': rnd.choice(currencies).id,
+			'min_donation_amount': 0,
+			'min_donation_currency_id': currencies[0].id,
+			'gift_aid': rnd.choice([0, 0, 0, 25]),
+		})
+
+	entities.CharityInCountry._all = [] # pylint: disable=protected-access
+	entities.CharityInCountry._by_charity_and_country_id = {} # pylint: disable=protected-access
+	entities.CharityInCountry._country_mask_by_charity_id = {} # pylint: disable=protected-access
+	entities.CharityInCountry._charity_mask_by_country_id = {} # pylint: disable=protected-access
+	for charity in entities.Charity.get_all():
+		for country in entities.Country.get_all():
+			if rnd.random() < 0.3:
+				entities.CharityInCountry._load_entity({ # pylint: disable=protected-access
+					'charity_id': charity.id,
+					'country_id': country.id,
+					'instructions': '',
+				})
+
+	entities.DeclinedMatch._pairs = set() # pylint: disable=protected-access
+
+	entities.Offer._by_id = {} # pylint: disable=protected-access
+	entities.Offer._by_secret = {} # pylint: disable=protected-access
+	entities.Offer._unmatched = {} # pylint: disable=protected-access
+	entities.Match._by_offer_id = {} # pylint: disable=protected-access
+	now = datetime.datetime.utcnow()
+	for i in range(1, offer_count + 1):
+		amount = rnd.randrange(100, 5000)
+		entities.Offer._load_entity({ # pylint: disable=protected-access
+			'id': i,
+			'secret': 'secret %s' % i,
+			'name': 'donor %s' % i,
+			'email': 'donor%s@test.test' % i,
+			'country_id': rnd.randrange(1, 21),
+			'amount': amount,
+			'min_amount': rnd.randrange(amount // 4, amount + 1),
+			'charity_id': rnd.randrange(1, 31),
+			'created_ts': now - datetime.timedelta(days=rnd.randrange(1, 60)),
+			'expires_ts': now + datetime.timedelta(days=rnd.randrange(1, 60)),
+			'confirmed': True,
+		})
+
+	return entities.Offer.get_all()
+
+def _timed(func, *args, **kwargs):
+	t1 = time.time()
+	result = func(*args, **kwargs)
+	return time.time() - t1, result
+
+def benchmark_automatch(args):
+	print('%6s %10s %10s %8s %10s %10s' % ('offers', 'score sec', 'solve sec', 'pairs', 'greedy', 'total'))
+	for size in args.sizes:
+		offers = _create_entities(size)
+		rates = currency.HistoricCurrency(RATES)
+		score_seconds, book = _timed(matchscore.OfferBook, offers, rates)
+		seconds, scores = _timed(book.candidate_scores)
+		score_seconds += seconds
+		solve_seconds, (_, stats) = _timed(matchscore.propose_matches, scores, time_budget=args.time_budget)
+		print('%6s %10.3f %10.3f %8s %10.2f %10.2f%s' % (
+			size, score_seconds, solve_seconds, stats['pairs'],
+			stats['greedy_total'], stats['total'],
+			' (timed out)' if stats['timed_out'] else ''))
+
+def benchmark_convert(args):
+	# about as many currencies as fixer.io has
+	rnd = random.Random(0)
+	data = {
+		'base': 'EUR',
+		'timestamp': 0,
+		'rates': {'C%03i' % i: rnd.uniform(0.01, 1000) for i in range(170)},
+	}
+	data['rates']['EUR'] = 1.0
+	rates = currency.HistoricCurrency(data)
+	isos = list(data['rates'])
+
+	print('%8s %12s %12s %12s %8s' % ('amounts', 'scalar/sec', 'batch/sec', 'mixed/sec', 'speedup'))
+	for size in args.sizes:
+		amounts = [rnd.randrange(1, 100000) for _ in range(size)]
+		from_isos = [rnd.choice(isos) for _ in range(size)]
+
+		scalar_seconds, scalar = _timed(lambda: [rates.convert(amount, iso, 'NZD') for amount, iso in zip(amounts, from_isos)])
+		batch_seconds, batch = _timed(rates.convert_many, amounts, 'USD', 'NZD')
+		mixed_seconds, mixed = _timed(rates.convert_many, amounts, from_isos, 'NZD')
+		assert mixed == scalar and len(batch) == size
+
+		print('%8s %12.0f %12.0f %12.0f %7.1fx' % (
+			size, size / scalar_seconds, size / batch_seconds, size / mixed_seconds,
+			scalar_seconds / mixed_seconds))
+
+def _replace_one_by_one(content, replacements):
+	'''How templates were filled in before they were compiled.'''
+	for k, v in replacements.items():
+		content = content.replace(k, str(v))
+	return content
+
+def benchmark_templates(args):
+	print('%-32s %8s %14s %14s %8s' % ('template', 'size', 'replace/sec', 'render/sec', 'speedup'))
+	for filename in args.templates:
+		template = util.Template(filename)
+		placeholders = sorted(template._compiled.placeholders) # pylint: disable=protected-access
+		replacements = {k: 'value of %s' % k for k in placeholders}
+
+		old_seconds, old = _timed(lambda: [_replace_one_by_one(util.Template(filename).content, replacements) for _ in range(args.rounds)])
+		new_seconds, new = _timed(lambda: [util.Template(filename).replace(replacements).content for _ in range(args.rounds)])
+		assert old[0] == new[0]
+
+		print('%-32s %8s %14.0f %14.0f %7.1fx' % (
+			filename, len(template.content), args.rounds / old_seconds,
+			args.rounds / new_seconds, old_seconds / new_seconds))
+
+class _InlineExecutor(concurrent.futures.Executor):
+	'''Runs jobs right away, on the IOLoop, like the handlers used to.'''
+
+	def submit(self, fn, *args, **kwargs): # pylint: disable=arguments-differ
+		future = concurrent.futures.Future()
+		future.set_result(fn(*args, **kwargs))
+		return future
+
+class _FakeLogic:
+	'''Every ajax call blocks for a while, like a database query would.'''
+
+	def __init__(self, pool, blocking_seconds):
+		self._pool = pool
+		self._blocking_seconds = blocking_seconds
+
+	def get_worker_pool(self):
+		return self._pool
+
+	def record_response_size(self, endpoint, raw_size, sent_size):
+		pass
+
+	def run_ajax(self, command, ip_address, args): # pylint: disable=unused-argument
+		time.sleep(self._blocking_seconds)
+		return True, {'command': command}
+
+async def _measure_requests(pool, args):
+	app = tornado.web.Application([
+		(r'/ajax/(.+)', webserver.AjaxHandler, {'logic': _FakeLogic(pool, args.blocking_ms / 1000.0)}),
+	])
+	sockets = tornado.netutil.bind_sockets(0, '127.0.0.1')
+	server = tornado.httpserver.HTTPServer(app)
+	server.add_sockets(sockets)
+	url = 'http://127.0.0.1:%s/ajax/get_info' % sockets[0].getsockname()[1]
+
+	client = tornado.httpclient.AsyncHTTPClient(force_instance=True, max_clients=args.concurrency)
+	latencies = []
+
+	async def _one():
+		t1 = time.time()
+		response = await client.fetch(url, method='POST', body=json.dumps({}))
+		assert response.code == 200
+		latencies.append(time.time() - t1)
+
+	t1 = time.time()
+	for _ in range(args.rounds):
+		await asyncio.gather(*[_one() for _ in range(args.concurrency)])
+	total = time.time() - t1
+
+	client.close()
+	server.stop()
+	return total, sorted(latencies)
+
+def benchmark_requests(args):
+	print('%8s %12s %10s %10s %10s %10s' % ('workers', 'requests/s', 'p50 ms', 'p95 ms', 'max ms', 'mean ms'))
+	for workers in [0] + args.workers:
+		if workers:
+			pool = util.WorkerPool(workers, args.concurrency)
+		else:
+			pool = _InlineExecutor()
+		total, latencies = asyncio.run(_measure_requests(pool, args))
+		pool.shutdown()
+
+		print('%8s %12.0f %10.1f %10.1f %10.1f %10.1f%s' % (
+			workers, len(latencies) / total,
+			1000 * latencies[len(latencies) // 2],
+			1000 * latencies[int(len(latencies) * 0.95)],
+			1000 * latencies[-1],
+			1000 * statistics.mean(latencies),
+			' (on the IOLoop, as before)' if not workers else ''))
+
+def main():
+	parser = argparse.ArgumentParser()
+	sub_parsers = parser.add_subparsers()
+
+	automatch_parser = sub_parsers.add_parser('automatch', help='scoring and solve time against book size')
+	automatch_parser.add_argument('--sizes', type=int, nargs='+', default=[50, 100, 200, 400, 800])
+	automatch_parser.add_argument('--time-budget', type=float, default=30)
+	automatch_parser.set_defaults(func=benchmark_automatch)
+
+	convert_parser = sub_parsers.add_parser('convert', help='scalar against batched currency conversion')
+	convert_parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+	convert_parser.set_defaults(func=benchmark_convert)
+
+	templates_parser = sub_parsers.add_parser('templates', help='one-by-one replacing against single-pass rendering')
+	templates_parser.add_argument('--rounds', type=int, default=10000)
+	templates_parser.add_argument('--templates', nargs='+', default=['match-approved-email.html', 'match-approved-email.txt', 'start.html'])
+	templates_parser.set_defaults(func=benchmark_templates)
+
+	requests_parser = sub_parsers.add_parser('requests', help='latency of concurrent ajax requests with and without worker threads')
+	requests_parser.add_argument('--concurrency', type=int, default=50)
+	requests_parser.add_argument('--rounds', type=int, default=4)
+	requests_parser.add_argument('--blocking-ms', type=float, default=20)
+	requests_parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8])
+	requests_parser.set_defaults(func=benchmark_requests)
+
+	all_args = parser.parse_args()
+	if getattr(all_args, 'func', None) is None:
+		parser.print_help()
+	else:
+		all_args.func(all_args)
+
+if __name__ == '__main__':
+	main()
@@ -2,6 +2,7 @@
 
 import json
 import logging
+import os
 
 class Config:
 	# pylint: disable=too-few-public-methods
@@ -26,7 +27,9 @@ class Config:
 		self.contact_message_receivers = data['contact_message_receivers']
 		self.cookie_key = data['cookie_key']
 		self.currency_cache = data['currency_cache']
+		self.currency_history = data.get('currency_history', os.path.join(os.path.dirname(self.currency_cache), 'currency-history.json'))
 		self.db_connection_string = data['db_connection_string']
+		self.db_pool_size = data.get('db_pool_size', 10)
 		self.email_password = data['email_password']
 		self.email_sender_name = data['email_sender_name']
 		self.email_smtp = data['email_smtp']
@@ -34,11 +37,14 @@ class Config:
 		self.email_from = data['email_from']
 		self.fixer_apikey = data['fixer_apikey']
 		self.geoip_datafile = data['geoip_datafile']
+		self.refresh_exchange_rates = data.get('refresh_exchange_rates', False)
+		self.run_deadlines = data.get('run_deadlines', False)
 		self.watchdog_email_password = data['watchdog_email_password']
 		self.watchdog_email_sender_name = data['watchdog_email_sender_name']
 		self.watchdog_email_smtp = data['watchdog_email_smtp']
 		self.watchdog_email_user = data['watchdog_email_user']
 		self.watchdog_receivers = data['watchdog_receivers']
+		self.worker_threads = data.get('worker_threads', 4)
 
 		# could just do this, but explicit is better than implicit
 		#for k, v in data.items():
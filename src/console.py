@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
+import datetime
 
 import donationswap
 import entities
@@ -53,6 +54,19 @@ def main():
 		print('   ID: %s' % offer.id)
 	create_offer_parser.set_defaults(func=create_offer_handler)
 
+	def date(txt):
+		return datetime.datetime.strptime(txt, '%Y-%m-%d').date()
+
+	backfill_rates_parser = sub_parsers.add_parser('backfill-rates')
+	backfill_rates_parser.add_argument('--from', dest='first_date', help='YYYY-MM-DD', required=True, type=date)
+	backfill_rates_parser.add_argument('--to', dest='last_date', help='YYYY-MM-DD (default: yesterday)', type=date)
+	def backfill_rates_handler(args):
+		if args.last_date is None:
+			args.last_date = datetime.date.today() - datetime.timedelta(days=1)
+		count = logic.backfill_historic_rates(args.first_date, args.last_date)
+		print('Downloaded exchange rates of %s days.' % count)
+	backfill_rates_parser.set_defaults(func=backfill_rates_handler)
+
 	all_args = parser.parse_args()
 	if getattr(all_args, 'func', None) is None:
 		parser.print_help()
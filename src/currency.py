@@ -1,19 +1,67 @@
 #!/usr/bin/env python3
 
+import datetime
 import json
 import logging
 import os
+import tempfile
 import threading
 import time
 import urllib.request
 
+class _Rates: # pylint: disable=too-few-public-methods
+	'''A snapshot of exchange rates, compiled for converting many
+	amounts at once: every currency gets an index into two lists
+	of factors, so a conversion is two list lookups.'''
+
+	__slots__ = ['base', 'index', 'from_factors', 'to_factors']
+
+	def __init__(self, data):
+		self.base = data['base']
+		rates = data['rates']
+		isos = list(rates)
+		# Unknown currencies get the last index, with factor 1.
+		self.index = {iso: i for i, iso in enumerate(isos)}
+		self.to_factors = [rates[iso] for iso in isos] + [1]
+		# Amounts in the base currency are not divided by anything.
+		self.from_factors = [1 if iso == self.base else rates[iso] for iso in isos] + [1]
+
+	def get_index(self, iso):
+		return self.index.get(iso, len(self.to_factors) - 1)
+
 class Currency:
+	'''
+	Exchange rates from fixer.io, cached in a file.
+
+	Readers always get the last good snapshot right away. Once it is
+	older than MAX_AGE, a background thread downloads new rates; only
+	one download runs at a time, and after a failure we wait longer
+	and longer (up to MAX_BACKOFF) before trying again.
+	Only the very first download, when there is no cache file yet,
+	makes the caller wait.
+	'''
+
+	MAX_AGE = 60*60 # seconds
+	MIN_BACKOFF = 60 # seconds
+	MAX_BACKOFF = 60*60 # seconds
 
 	def __init__(self, cache_filename, secret):
 		self._cache_filename = cache_filename
 		self._secret = secret
 		self._data = None
+		self._compiled = (None, None) # (data, _Rates)
 		self._file_lock = threading.Lock()
+		self._refresh_lock = threading.Lock()
+		self._refreshing = False
+		self._failures = 0
+		self._next_attempt = 0
+		self._metrics = {
+			'refreshes': 0,
+			'failures': 0,
+			'last_refresh_seconds': None,
+			'max_refresh_seconds': 0.0,
+			'last_error': None,
+		}
 
 	def _read_cache(self):
 		if os.path.isfile(self._cache_filename):
@@ -34,42 +82,122 @@ class Currency:
 		logging.info('Downloading currency exchange rates from fixer.io...')
 		# https is a premium feature
 		url = 'http://data.fixer.io/api/latest?access_key=%s' % self._secret
-		with urllib.request.urlopen(url) as f:
+		with urllib.request.urlopen(url, timeout=30) as f:
 			content = f.read()
 		data = json.loads(content.decode('utf-8'))
 		if data.get('success', False):
-			self._data = data
+			self._data = data # readers see either the old or the new snapshot
 		else:
 			logging.error('Failed to download currency exchange rates from fixer.io: %s', content, exc_info=True)
+			raise ValueError('fixer.io: %s' % data.get('error', content))
+
+	def _get_age(self):
+		return time.time() - (self._data or {}).get('timestamp', 0)
+
+	def _refresh(self):
+		t1 = time.time()
+		try:
+			self._read_live()
+			self._write_cache()
+		except Exception as e: # pylint: disable=broad-except
+			logging.error('Failed to refresh currency exchange rates.', exc_info=True)
+			with self._refresh_lock:
+				self._failures += 1
+				backoff = min(self.MIN_BACKOFF * 2 ** (self._failures - 1), self.MAX_BACKOFF)
+				self._next_attempt = time.time() + backoff
+				self._metrics['failures'] += 1
+				self._metrics['last_error'] = str(e)
+		else:
+			with self._refresh_lock:
+				self._failures = 0
+				self._next_attempt = 0
+				self._metrics['refreshes'] += 1
+				self._metrics['last_error'] = None
+		finally:
+			duration = time.time() - t1
+			with self._refresh_lock:
+				self._refreshing = False
+				self._metrics['last_refresh_seconds'] = duration
+				self._metrics['max_refresh_seconds'] = max(self._metrics['max_refresh_seconds'], duration)
+
+	def _claim_refresh(self):
+		'''Returns True if the caller should refresh now.'''
+		with self._refresh_lock:
+			if self._refreshing or time.time() < self._next_attempt:
+				return False
+			self._refreshing = True
+			return True
+
+	def refresh_in_background(self):
+		'''Starts downloading new rates if the current ones are
+		too old, unless a download is already running or we are
+		backing off after a failure. Never blocks.'''
+		if self._data is not None and self._get_age() <= self.MAX_AGE:
+			return False
+		if not self._claim_refresh():
+			return False
+		threading.Thread(target=self._refresh, name='currency-refresh', daemon=True).start()
+		return True
 
 	def _get_data(self):
 		if self._data is None:
 			self._read_cache()
-		age = time.time() - (self._data or {}).get('timestamp', 0)
-		if self._data is None or age > 60*60:
-			self._read_live()
-			self._write_cache()
+		if self._data is None and self._claim_refresh():
+			self._refresh() # nothing to serve yet, so we have to wait
+		else:
+			self.refresh_in_background()
 		return self._data
 
+	def get_metrics(self):
+		with self._refresh_lock:
+			result = dict(self._metrics)
+			result['refreshing'] = self._refreshing
+			result['retry_in_seconds'] = max(0, self._next_attempt - time.time())
+		result['age_seconds'] = self._get_age() if self._data is not None else None
+		return result
+
+	def get_version(self):
+		'''Changes whenever new exchange rates have been loaded.'''
+		return (self._get_data() or {}).get('timestamp', 0)
+
 	def get_supported_currencies(self):
 		return sorted(self._get_data()['rates'].keys())
 
-	def convert(self, amount, from_currency, to_currency):
+	def _get_rates(self):
 		data = self._get_data()
+		compiled_data, rates = self._compiled
+		if compiled_data is not data:
+			rates = _Rates(data)
+			self._compiled = (data, rates)
+		return rates
 
-		if from_currency != data['base']: # convert to base currency
-			amount /= data['rates'].get(from_currency, 1)
+	def convert_many(self, amounts, from_currencies, to_currency):
+		'''Converts a list of amounts to one currency.
+		`from_currencies` is either one ISO code for all amounts,
+		or a list with one ISO code per amount.
+		All amounts are converted with the same snapshot of rates.'''
 
-		amount *= data['rates'].get(to_currency, 1)
+		rates = self._get_rates()
+		to_factor = rates.to_factors[rates.get_index(to_currency)]
 
-		return int(amount)
+		if isinstance(from_currencies, str):
+			from_factor = rates.from_factors[rates.get_index(from_currencies)]
+			return [int(amount / from_factor * to_factor) for amount in amounts]
 
-	def is_more_money(self, amount_a, currency_a, amount_b, currency_b):
-		data = self._get_data()
+		index = rates.index
+		unknown = len(rates.from_factors) - 1
+		from_factors = rates.from_factors
+		return [
+			int(amount / from_factors[index.get(iso, unknown)] * to_factor)
+			for amount, iso in zip(amounts, from_currencies)
+		]
 
-		amount_a = self.convert(amount_a, currency_a, data['base'])
-		amount_b = self.convert(amount_b, currency_b, data['base'])
+	def convert(self, amount, from_currency, to_currency):
+		return self.convert_many([amount], from_currency, to_currency)[0]
 
+	def is_more_money(self, amount_a, currency_a, amount_b, currency_b):
+		rates = self._get_rates()
+		amount_a, amount_b = self.convert_many([amount_a, amount_b], [currency_a, currency_b], rates.base)
 		return amount_a > amount_b
 
 class HistoricCurrency(Currency):
@@ -87,4 +215,158 @@ class HistoricCurrency(Currency):
 		pass
 
 	def _read_live(self):
-		pass
\ No newline at end of file
+		pass
+
+class HistoricRates:
+	'''
+	Daily exchange rates from fixer.io, one payload per day,
+	kept in memory and in a JSON file.
+
+	Each day is downloaded at most once, ever, so converting amounts
+	at historic rates costs no network call after the first time.
+	`backfill` downloads a whole date range in one go.
+
+	Downloads happen without holding the lock, so looking up days we
+	already have never waits for fixer.io; only callers that want the
+	same missing day wait for the one download of it. Several processes
+	may share the file; each merges what the others saved before
+	writing it.
+	'''
+
+	RETRY_AFTER = 60*60 # seconds to wait before asking for a failed day again
+
+	def __init__(self, filename, secret):
+		self._filename = filename
+		self._secret = secret
+		self._days = None # 'YYYY-MM-DD' -> fixer.io payload
+		self._currencies = {} # 'YYYY-MM-DD' -> HistoricCurrency
+		self._failed = {} # 'YYYY-MM-DD' -> time of failure
+		self._downloading = {} # 'YYYY-MM-DD' -> threading.Event, set when done
+		self._lock = threading.Lock()
+
+	def _read_file(self):
+		if not os.path.isfile(self._filename):
+			return {}
+		with open(self._filename, 'r') as f:
+			return json.loads(f.read())
+
+	def _load(self):
+		if self._days is None:
+			self._days = self._read_file()
+
+	def _save(self):
+		# another process may have saved days we don't have
+		days = self._read_file()
+		days.update(self._days)
+		self._days = days
+
+		content = json.dumps(days, separators=(',', ':'), sort_keys=True)
+		directory, name = os.path.split(os.path.abspath(self._filename))
+		with tempfile.NamedTemporaryFile('w', dir=directory, prefix='.%s.' % name, suffix='.tmp', delete=False) as f:
+			tmp_filename = f.name
+			try:
+				f.write(content)
+			except Exception:
+				f.close()
+				os.unlink(tmp_filename)
+				raise
+		os.replace(tmp_filename, self._filename)
+
+	def _download(self, day):
+		logging.info('Downloading currency exchange rates of %s from fixer.io...', day)
+		# https is a premium feature
+		url = 'http://data.fixer.io/api/%s?access_key=%s' % (day, self._secret)
+		try:
+			with urllib.request.urlopen(url, timeout=30) as f:
+				data = json.loads(f.read().decode('utf-8'))
+		except Exception: # pylint: disable=broad-except
+			logging.error('Failed to download currency exchange rates of %s.', day, exc_info=True)
+			return None
+		if not data.get('success', False):
+			logging.error('Failed to download currency exchange rates of %s: %s', day, data)
+			return None
+		return {'base': data['base'], 'timestamp': data['timestamp'], 'rates': data['rates']}
+
+	def _fetch(self, day):
+		'''Downloads the day and stores it, or waits for the thread
+		that is already doing that. Returns the payload, or None.
+		Call without holding the lock.'''
+
+		with self._lock:
+			event = self._downloading.get(day, None)
+			if event is None:
+				event = self._downloading[day] = threading.Event()
+				is_mine = True
+			else:
+				is_mine = False
+
+		if not is_mine:
+			event.wait()
+			with self._lock:
+				return self._days.get(day, None)
+
+		data = None
+		try:
+			data = self._download(day)
+			with self._lock:
+				if data is None:
+					self._failed[day] = time.time()
+				else:
+					self._days[day] = data
+					self._save()
+		finally:
+			with self._lock:
+				del self._downloading[day]
+			event.set()
+		return data
+
+	def get(self, date):
+		'''Returns a HistoricCurrency for the given datetime.date,
+		or None if fixer.io doesn't know that day (yet).'''
+
+		day = date.isoformat()
+		with self._lock:
+			result = self._currencies.get(day, None)
+			if result is not None:
+				return result
+			self._load()
+			data = self._days.get(day, None)
+			if data is None and time.time() - self._failed.get(day, 0) < self.RETRY_AFTER:
+				return None
+
+		if data is None:
+			data = self._fetch(day)
+			if data is None:
+				return None
+
+		with self._lock:
+			result = self._currencies.get(day, None)
+			if result is None:
+				result = self._currencies[day] = HistoricCurrency(data)
+			return result
+
+	def backfill(self, first_date, last_date):
+		'''Downloads all missing days from first_date to last_date
+		(both datetime.date, inclusive).
+		Returns the number of days downloaded.'''
+
+		with self._lock:
+			self._load()
+			missing = []
+			date = first_date
+			while date <= last_date:
+				if date.isoformat() not in self._days:
+					missing.append(date.isoformat())
+				date += datetime.timedelta(days=1)
+
+		downloaded = {}
+		for day in missing:
+			data = self._download(day)
+			if data is not None:
+				downloaded[day] = data
+
+		if downloaded:
+			with self._lock:
+				self._days.update(downloaded)
+				self._save()
+		return len(downloaded)
@@ -1,11 +1,17 @@
 #!/usr/bin/env python3
 
 import logging
+import threading
+import time
 
 import psycopg2 # `sudo pip3 install psycopg2-binary`
+import psycopg2.extensions
 import psycopg2.extras
 
 
+class PoolTimeout(Exception):
+	pass
+
 class Database: # pylint: disable=too-few-public-methods
 	'''
 	Database adapter class.
@@ -16,6 +22,10 @@ class Database: # pylint: disable=too-few-public-methods
 		for i in db.read('SELECT * FROM table'):
 			print(i['id'], i['name'])`
 
+	Connections are taken from a pool and handed back
+	when the "with" block is left, so opening a connection
+	is cheap after the first few requests.
+
 	Configuration files for postgres daemon:
 	/etc/postgresql/9.6/main/pg_hba.conf
 	/etc/postgresql/9.6/main/postgresql.conf
@@ -27,35 +37,214 @@ class Database: # pylint: disable=too-few-public-methods
 	http://initd.org/psycopg/docs/
 	'''
 
-	def __init__(self, connection_string):
+	def __init__(self, connection_string, pool_size=10, pool_timeout=30):
 		self._connection_string = connection_string
+		self._pool = ConnectionPool(connection_string, pool_size, pool_timeout)
 
 	def connect(self):
 		'''
 		Gets a connection to the database.
-		Seems to hang if a connection already exists.
+		Blocks for up to `pool_timeout` seconds if all
+		`pool_size` connections are in use.
 		'''
-		return Connection(self._connection_string)
+		return Connection(self._pool)
 
-class Connection:
+	def get_pool_metrics(self):
+		return self._pool.get_metrics()
+
+	def listen(self, channel):
+		'''Returns a Listener for NOTIFY messages on `channel`.'''
+		return Listener(self._connection_string, channel)
+
+class Listener:
+	'''
+	A connection of its own (not from the pool), which receives
+	the NOTIFY messages sent to one channel.
+
+	Wait for `fileno()` to become readable, e.g. with select()
+	or an IOLoop, then call `get_payloads()`.
+	'''
 
-	def __init__(self, connection_string):
+	def __init__(self, connection_string, channel):
 		self._connection = psycopg2.connect(connection_string)
-		self._cursor = self._connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
+		self._connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+		with self._connection.cursor() as cursor:
+			# channel names are identifiers, which can't be query parameters
+			cursor.execute('LISTEN %s;' % channel)
+
+	def fileno(self):
+		return self._connection.fileno()
+
+	def get_payloads(self):
+		'''Returns the payloads of all messages received so far.'''
+		self._connection.poll()
+		result = [i.payload for i in self._connection.notifies]
+		del self._connection.notifies[:]
+		return result
+
+	def close(self):
+		try:
+			self._connection.close()
+		except psycopg2.Error:
+			pass
+
+class ConnectionPool:
+	'''
+	A bounded, thread-safe pool of psycopg2 connections.
+
+	Idle connections are reused last-in-first-out, so that rarely
+	needed connections can time out on the server side without
+	us caring. Connections that have been idle for more than
+	PING_AFTER seconds are checked with a "SELECT 1" before
+	they are handed out; broken ones are replaced.
+	'''
+
+	PING_AFTER = 60 # seconds
+
+	def __init__(self, connection_string, max_size, timeout):
+		self._connection_string = connection_string
+		self._max_size = max_size
+		self._timeout = timeout
+		self._idle = [] # (connection, released_at) tuples
+		self._size = 0 # connections in use plus idle ones
+		self._condition = threading.Condition()
+		self._metrics = {
+			'acquired': 0,
+			'opened': 0,
+			'discarded': 0,
+			'waited': 0,
+			'wait_seconds': 0.0,
+			'max_wait_seconds': 0.0,
+			'timeouts': 0,
+		}
+
+	def _is_healthy(self, connection, released_at):
+		if connection.closed:
+			return False
+		if time.time() - released_at < self.PING_AFTER:
+			return True
+		try:
+			with connection.cursor() as cursor:
+				cursor.execute('SELECT 1;')
+			connection.rollback()
+			return True
+		except psycopg2.Error:
+			return False
+
+	def _discard(self, connection):
+		try:
+			connection.close()
+		except psycopg2.Error:
+			pass
+		with self._condition:
+			self._size -= 1
+			self._metrics['discarded'] += 1
+			self._condition.notify()
+
+	def _take_idle_or_slot(self, deadline):
+		'''Returns an idle connection, or None if the caller
+		may open a new one (a slot has been reserved for it).'''
+		with self._condition:
+			waited = False
+			while not self._idle and self._size >= self._max_size:
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					self._metrics['timeouts'] += 1
+					raise PoolTimeout('No database connection available after %s seconds.' % self._timeout)
+				waited = True
+				self._condition.wait(remaining)
+			if waited:
+				self._metrics['waited'] += 1
+			if self._idle:
+				return self._idle.pop()
+			self._size += 1
+			return None
+
+	def acquire(self):
+		t1 = time.time()
+		deadline = t1 + self._timeout
+
+		while True:
+			idle = self._take_idle_or_slot(deadline)
+			if idle is None:
+				break
+			connection, released_at = idle
+			if self._is_healthy(connection, released_at):
+				self._record_acquired(t1)
+				return connection
+			logging.warning('Discarding broken database connection.')
+			self._discard(connection)
+
+		try:
+			connection = psycopg2.connect(self._connection_string)
+		except Exception:
+			with self._condition:
+				self._size -= 1
+				self._condition.notify()
+			raise
+
+		with self._condition:
+			self._metrics['opened'] += 1
+		self._record_acquired(t1)
+		return connection
+
+	def _record_acquired(self, t1):
+		wait = time.time() - t1
+		with self._condition:
+			self._metrics['acquired'] += 1
+			self._metrics['wait_seconds'] += wait
+			self._metrics['max_wait_seconds'] = max(self._metrics['max_wait_seconds'], wait)
+
+	def release(self, connection, discard=False):
+		status = connection.closed or connection.get_transaction_status()
+		if discard or status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+			self._discard(connection)
+			return
+		with self._condition:
+			self._idle.append((connection, time.time()))
+			self._condition.notify()
+
+	def get_metrics(self):
+		with self._condition:
+			result = dict(self._metrics)
+			result['size'] = self._size
+			result['idle'] = len(self._idle)
+			result['in_use'] = self._size - len(self._idle)
+			result['max_size'] = self._max_size
+		return result
+
+class Connection:
+
+	def __init__(self, pool):
+		self._pool = pool
+		self._connection = pool.acquire()
+		try:
+			self._cursor = self._connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
+		except Exception:
+			self._pool.release(self._connection, discard=True)
+			raise
 		self.written = False
 
 	def __enter__(self):
 		return self
 
 	def __exit__(self, exc_type, exc_val, exc_tb):
-		if self.written:
-			if exc_type: # do not commit on exception
-				logging.error('exception during transaction', exc_info=True)
-				self._connection.rollback()
-			else:
+		discard = False
+		try:
+			if self.written and not exc_type:
 				self._connection.commit()
-		self._cursor.close()
-		self._connection.close()
+			else:
+				if self.written: # do not commit on exception
+					logging.error('exception during transaction', exc_info=True)
+				# Even a read-only transaction must be ended before
+				# the connection can be handed to somebody else.
+				self._connection.rollback()
+			self._cursor.close()
+		except psycopg2.Error:
+			discard = True
+			raise
+		finally:
+			self._pool.release(self._connection, discard=discard)
 
 	def _get_row_iterator(self):
 		while True:
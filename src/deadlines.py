@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+import heapq
+
+class DeadlineQueue:
+	'''
+	Things that have to happen at a certain time,
+	e.g. deleting an offer when it expires.
+
+	`schedule` and `pop_due` are O(log n), so checking for due
+	work costs nothing when there is none, no matter how many
+	offers and matches there are.
+
+	Every (kind, key) pair is due at most once. Scheduling it again
+	moves it; the old heap entry is skipped when it comes up.
+	Callers must still check that the event is valid when it fires,
+	because the offer or match may have changed in the meantime.
+	'''
+
+	def __init__(self):
+		self._heap = [] # (due, kind, key)
+		self._due = {} # (kind, key) -> due
+
+	def __len__(self):
+		return len(self._due)
+
+	def schedule(self, due, kind, key):
+		if self._due.get((kind, key), None) == due:
+			return
+		self._due[(kind, key)] = due
+		heapq.heappush(self._heap, (due, kind, key))
+		if len(self._heap) > 2 * len(self._due) + 100:
+			self._compact()
+
+	def cancel(self, kind, key):
+		self._due.pop((kind, key), None)
+
+	def clear(self):
+		self._heap = []
+		self._due = {}
+
+	def rebuild(self, events):
+		'''Replaces everything with `events`, a list of (due, kind, key).
+		This is O(n), cheaper than scheduling them one by one.'''
+		self._due = {(kind, key): due for due, kind, key in events}
+		self._heap = [(due, kind, key) for (kind, key), due in self._due.items()]
+		heapq.heapify(self._heap)
+
+	def _compact(self):
+		self._heap = [(due, kind, key) for (kind, key), due in self._due.items()]
+		heapq.heapify(self._heap)
+
+	def next_due(self):
+		'''Returns the time of the next event, or None.'''
+		while self._heap:
+			due, kind, key = self._heap[0]
+			if self._due.get((kind, key), None) == due:
+				return due
+			heapq.heappop(self._heap)
+		return None
+
+	def pop_due(self, now):
+		'''Removes and returns [(kind, key), ...] of all events
+		that are due at `now`, earliest first.'''
+		result = []
+		while self._heap and self._heap[0][0] <= now:
+			due, kind, key = heapq.heappop(self._heap)
+			if self._due.get((kind, key), None) == due:
+				del self._due[(kind, key)]
+				result.append((kind, key))
+		return result
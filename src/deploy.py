@@ -6,12 +6,14 @@ import os
 import shutil
 
 FILE_LIST = [
+	('assets.py', 0o444),
 	('backup.py', 0o555),
 	('captcha.py', 0o444),
 	('config.py', 0o444),
 	('console.py', 0o555),
 	('currency.py', 0o444),
 	('database.py', 0o444),
+	('deadlines.py', 0o444),
 	('donationswap.py', 0o444),
 	('download-geoip.sh', 0o544),
 	('entities.py', 0o444),
@@ -22,6 +24,7 @@ FILE_LIST = [
 	('matching', 0o777),
 	('matching/*', 0o444),
 	('matchmaker.py', 0o555),
+	('matchscore.py', 0o444),
 	('util.py', 0o444),
 	('data', 0o777),
 	('data/*', 0o444),
@@ -28,25 +28,33 @@ Dependency structure:
 '''
 
 import base64
+import collections
+import contextlib
+import contextvars
 import datetime
+import hashlib
 import json
 import logging
 import os
 import re
 import struct
+import threading
 import time
 import urllib.parse
 
 from passlib.apps import custom_app_context as pwd_context # `sudo pip3 install passlib`
 
+import assets
 import captcha
 import config
 import currency
 import database
+import deadlines
 import entities
 import eventlog
 import geoip
 import mail
+import matchscore
 import util
 
 #xxx anonymize (remove name+email) event log after 3 months
@@ -87,32 +95,190 @@ def create_secret():
 class DonationException(Exception):
 	pass
 
+class RequestContext: # pylint: disable=too-few-public-methods
+	'''Who is asking, and since when.'''
+
+	__slots__ = ['ip_address', 'user', 'command', 'started']
+
+	def __init__(self, ip_address=None, user=None, command=None):
+		self.ip_address = ip_address
+		self.user = user # the admin, for admin ajax calls
+		self.command = command
+		self.started = time.time()
+
+	def get_seconds(self):
+		return time.time() - self.started
+
+# Every thread has its own value, so requests
+# served in parallel never see each other's context.
+_request = contextvars.ContextVar('request', default=RequestContext())
+
+def get_request():
+	'''Returns the RequestContext of the request being served.
+	Outside of requests (cronjobs, console) it is an empty one.'''
+	return _request.get()
+
+@contextlib.contextmanager
+def request_context(ip_address=None, user=None, command=None):
+	context = RequestContext(ip_address, user, command)
+	token = _request.set(context)
+	try:
+		yield context
+	finally:
+		_request.reset(token)
+
+class Page: # pylint: disable=too-few-public-methods
+	'''A rendered page, ready to be sent as it is.'''
+
+	__slots__ = ['content', 'body', 'etag']
+
+	def __init__(self, content):
+		self.content = content
+		self.body = content.encode('utf-8')
+		self.etag = '"%s"' % hashlib.sha256(self.body).hexdigest()[:32]
+
+class Info: # pylint: disable=too-few-public-methods
+	'''The part of `get_info` that is the same for every visitor,
+	built and serialized once.'''
+
+	__slots__ = ['data', 'body', 'hash']
+
+	def __init__(self, data):
+		self.data = data
+		self.body = json.dumps(data, separators=(',', ':'))
+		self.hash = hashlib.sha256(self.body.encode('utf-8')).hexdigest()[:32]
+
+class ReferenceSnapshot:
+	'''
+	All reference data as `read_all` returns it, built once.
+
+	The version is a hash of the content, not a counter, so that it
+	means the same thing in every server process, and two snapshots
+	can be compared record by record to tell what has changed.
+	'''
+
+	__slots__ = ['data', 'version', '_records']
+
+	def __init__(self, data):
+		self.data = data
+		self._records = {
+			kind: {self._get_key(kind, record): record for record in records}
+			for kind, records in data.items()
+		}
+		content = json.dumps({
+			kind: [records[key] for key in sorted(records)]
+			for kind, records in self._records.items()
+		}, sort_keys=True)
+		self.version = hashlib.sha256(content.encode('utf-8')).hexdigest()[:32]
+
+	@staticmethod
+	def _get_key(kind, record):
+		if kind == 'charities_in_countries':
+			return (record['charity_id'], record['country_id'])
+		return record['id']
+
+	def get_changes_since(self, old):
+		'''Returns (changed, deleted), each {kind: [record, ...]},
+		with the records that were added or changed since the `old`
+		snapshot, and those that were deleted, as they were.'''
+		changed = {}
+		deleted = {}
+		for kind, records in self._records.items():
+			old_records = old._records.get(kind, {}) # pylint: disable=protected-access
+			changed[kind] = [record for key, record in records.items() if old_records.get(key, None) != record]
+			deleted[kind] = [record for key, record in old_records.items() if key not in records]
+		return changed, deleted
+
 class Donationswap:
 	# pylint: disable=too-many-instance-attributes
 	# pylint: disable=too-many-public-methods
 
-	STATIC_VERSION = 4 # cache-breaker
+	# Unknown match secrets are remembered for a while, so that
+	# guessing secrets cannot make us hit the database over and over.
+	MISSED_SECRET_TTL = 10*60 # seconds
+	MISSED_SECRET_MAX_COUNT = 10000
+	MISSED_SECRET_REFRESH_INTERVAL = 5 # seconds
+
+	# `read_changes_since` can tell the changes since any of
+	# the last so many versions of the reference data.
+	REFERENCE_SNAPSHOTS = 20
+
+	# housekeeping events, see `run_deadlines()`
+	UNCONFIRMED_OFFER = 'unconfirmed offer'
+	EXPIRED_OFFER = 'expired offer'
+	MATCH_FEEDBACK = 'match feedback'
+	UNCONFIRMED_OFFER_AGE = datetime.timedelta(days=1)
+	MATCH_FEEDBACK_AGE = datetime.timedelta(days=31)
+	MAX_FEEDBACK_EMAILS_PER_RUN = 5
+
+	MAX_QUEUED_PER_WORKER = 20 # requests waiting for a worker thread
 
 	def __init__(self, config_path):
 		self._config = config.Config(config_path)
 
-		self._database = database.Database(self._config.db_connection_string)
+		self._database = database.Database(self._config.db_connection_string, self._config.db_pool_size)
 
 		self._captcha = captcha.Captcha(self._config.captcha_secret)
 		self._currency = currency.Currency(self._config.currency_cache, self._config.fixer_apikey)
+		self._historic_rates = currency.HistoricRates(self._config.currency_history, self._config.fixer_apikey)
 		self._geoip = geoip.GeoIpCountry(self._config.geoip_datafile)
 		self._mail = mail.Mail(self._config.email_user, self._config.email_password, self._config.email_smtp, self._config.email_from, self._config.email_sender_name)
 
 		with self._database.connect() as db:
 			entities.load(db)
 
-		self._ip_address = None
+		# The deadline queue and the candidate graph are changed by
+		# whichever worker thread gets to them, so they need locks.
+		self._candidates = matchscore.CandidateGraph()
+		self._candidates_lock = threading.RLock()
+
+		self._missed_secrets = util.ExpiringSet(self.MISSED_SECRET_TTL, self.MISSED_SECRET_MAX_COUNT)
+		self._last_missed_secret_refresh = None
+
+		self._deadlines = deadlines.DeadlineQueue()
+		self._deadlines_serial = None
+		self._deadlines_lock = threading.RLock()
+
+		self._workers = util.WorkerPool(self._config.worker_threads, self._config.worker_threads * self.MAX_QUEUED_PER_WORKER)
+
+		self._assets = assets.Assets('static')
+		self._response_sizes = util.ResponseSizes()
+		self._pages = {} # name -> ((template version, assets version), Page or None)
+		self._info = (None, None) # ((reference version, rates version), Info)
+		self._reference_snapshot = (None, None) # (reference version, ReferenceSnapshot)
+		self._reference_snapshots = collections.OrderedDict() # recent ones, version -> ReferenceSnapshot
+		self._reference_snapshots_lock = threading.Lock()
 
 		self.automation_mode = False
 
 	def get_cookie_key(self):
 		return self._config.cookie_key
 
+	def should_run_deadlines(self):
+		'''Whether the web server calls `run_deadlines` every minute.'''
+		return self._config.run_deadlines
+
+	def should_refresh_exchange_rates(self):
+		'''Whether the web server calls `refresh_exchange_rates` every
+		few minutes. Otherwise the first request that finds the rates
+		too old starts the refresh (in the background, too).'''
+		return self._config.refresh_exchange_rates
+
+	def listen_for_changes(self):
+		'''Returns a `database.Listener` that receives a message whenever
+		any process has changed a cached table. Call `refresh_entities`
+		when one arrives.'''
+		return self._database.listen(entities.CHANGES_CHANNEL)
+
+	def refresh_entities(self):
+		with self._database.connect() as db:
+			return entities.refresh(db)
+
+	def get_worker_pool(self):
+		'''The web layer runs everything that may block
+		(`run_ajax`, `run_admin_ajax`, `clean_up`) in here.'''
+		return self._workers
+
 	@staticmethod
 	def _int(number, msg):
 		try:
@@ -130,12 +296,20 @@ class Donationswap:
 
 		match = entities.Match.by_secret(match_secret)
 
-		if match is None:
-			# not cached yet? reload from db
-			logging.debug('reloading matches')
-			with self._database.connect() as db:
-				entities.Match.load(db)
-			match = entities.Match.by_secret(match_secret)
+		if match is None and match_secret not in self._missed_secrets:
+			# Not cached yet? Fetch what changed in the db,
+			# but not more often than every few seconds.
+			now = time.monotonic()
+			if self._last_missed_secret_refresh is None or now - self._last_missed_secret_refresh >= self.MISSED_SECRET_REFRESH_INTERVAL:
+				self._last_missed_secret_refresh = now
+				logging.debug('refreshing entities')
+				with self._database.connect() as db:
+					entities.refresh(db)
+				match = entities.Match.by_secret(match_secret)
+				if match is None:
+					# Only remember secrets that are known to be missing,
+					# so a real one that was too early gets another try.
+					self._missed_secrets.add(match_secret)
 
 		if match is None:
 			logging.debug('match with secret "%s" not found.', match_secret)
@@ -165,13 +339,10 @@ class Donationswap:
 		if not getattr(method, 'allow_ajax', False):
 			return False, None # ajax not allowed
 
-		self._ip_address = ip_address
-
 		try:
-			t1 = time.time()
-			result = method(**args)
-			t2 = time.time()
-			logging.debug('Benchmark: %s: %s sec.', command, t2-t1)
+			with request_context(ip_address, command=command) as request:
+				result = method(**args)
+				logging.debug('Benchmark: %s: %s sec.', command, request.get_seconds())
 			return True, result
 		except DonationException as e:
 			return False, str(e)
@@ -199,19 +370,16 @@ class Donationswap:
 		if not getattr(method, 'allow_admin_ajax', False):
 			return False, 'not an admin-ajax method'
 
-		self._ip_address = ip_address
-
 		try:
-			t1 = time.time()
-			result = method(user, **args)
-			t2 = time.time()
-			logging.debug('Benchmark: %s: %s sec.', command, t2-t1)
+			with request_context(ip_address, user, command) as request:
+				result = method(user, **args)
+				logging.debug('Benchmark: %s: %s sec.', command, request.get_seconds())
 			return True, result
 		except Exception as e: # pylint: disable=broad-except
 			logging.error('Ajax Admin Error', exc_info=True)
 			return False, str(e)
 
-	def get_page(self, name):
+	def _render_page(self, name):
 
 		replacements = {
 			'{%CAPTCHA_SITE_KEY%}': self._config.captcha_site_key,
@@ -219,15 +387,36 @@ class Donationswap:
 
 		content = util.Template(name).replace(replacements).content
 
-		# This acts as a cache breaker -- just increment
-		# self.STATIC_VERSION whenever a static file has changed,
-		# so the client will know to re-request it from the server.
-		# The only exception are files referenced in style.css,
-		# which must be handled manually.
-		content = re.sub('src="/static/(.*?)"', lambda m: 'src="/static/%s?v=%s"' % (m.group(1), self.STATIC_VERSION), content)
-		content = re.sub('href="/static/(.*?)"', lambda m: 'href="/static/%s?v=%s"' % (m.group(1), self.STATIC_VERSION), content)
+		# Static files are referenced by the hash of their content,
+		# so browsers re-request exactly the files that have changed.
+		return self._assets.rewrite(content)
+
+	def get_cached_page(self, name):
+		'''Returns the page as a `Page`, or None if there is no such page.
+		Pages are rendered once, and again only when their template
+		or a static file has changed.'''
+
+		version = (util.Template(name).version, self._assets.get_version())
+		cached = self._pages.get(name, None)
+		if cached is not None and cached[0] == version:
+			return cached[1]
+
+		content = self._render_page(name)
+		page = Page(content) if content else None
+		self._pages[name] = (version, page)
+		return page
+
+	def get_page(self, name):
+		page = self.get_cached_page(name)
+		return page.content if page is not None else ''
 
-		return content
+	def get_asset(self, path):
+		'''Returns the `assets.Asset` for a file in static/, or None.'''
+		return self._assets.get(path)
+
+	def record_response_size(self, endpoint, raw_size, sent_size):
+		'''The web layer reports how much compression saved.'''
+		self._response_sizes.add(endpoint, raw_size, sent_size)
 
 	def _send_mail_about_unconfirmed_offer(self, offer):
 		replacements = {
@@ -258,23 +447,23 @@ class Donationswap:
 			to=offer.email
 		)
 
-	def _delete_unconfirmed_offers(self):
+	def _delete_unconfirmed_offer(self, db, offer, now):
 		'''An offer is considered unconfirmed if it has not
 		been confirmed for 24 hours.
 		We delete it and send the donor an email.'''
 
-		count = 0
-		one_day_ago = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+		if offer.confirmed:
+			return False
+		if offer.created_ts + self.UNCONFIRMED_OFFER_AGE > now:
+			self._schedule_offer(offer)
+			return False
 
-		with self._database.connect() as db:
-			for offer in entities.Offer.get_all(lambda x: not x.confirmed and x.created_ts < one_day_ago):
-				logging.info('Deleting unconfirmed offer %s.', offer.id)
-				offer.delete(db)
-				eventlog.offer_unconfirmed(db, offer)
-				self._send_mail_about_unconfirmed_offer(offer)
-				count += 1
-
-		return count
+		logging.info('Deleting unconfirmed offer %s.', offer.id)
+		offer.delete(db)
+		self._update_candidates(offer.id)
+		eventlog.offer_unconfirmed(db, offer)
+		self._send_mail_about_unconfirmed_offer(offer)
+		return True
 
 	def _send_mail_about_expired_offer(self, offer):
 		newExpirey = offer.expires_ts + (offer.expires_ts - offer.created_ts)
@@ -306,22 +495,23 @@ class Donationswap:
 			to=offer.email
 		)
 
-	def _delete_expired_offers(self):
+	def _delete_expired_offer(self, db, offer, now):
 		'''An offer is considered expired if its expiration date
 		is in the past and it is not part of a match.
 		We delete it and send the donor an email.'''
 
-		count = 0
+		if entities.Match.has_offer(offer.id):
+			return False # rescheduled if the match gets declined
+		if offer.expires_ts > now:
+			self._schedule_offer(offer)
+			return False
 
-		with self._database.connect() as db:
-			for offer in entities.Offer.get_expired_offers(db):
-				logging.info('Deleting expired offer %s.', offer.id)
-				offer.delete(db)
-				eventlog.offer_expired(db, offer)
-				self._send_mail_about_expired_offer(offer)
-				count += 1
-
-		return count
+		logging.info('Deleting expired offer %s.', offer.id)
+		offer.delete(db)
+		self._update_candidates(offer.id)
+		eventlog.offer_expired(db, offer)
+		self._send_mail_about_expired_offer(offer)
+		return True
 
 	def _send_mail_about_unconfirmed_matches(self, match):
 		new_offer = entities.Offer.by_id(match.new_offer_id)
@@ -450,22 +640,125 @@ class Donationswap:
 			html=util.Template('feedback-email.html').replace(old_replacements).content,
 			to=old_offer.email)
 
-	def _delete_expired_matches(self):
+	def _request_match_feedback(self, db, match, now):
 		'''Send a feedback email one month after creation.'''
-		count = 0
-		one_month_ago = datetime.datetime.utcnow() - datetime.timedelta(days=31)
 
-		with self._database.connect() as db:
-			feedback_ready = entities.Match.get_feedback_ready_matches(db)
-			for match in feedback_ready[:5]:
-				if (match.created_ts < one_month_ago):
-					logging.info('Requesting feedback for match %s', match.id)
-					eventlog.match_feedback(db, match)
-					match.set_feedback_requested(db)
-					self._send_feedback_email(match, db)
-					count += 1
+		if match.feedback_requested or not (match.new_agrees and match.old_agrees):
+			return False # rescheduled when the match gets approved
+		if match.created_ts + self.MATCH_FEEDBACK_AGE > now:
+			self._schedule_match(match)
+			return False
+
+		logging.info('Requesting feedback for match %s', match.id)
+		eventlog.match_feedback(db, match)
+		match = match.set_feedback_requested(db)
+		self._send_feedback_email(match, db)
 		#xxx delete two offers and one match one week after feedback_ts TODO elsewhere maybe?
-		return count
+		return True
+
+	def _schedule_offer(self, offer):
+		with self._deadlines_lock:
+			if offer.confirmed:
+				self._deadlines.cancel(self.UNCONFIRMED_OFFER, offer.id)
+			else:
+				self._deadlines.schedule(offer.created_ts + self.UNCONFIRMED_OFFER_AGE, self.UNCONFIRMED_OFFER, offer.id)
+			self._deadlines.schedule(offer.expires_ts, self.EXPIRED_OFFER, offer.id)
+
+	def _schedule_match(self, match):
+		if not match.feedback_requested:
+			with self._deadlines_lock:
+				self._deadlines.schedule(match.created_ts + self.MATCH_FEEDBACK_AGE, self.MATCH_FEEDBACK, match.id)
+
+	def _update_deadlines(self):
+		'''Brings the deadline queue up to date with the offers and
+		matches that `entities.refresh` merged since the last time,
+		e.g. because console.py or another process changed them. Only
+		rows that changed are looked at; the whole queue is rebuilt
+		only after the caches were loaded from scratch. Changes made by
+		this process schedule their own deadlines as they happen.
+		Call with _deadlines_lock held.'''
+
+		self._deadlines_serial, changes = entities.get_changes_since(self._deadlines_serial)
+
+		if changes is None:
+			events = []
+			for offer in entities.Offer.get_all():
+				if not offer.confirmed:
+					events.append((offer.created_ts + self.UNCONFIRMED_OFFER_AGE, self.UNCONFIRMED_OFFER, offer.id))
+				events.append((offer.expires_ts, self.EXPIRED_OFFER, offer.id))
+			for match in entities.Match.get_all(lambda x: not x.feedback_requested):
+				events.append((match.created_ts + self.MATCH_FEEDBACK_AGE, self.MATCH_FEEDBACK, match.id))
+			self._deadlines.rebuild(events)
+			return
+
+		for cls, key in changes:
+			if cls is entities.Offer:
+				offer = entities.Offer.by_id(key)
+				if offer is None:
+					self._deadlines.cancel(self.UNCONFIRMED_OFFER, key)
+					self._deadlines.cancel(self.EXPIRED_OFFER, key)
+				else:
+					self._schedule_offer(offer)
+			elif cls is entities.Match:
+				match = entities.Match.by_id(key)
+				if match is None or match.feedback_requested:
+					self._deadlines.cancel(self.MATCH_FEEDBACK, key)
+				else:
+					self._schedule_match(match)
+
+	def run_deadlines(self):
+		'''Deletes unconfirmed and expired offers and asks for feedback
+		on matches, as they become due. Finding them costs O(log n)
+		per event, and nothing at all if nothing is due, so this
+		can be called every minute.'''
+
+		counts = {
+			'unconfirmed_offers': 0,
+			'expired_offers': 0,
+			'expired_matches': 0,
+		}
+
+		with self._database.connect() as db:
+			entities.refresh(db)
+
+		now = datetime.datetime.utcnow()
+		with self._deadlines_lock:
+			self._update_deadlines()
+			due = self._deadlines.pop_due(now)
+		if not due:
+			return counts
+
+		with self._database.connect() as db:
+			for kind, key in due:
+				if kind == self.UNCONFIRMED_OFFER:
+					offer = entities.Offer.by_id(key)
+					if offer is not None and self._delete_unconfirmed_offer(db, offer, now):
+						counts['unconfirmed_offers'] += 1
+				elif kind == self.EXPIRED_OFFER:
+					offer = entities.Offer.by_id(key)
+					if offer is not None and self._delete_expired_offer(db, offer, now):
+						counts['expired_offers'] += 1
+				elif kind == self.MATCH_FEEDBACK:
+					match = entities.Match.by_id(key)
+					if match is None:
+						continue
+					if counts['expired_matches'] >= self.MAX_FEEDBACK_EMAILS_PER_RUN:
+						# don't send too many emails at once
+						with self._deadlines_lock:
+							self._deadlines.schedule(now + datetime.timedelta(hours=1), kind, key)
+					elif self._request_match_feedback(db, match, now):
+						counts['expired_matches'] += 1
+
+		return counts
+
+	def refresh_exchange_rates(self):
+		'''Never blocks, see `currency.Currency.refresh_in_background`.'''
+		return self._currency.refresh_in_background()
+
+	def backfill_historic_rates(self, first_date, last_date):
+		'''Downloads the daily exchange rates of a date range,
+		e.g. for all matches before generating statistics.'''
+		return self._historic_rates.backfill(first_date, last_date)
 
 	def clean_up(self):
 		'''This method gets called once per hour by a cronjob.'''
@@ -477,26 +770,26 @@ class Donationswap:
 		# so I guess it's alright.
 		self._geoip.clear()
 
-		counts = {
-			'unconfirmed_offers': self._delete_unconfirmed_offers(),
-			'expired_offers': self._delete_expired_offers(),
-			'unconfirmed_matches': self._delete_unconfirmed_matches(),
-			'expired_matches': self._delete_expired_matches(),
-		}
+		counts = self.run_deadlines()
+		counts['unconfirmed_matches'] = self._delete_unconfirmed_matches()
+
+		with self._database.connect() as db:
+			counts['tombstones'] = entities.delete_old_tombstones(db)
 
 		return '%s\n' % '\n'.join('%s=%s' % i for i in sorted(counts.items()))
 
 	@ajax
 	def send_contact_message(self, captcha_response, message, name=None, email=None):
-		if not self.automation_mode and not self._captcha.is_legit(self._ip_address, captcha_response):
+		ip_address = get_request().ip_address
+		if not self.automation_mode and not self._captcha.is_legit(ip_address, captcha_response):
 			raise DonationException(
 				util.Template('errors-and-warnings.json').json('bad captcha')
 			)
 
 		tmp = util.Template('contact-email.txt')
 		tmp.replace({
-			'{%IP_ADDRESS%}': self._ip_address,
-			'{%COUNTRY%}': self._geoip.lookup(self._ip_address),
+			'{%IP_ADDRESS%}': ip_address,
+			'{%COUNTRY%}': self._geoip.lookup(ip_address),
 			'{%NAME%}': name or 'n/a',
 			'{%EMAIL%}': email or 'n/a',
 			'{%MESSAGE%}': message.strip(),
@@ -548,40 +841,69 @@ class Donationswap:
 
 	@staticmethod
 	def _get_charities_in_countries_info():
-		result = {}
-		for country in entities.Country.get_all():
-			result[country.id] = []
-			for charity in entities.Charity.get_all():
-				charity_in_country = entities.CharityInCountry.by_charity_and_country_id(charity.id, country.id)
-				if charity_in_country is not None:
-					result[country.id].append(charity.id)
-		return result
+		return {
+			country.id: entities.CharityInCountry.get_charity_ids(country.id)
+			for country in entities.Country.get_all()
+		}
 
-	@ajax
-	def get_info(self):
-		client_country_iso = self._geoip.lookup(self._ip_address)
+	def _get_cached_info(self):
+		'''Charities, countries and which charities are tax deductible
+		where, rebuilt only when one of them (see
+		`entities.get_reference_version`) or the exchange rates
+		(for `min_donation_amount`) have changed.'''
+
+		version = (entities.get_reference_version(), self._currency.get_version())
+		cached_version, info = self._info
+		if cached_version == version:
+			return info
+
+		info = Info({
+			'charities': self._get_charities_info(),
+			'countries': self._get_countries_info(),
+			'charities_in_countries': self._get_charities_in_countries_info(),
+		})
+		self._info = (version, info)
+		return info
+
+	def _get_visitor_info(self):
+		ip_address = get_request().ip_address
+		client_country_iso = self._geoip.lookup(ip_address)
 		client_country = entities.Country.by_iso_name(client_country_iso)
 		if client_country:
 			client_country_id = client_country.id
 		else:
 			client_country_id = None
 
-		logging.info('Website visitor from %s with IP address "%s".', client_country_iso, self._ip_address)
+		logging.info('Website visitor from %s with IP address "%s".', client_country_iso, ip_address)
 
 		today = datetime.datetime.utcnow()
 
-		return {
-			'charities': self._get_charities_info(),
-			'client_country': client_country_id,
-			'countries': self._get_countries_info(),
-			'charities_in_countries': self._get_charities_in_countries_info(),
-			'today': {
-				'day': today.day,
-				'month': today.month,
-				'year': today.year,
-			},
+		return client_country_id, {
+			'day': today.day,
+			'month': today.month,
+			'year': today.year,
 		}
 
+	@ajax
+	def get_info(self):
+		result = dict(self._get_cached_info().data)
+		result['client_country'], result['today'] = self._get_visitor_info()
+		return result
+
+	def get_info_json(self, ip_address):
+		'''Returns (etag, body) of `get_info` as JSON. Only the visitor's
+		country and today's date are added to the cached part, so
+		neither has to be built or serialized again, and the etag
+		tells whether the client already has this exact response.'''
+
+		with request_context(ip_address, command='get_info'):
+			info = self._get_cached_info()
+			client_country, today = self._get_visitor_info()
+
+		etag = 'W/"%s-%s-%04d%02d%02d"' % (info.hash, client_country, today['year'], today['month'], today['day'])
+		body = '%s,"client_country":%s,"today":%s}' % (info.body[:-1], json.dumps(client_country), json.dumps(today))
+		return etag, body.encode('utf-8')
+
 	@ajax
 	def get_charity_in_country_info(self, charity_id, country_id): # pylint: disable=no-self-use
 		charity_in_country = entities.CharityInCountry.by_charity_and_country_id(charity_id, country_id)
@@ -613,8 +935,8 @@ class Donationswap:
 
 		min_allowed_amount = self._currency.convert(
 			country.min_donation_amount,
-			country.min_donation_currency,
-			country.currency)
+			country.min_donation_currency.iso,
+			country.currency.iso)
 
 		if min_amount < min_allowed_amount:
 			raise DonationException(errors.json('min_amount_too_small') % (
@@ -652,7 +974,7 @@ class Donationswap:
 	@ajax
 	def create_offer(self, captcha_response, name, country, amount, min_amount, charity, email, expiration):
 		errors = util.Template('errors-and-warnings.json')
-		if not self.automation_mode and not self._captcha.is_legit(self._ip_address, captcha_response):
+		if not self.automation_mode and not self._captcha.is_legit(get_request().ip_address, captcha_response):
 			raise DonationException(errors.json('bad captcha'))
 
 		name, country, amount, min_amount, charity, email, expires_ts = self._validate_offer(name, country, amount, min_amount, charity, email, expiration)
@@ -664,6 +986,7 @@ class Donationswap:
 		with self._database.connect() as db:
 			offer = entities.Offer.create(db, secret, name, email, country.id, amount, min_amount, charity.id, expires_ts)
 			eventlog.created_offer(db, offer)
+		self._schedule_offer(offer)
 
 		if self.automation_mode:
 			return offer
@@ -702,8 +1025,10 @@ class Donationswap:
 
 		if not was_confirmed:
 			with self._database.connect() as db:
-				offer.confirm(db)
+				offer = offer.confirm(db)
 				eventlog.confirmed_offer(db, offer)
+			self._schedule_offer(offer)
+			self._update_candidates(offer.id)
 
 		replacements = {
 			'{%CHARITY%}': offer.charity.name,
@@ -738,86 +1063,36 @@ class Donationswap:
 			with self._database.connect() as db:
 				offer.delete(db)
 				eventlog.deleted_offer(db, offer)
-
-	def _get_match_score(self, offer_a, offer_b, db):
-		if offer_a.id == offer_b.id:
-			return 0, 'same offer'
-
-		if offer_a.charity_id == offer_b.charity_id:
-			return 0, 'same charity'
-
-		if offer_a.country_id == offer_b.country_id:
-			return 0, 'same country'
-
-		if offer_a.email.lower() == offer_b.email.lower():
-			return 0, 'same email address'
-
-		amount_a_in_currency_b = self._currency.convert(
-			offer_a.amount,
-			offer_a.country.currency.iso,
-			offer_b.country.currency.iso) * offer_a.country.gift_aid_multiplier
-		amount_b_in_currency_a = self._currency.convert(
-			offer_b.amount,
-			offer_b.country.currency.iso,
-			offer_a.country.currency.iso) * offer_b.country.gift_aid_multiplier
-
-		if amount_a_in_currency_b < offer_b.min_amount * offer_b.country.gift_aid_multiplier:
-			return 0, 'amount mismatch'
-		if amount_b_in_currency_a < offer_a.min_amount * offer_a.country.gift_aid_multiplier:
-			return 0, 'amount mismatch'
-
-		#xxx only count as "benefit" if own charity isn't tax-deductible, but other donor's one is
-		#    (otherwise we would reward pointless swaps, where both donors already get their tax back)
-		#    J -> we can start by checking whether we would have gotten a benefit by donating to our chosen charity anyway
-		a_would_have_benefit = entities.CharityInCountry.by_charity_and_country_id(offer_a.charity_id, offer_a.country_id) is not None
-		b_would_have_benefit = entities.CharityInCountry.by_charity_and_country_id(offer_b.charity_id, offer_b.country_id) is not None
-
-		if a_would_have_benefit and b_would_have_benefit:
-			return 0, 'both would benefit from donating to their chosen charity anyway'
-
-		a_will_benefit = entities.CharityInCountry.by_charity_and_country_id(offer_b.charity_id, offer_a.country_id) is not None
-		b_will_benefit = entities.CharityInCountry.by_charity_and_country_id(offer_a.charity_id, offer_b.country_id) is not None
-
-		if not a_will_benefit and not b_will_benefit:
-			return 0, 'nobody will benefit'
-
-		query = '''
-			SELECT 1
-			FROM declined_matches
-			WHERE (new_offer_id = %(id_a)s AND old_offer_id = %(id_b)s)
-				OR (new_offer_id = %(id_b)s AND old_offer_id = %(id_a)s);
-		'''
-		declined = db.read_one(query, id_a=offer_a.id, id_b=offer_b.id) or False
-		if declined:
-			return 0, 'match declined'
-
-		# TODO
-		#xxx
-		# scoring should be impacted by a_would_have_benefit and b_would_have_benefit
-		# if either is true *0.5?
-
-		# amounts are equal => score = 1
-		# amounts are vastly different => score = almost 0
-		amount_a_in_nzd = self._currency.convert(
-			offer_a.amount,
-			offer_a.country.currency.iso,
-			'NZD') * offer_a.country.gift_aid_multiplier
-		amount_b_in_nzd = self._currency.convert(
-			offer_b.amount,
-			offer_b.country.currency.iso,
-			'NZD') * offer_b.country.gift_aid_multiplier
-
-		score = 1 - (amount_a_in_nzd - amount_b_in_nzd)**2 / max(amount_a_in_nzd, amount_b_in_nzd)**2
-
-		if a_will_benefit and b_will_benefit:
-			factor, reason = 1, 'both benefit'
+			self._update_candidates(offer.id)
+
+	def _get_offer_book(self, offers):
+		return matchscore.OfferBook(offers, self._currency)
+
+	def _update_candidates(self, *offer_ids):
+		'''Adds offers to the candidate graph or removes them from it,
+		depending on whether they can be matched now.'''
+		with self._candidates_lock:
+			for offer_id in offer_ids:
+				if not entities.Offer.is_unmatched(offer_id):
+					self._candidates.remove(offer_id)
+				elif offer_id not in self._candidates:
+					self._candidates.add(entities.Offer.by_id(offer_id))
+
+	def _get_candidate_graph(self):
+		'''Returns the candidate graph of all unmatched offers.
+		Changes made by this process update the graph as they happen
+		(see `_update_candidates`); changes made by console.py or other
+		processes are found by comparing offer ids, and only those
+		offers get (un)scored, unless exchange rates or charities changed.
+		Call with _candidates_lock held.'''
+
+		offers = self._get_unmatched_offers()
+		version = (self._currency.get_version(), entities.get_reference_version())
+		if version != self._candidates.version:
+			self._candidates.rebuild(offers, self._currency, version)
 		else:
-			factor, reason = 0.5, 'only one will benefit'
-
-		score *= factor
-
-		score = round(score, 4)
-		return score, reason
+			self._candidates.sync(offers)
+		return self._candidates
 
 	def _get_actual_amounts(self, match, my_offer, their_offer, db):
 
@@ -830,17 +1105,10 @@ class Donationswap:
 
 		currencyData = self._currency
 
-		try:
-			one_day_ago = datetime.datetime.utcnow() - datetime.timedelta(days=1)
-			if (match.created_ts < one_day_ago) :
-				url = 'http://data.fixer.io/api/{:04d}-{:02d}-{:02d}?access_key=%s' % (match.created_ts.year, match.created_ts.month, match.created_ts.day, self._secret)
-				with urllib.request.urlopen(url) as f:
-					content = f.read()
-					data = json.loads(content.decode('utf-8'))
-					if data.get('success', False):
-						currencyData = currency.HistoricCurrency(data)
-		except:
-			pass # just use now currency if we can't get historic
+		one_day_ago = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+		if (match.created_ts < one_day_ago) :
+			# just use now currency if we can't get historic
+			currencyData = self._historic_rates.get(match.created_ts.date()) or self._currency
 
 		if currencyData.is_more_money(
 			my_offer.amount * my_offer.country.gift_aid_multiplier,
@@ -862,11 +1130,11 @@ class Donationswap:
 
 		# save to DB
 		if (match.new_offer_id == my_offer.id and match.old_offer_id == their_offer.id):
-			match.set_new_amount_suggested_requested(db, my_actual_amount)
-			match.set_old_amount_suggested_requested(db, their_actual_amount)
+			match = match.set_new_amount_suggested_requested(db, my_actual_amount)
+			match = match.set_old_amount_suggested_requested(db, their_actual_amount)
 		elif (match.old_offer_id == my_offer.id and match.new_offer_id == their_offer.id):
-			match.set_old_amount_suggested_requested(db, my_actual_amount)
-			match.set_new_amount_suggested_requested(db, their_actual_amount)
+			match = match.set_old_amount_suggested_requested(db, my_actual_amount)
+			match = match.set_new_amount_suggested_requested(db, their_actual_amount)
 
 		return my_actual_amount, their_actual_amount
 
@@ -999,14 +1267,15 @@ class Donationswap:
 
 		with self._database.connect() as db:
 			if my_offer == old_offer:
-				match.agree_old(db)
+				match = match.agree_old(db)
 				eventlog.approved_match(db, match, my_offer)
 			elif my_offer == new_offer:
-				match.agree_new(db)
+				match = match.agree_new(db)
 				eventlog.approved_match(db, match, my_offer)
 
 			if match.old_agrees and match.new_agrees:
 				self._send_mail_about_approved_match(match, old_offer, new_offer, db)
+				self._schedule_match(match)
 
 	@ajax
 	def decline_match(self, secret, feedback):
@@ -1019,18 +1288,15 @@ class Donationswap:
 			)
 
 		with self._database.connect() as db:
-			query = '''
-				do $$ begin
-					IF NOT EXISTS (SELECT * FROM declined_matches WHERE new_offer_id=%(id_old)s AND old_offer_id=%(id_new)s) THEN
-						INSERT INTO declined_matches (new_offer_id, old_offer_id)
-						VALUES (%(id_old)s, %(id_new)s);
-					END IF;
-				end $$;
-			'''
-			db.write(query, id_old=old_offer.id, id_new=new_offer.id)
+			entities.DeclinedMatch.create(db, old_offer.id, new_offer.id)
+			with self._candidates_lock:
+				self._candidates.decline(old_offer.id, new_offer.id)
 			match.delete(db)
-			my_offer.suspend(db)
+			my_offer = my_offer.suspend(db)
 			eventlog.declined_match(db, match, my_offer, feedback)
+			self._schedule_offer(my_offer)
+			self._schedule_offer(other_offer)
+			self._update_candidates(my_offer.id, other_offer.id)
 
 			#TODO: needs args applied to a new offer rather than reconfirming old offer
 			replacements = {
@@ -1131,6 +1397,15 @@ class Donationswap:
 	def get_admin_info(self, user): # pylint: disable=no-self-use
 		return user
 
+	@admin_ajax
+	def get_metrics(self, _):
+		return {
+			'database_pool': self._database.get_pool_metrics(),
+			'exchange_rates': self._currency.get_metrics(),
+			'response_sizes': self._response_sizes.get(),
+			'workers': self._workers.get_metrics(),
+		}
+
 	@admin_ajax
 	def get_currencies(self, _): # pylint: disable=no-self-use
 		return [
@@ -1154,9 +1429,17 @@ class Donationswap:
 			db.write(query, currency_id=currency_id, id=user['id'])
 			return True
 
-	@admin_ajax
-	def read_all(self, _): # pylint: disable=no-self-use
-		return {
+	def _get_reference_snapshot(self):
+		'''Returns the current `ReferenceSnapshot`, which is rebuilt only
+		when reference data has changed (see `entities.get_reference_version`),
+		and remembers the last REFERENCE_SNAPSHOTS versions.'''
+
+		version = entities.get_reference_version()
+		cached_version, snapshot = self._reference_snapshot
+		if cached_version == version:
+			return snapshot
+
+		snapshot = ReferenceSnapshot({
 			'currencies': [
 				{
 					'id': i.id,
@@ -1207,8 +1490,48 @@ class Donationswap:
 					'country_id': i.country_id,
 					'instructions': i.instructions,
 				}
-				for i in entities.CharityInCountry.get_all()
+				for i in sorted(
+					entities.CharityInCountry.get_all(),
+					key=lambda x: (x.charity_id, x.country_id))
 			],
+		})
+		with self._reference_snapshots_lock:
+			snapshot = self._reference_snapshots.setdefault(snapshot.version, snapshot)
+			self._reference_snapshots.move_to_end(snapshot.version)
+			while len(self._reference_snapshots) > self.REFERENCE_SNAPSHOTS:
+				self._reference_snapshots.popitem(last=False)
+		self._reference_snapshot = (version, snapshot)
+		return snapshot
+
+	@admin_ajax
+	def read_all(self, _):
+		snapshot = self._get_reference_snapshot()
+		result = dict(snapshot.data)
+		result['version'] = snapshot.version
+		return result
+
+	@admin_ajax
+	def read_changes_since(self, _, version):
+		'''Returns the records that were added, changed or deleted since
+		`version` (from `read_all` or an earlier call). If that version is
+		too old, or this process has never seen it, all records are
+		returned as changed, and `full` is true.'''
+
+		snapshot = self._get_reference_snapshot()
+		with self._reference_snapshots_lock:
+			old = self._reference_snapshots.get(version, None)
+
+		if old is None:
+			changed = snapshot.data
+			deleted = {kind: [] for kind in snapshot.data}
+		else:
+			changed, deleted = snapshot.get_changes_since(old)
+
+		return {
+			'version': snapshot.version,
+			'full': old is None,
+			'changed': changed,
+			'deleted': deleted,
 		}
 
 	@admin_ajax
@@ -1364,12 +1687,19 @@ class Donationswap:
 		not expired and not matched.'''
 
 		with self._database.connect() as db:
-			entities.Offer.load(db) # only necessary because of console.py
-			return entities.Offer.get_unmatched_offers(db)
+			entities.refresh(db) # only necessary because of console.py
+		return entities.Offer.get_unmatched_offers()
 
 	@admin_ajax
 	def get_unmatched_offers(self, user):
 		admin_currency = entities.Currency.by_id(user['currency_id'])
+		offers = self._get_unmatched_offers()
+		isos = [offer.country.currency.iso for offer in offers]
+		localized = self._currency.convert_many(
+			[offer.amount * offer.country.gift_aid_multiplier for offer in offers]
+			+ [offer.min_amount * offer.country.gift_aid_multiplier for offer in offers],
+			isos + isos,
+			admin_currency.iso)
 		return [
 			{
 				'id': offer.id,
@@ -1381,28 +1711,67 @@ class Donationswap:
 				'expires_ts': offer.expires_ts.strftime('%Y-%m-%d %H:%M:%S'),
 				'email': offer.email,
 				'name': offer.name,
-				'amount_for_charity_localized': self._currency.convert(
-					offer.amount * offer.country.gift_aid_multiplier,
-					offer.country.currency.iso,
-					admin_currency.iso),
-				'min_amount_for_charity_localized': self._currency.convert(
-					offer.min_amount * offer.country.gift_aid_multiplier,
-					offer.country.currency.iso,
-					admin_currency.iso),
+				'amount_for_charity_localized': localized[i],
+				'min_amount_for_charity_localized': localized[len(offers) + i],
 				'currency_localized': admin_currency.iso,
 				'offer_secret': offer.secret,
 			}
-			for offer in self._get_unmatched_offers()
+			for i, offer in enumerate(offers)
 		]
 
 	@admin_ajax
 	def get_match_scores(self, _, offer_id):
-		with self._database.connect() as db:
-			offer_a = entities.Offer.by_id(offer_id)
-			return {
-				offer_b.id: self._get_match_score(offer_a, offer_b, db)
-				for offer_b in self._get_unmatched_offers()
-			}
+		offer_a = entities.Offer.by_id(offer_id)
+		with self._candidates_lock:
+			scores = self._get_candidate_graph().scores(offer_a)
+		return {
+			offer_id: (score, matchscore.REASONS[reason])
+			for offer_id, (score, reason) in scores.items()
+		}
+
+	@admin_ajax
+	def get_match_score_matrix(self, _, top_k=None):
+		'''Scores all unmatched offers against each other.
+		Returns the full matrix, or the `top_k` best partners
+		of each offer if `top_k` is set.
+		The matrix holds reason codes, to be looked up in `reasons`.'''
+
+		if top_k is not None:
+			with self._candidates_lock:
+				graph = self._get_candidate_graph()
+				ids, _ = graph.candidate_scores()
+				return {
+					'top_candidates': {
+						offer_id: [
+							{'offer_id': other_id, 'score': score, 'reason': reason}
+							for other_id, score, reason in graph.top_candidates(offer_id, int(top_k))
+						]
+						for offer_id in ids
+					},
+				}
+
+		offers = self._get_unmatched_offers()
+		book = self._get_offer_book(offers)
+		scores = book.score_matrix()
+		return {
+			'reasons': matchscore.REASONS,
+			'offer_ids': book.ids,
+			'scores': scores[0],
+			'reason_codes': scores[1],
+		}
+
+	@admin_ajax
+	def get_top_candidates(self, _, offer_id, k=10):
+		'''Returns the `k` best partners of an unmatched offer.'''
+
+		with self._candidates_lock:
+			graph = self._get_candidate_graph()
+			if offer_id not in graph:
+				raise ValueError('Offer %s is not available for matching.' % offer_id)
+			return [
+				{'offer_id': other_id, 'score': score, 'reason': reason}
+				for other_id, score, reason in graph.top_candidates(offer_id, int(k))
+			]
 
 	def _send_mail_about_match(self, my_offer, their_offer, match_secret, db):
 		my_actual_amount, _ = self._get_actual_amounts(entities.Match.by_secret(match_secret), my_offer, their_offer, db)
@@ -1429,11 +1798,8 @@ class Donationswap:
 			to=my_offer.email
 		)
 
-	@admin_ajax
-	def create_match(self, _, offer_a_id, offer_b_id):
-		offer_a = entities.Offer.by_id(offer_a_id)
-		offer_b = entities.Offer.by_id(offer_b_id)
-
+	@staticmethod
+	def _create_match(db, offer_a, offer_b):
 		match_secret = create_secret()
 
 		if offer_a.created_ts < offer_b.created_ts:
@@ -1441,8 +1807,82 @@ class Donationswap:
 		else:
 			old_offer, new_offer = offer_b, offer_a
 
+		match = entities.Match.create(db, match_secret, new_offer.id, old_offer.id)
+		eventlog.match_generated(db, match)
+		return match
+
+	def _send_mails_about_match(self, match, db):
+		self._send_mail_about_match(match.old_offer, match.new_offer, match.secret, db)
+		self._send_mail_about_match(match.new_offer, match.old_offer, match.secret, db)
+
+	@admin_ajax
+	def create_match(self, _, offer_a_id, offer_b_id):
+		offer_a = entities.Offer.by_id(offer_a_id)
+		offer_b = entities.Offer.by_id(offer_b_id)
+
 		with self._database.connect() as db:
-			match = entities.Match.create(db, match_secret, new_offer.id, old_offer.id)
-			eventlog.match_generated(db, match)
-			self._send_mail_about_match(old_offer, new_offer, match_secret, db)
-			self._send_mail_about_match(new_offer, old_offer, match_secret, db)
+			match = self._create_match(db, offer_a, offer_b)
+			self._update_candidates(offer_a.id, offer_b.id)
+			self._send_mails_about_match(match, db)
+
+	@admin_ajax
+	def get_proposed_matches(self, _, time_budget=5):
+		'''Pairs up all unmatched offers such that the sum
+		of their match scores is as high as possible.
+		The graph is only locked while copying and reading it, not
+		while solving, which can take up to `time_budget` seconds.'''
+
+		with self._candidates_lock:
+			ids, rows = self._get_candidate_graph().candidate_scores()
+
+		pairs, stats = matchscore.propose_matches(rows, time_budget=float(time_budget))
+
+		matches = []
+		with self._candidates_lock:
+			for i, j in pairs:
+				edge = self._candidates.get_edge(ids[i], ids[j])
+				if edge is None:
+					continue # declined or gone while we were solving
+				score, reason = edge
+				matches.append({
+					'offer_a_id': ids[i],
+					'offer_b_id': ids[j],
+					'score': score,
+					'reason': matchscore.REASONS[reason],
+				})
+		matches.sort(key=lambda x: -x['score'])
+
+		return {
+			'matches': matches,
+			'stats': stats,
+		}
+
+	@admin_ajax
+	def create_matches(self, _, pairs):
+		'''Creates many matches in one transaction, e.g. the
+		ones from `get_proposed_matches`. `pairs` is a list of
+		[offer_a_id, offer_b_id] lists.'''
+
+		unmatched_ids = {offer.id for offer in self._get_unmatched_offers()}
+		seen = set()
+		for offer_a_id, offer_b_id in pairs:
+			for offer_id in (offer_a_id, offer_b_id):
+				if offer_id not in unmatched_ids:
+					raise ValueError('Offer %s is not available for matching.' % offer_id)
+				if offer_id in seen:
+					raise ValueError('Offer %s is part of more than one match.' % offer_id)
+				seen.add(offer_id)
+
+		with self._database.connect() as db:
+			matches = [
+				self._create_match(db, entities.Offer.by_id(offer_a_id), entities.Offer.by_id(offer_b_id))
+				for offer_a_id, offer_b_id in pairs
+			]
+		self._update_candidates(*seen)
+
+		# only send emails once all matches are safely in the database
+		with self._database.connect() as db:
+			for match in matches:
+				self._send_mails_about_match(match, db)
+
+		return [match.id for match in matches]
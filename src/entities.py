@@ -3,18 +3,192 @@
 # pylint: disable=invalid-name
 # pylint: disable=redefined-builtin
 
+import collections
+import contextlib
+import copy
+import datetime
+import itertools
+import logging
+import threading
+
+# Readers never lock. Writers, one at a time, change private copies
+# of the caches, which are published when the outermost `_writing()`
+# block is left. So a reader sees each cache as it was either before
+# or after a write, never half-way through, and iterating over a cache
+# is safe while somebody else writes.
+_write_lock = threading.RLock()
+_staging = threading.local() # .attributes: (cls, name) -> private copy
+
+_reference_version = 0 # pylint: disable=invalid-name
+
+@contextlib.contextmanager
+def _writing():
+	# pylint: disable=global-statement
+	global _reference_version
+	with _write_lock:
+		if getattr(_staging, 'attributes', None) is not None:
+			yield # nested, the outermost block publishes
+			return
+		_staging.attributes = {}
+		_staging.reference_changed = False
+		try:
+			yield
+			for (cls, name), value in _staging.attributes.items():
+				setattr(cls, name, value)
+			if _staging.reference_changed:
+				_reference_version += 1 # only after the new data can be seen
+		finally:
+			_staging.attributes = None
+
+def _reference_data_changed():
+	# pylint: disable=global-statement
+	global _reference_version
+	if getattr(_staging, 'attributes', None) is not None:
+		_staging.reference_changed = True
+		return
+	with _write_lock:
+		_reference_version += 1
+
+def get_reference_version():
+	'''Changes whenever currencies, charities, countries or
+	charities-in-countries are loaded, created, saved or deleted,
+	so that caches built from them know when to rebuild.'''
+	return _reference_version
+
+def _mask_to_ids(mask):
+	result = []
+	while mask:
+		lowest_bit = mask & -mask
+		result.append(lowest_bit.bit_length() - 1)
+		mask ^= lowest_bit
+	return result
+
 class EntityMixin: # pylint: disable=too-few-public-methods
+	'''Every table has a `row_version` column, which triggers set
+	from one global sequence whenever a row is inserted or updated,
+	and a `row_xid` column with the id of the writing transaction.
+	Deleted rows are copied to the `tombstones` table.
+	This lets `refresh` fetch only what changed since the last
+	`load` or `refresh`, instead of reading whole tables.'''
+
+	_table = None
+	_is_reference_data = False
+	_row_versions = {} # key -> row_version of the cached row
+
+	@classmethod
+	def _staged(cls, name):
+		'''Returns the writer's private copy of the cache `name`,
+		for changing it. Only valid inside `_writing()`.'''
+		key = (cls, name)
+		attributes = _staging.attributes
+		if key not in attributes:
+			attributes[key] = copy.copy(getattr(cls, name))
+		return attributes[key]
+
+	@classmethod
+	def _stage(cls, name, value):
+		'''Replaces the cache `name` once the write is published.'''
+		_staging.attributes[(cls, name)] = value
+
+	@classmethod
+	def _current(cls, name):
+		'''The cache `name` as the writer sees it, for reading only.'''
+		attributes = getattr(_staging, 'attributes', None) or {}
+		return attributes.get((cls, name), getattr(cls, name))
 
 	@classmethod
 	def _load_entity(cls, row):
 		entity = cls(row)
-		cls._load_entity_impl(entity)
+		with _writing():
+			cls._load_entity_impl(entity)
+			# rows written without RETURNING * have no version (yet),
+			# refresh will merge them again once
+			cls._staged('_row_versions')[cls._key(row)] = row.get('row_version', 0)
 		return entity
 
 	@classmethod
 	def _load_entity_impl(cls, entity):
 		raise NotImplementedError()
 
+	@classmethod
+	def _load_rows(cls, rows):
+		cls._stage('_row_versions', {})
+		for row in rows:
+			cls._load_entity(row)
+
+	# Subclasses also implement `_key(cls, row)`, which identifies the
+	# row (or an entity's `vars()`), and `_cached(cls, row)`, which
+	# returns the cached entity for a row or None (IdMixin has both).
+
+	def _forget(self):
+		'''Removes the entity from all caches. Only valid inside `_writing()`.'''
+		raise NotImplementedError()
+
+	def _remove(self):
+		with _writing():
+			self._forget()
+			self._staged('_row_versions').pop(self._key(vars(self)), None)
+
+	def _replace(self, **changes):
+		'''Publishes a copy of the entity with some attributes changed,
+		like an insert, and returns it. The entity itself stays as it
+		was, because readers may be looking at it.'''
+		entity = copy.copy(self)
+		vars(entity).update(changes)
+		with _writing():
+			self._forget()
+			self._load_entity_impl(entity)
+		return entity
+
+	@classmethod
+	def refresh(cls, db, xmin):
+		'''Merges the rows that were inserted, updated or deleted
+		by transactions with an id of at least `xmin`, by this or any
+		other process, unless we have them already.
+		Returns the keys of the changed rows.'''
+
+		with _writing():
+			return cls._refresh(db, xmin)
+
+	@classmethod
+	def _refresh(cls, db, xmin):
+		changes = [
+			(row['row_version'], row, False)
+			for row in db.read('''SELECT * FROM %s WHERE row_xid >= %%(xmin)s;''' % cls._table, xmin=xmin)
+		]
+		changes += [
+			(row['row_version'], row['row_data'], True)
+			for row in db.read('''
+				SELECT row_version, row_data
+				FROM tombstones
+				WHERE table_name = %(table)s AND row_xid >= %(xmin)s;''',
+				table=cls._table,
+				xmin=xmin)
+		]
+		changes.sort(key=lambda i: i[0])
+
+		result = []
+		for _, row, deleted in changes:
+			key = cls._key(row)
+			known = cls._current('_row_versions').get(key, None)
+			if deleted:
+				if known is None or known > row['row_version']:
+					continue # gone already, or created again since
+			elif known is not None and known >= row['row_version']:
+				continue # we have this version, or a newer one
+			entity = cls._cached(row)
+			if entity is not None:
+				entity._forget() # pylint: disable=protected-access
+			if deleted:
+				cls._staged('_row_versions').pop(key, None)
+			else:
+				cls._load_entity(row)
+			result.append(key)
+
+		if result and cls._is_reference_data:
+			_reference_data_changed()
+		return result
+
 	def __repr__(self):
 		return self.__class__.__name__
 
@@ -25,6 +199,14 @@ class IdMixin: # pylint: disable=too-few-public-methods
 
 	_by_id = {}
 
+	@staticmethod
+	def _key(row):
+		return row['id']
+
+	@classmethod
+	def _cached(cls, row):
+		return cls._current('_by_id').get(row['id'], None)
+
 	@classmethod
 	def by_id(cls, id):
 		return cls._by_id.get(id, None)
@@ -45,6 +227,9 @@ class SecretMixin: # pylint: disable=too-few-public-methods
 
 class Currency(EntityMixin, IdMixin):
 
+	_table = 'currencies'
+	_is_reference_data = True
+
 	def __init__(self, row):
 		self.id = row['id']
 		self.iso = row['iso']
@@ -55,16 +240,23 @@ class Currency(EntityMixin, IdMixin):
 
 	@classmethod
 	def _load_entity_impl(cls, entity):
-		cls._by_id[entity.id] = entity
+		cls._staged('_by_id')[entity.id] = entity
+
+	def _forget(self):
+		self._staged('_by_id').pop(self.id, None)
 
 	@classmethod
 	def load(cls, db):
-		cls._by_id = {}
-		for row in db.read('''SELECT * FROM currencies;'''):
-			cls._load_entity(row)
+		with _writing():
+			cls._stage('_by_id', {})
+			cls._load_rows(db.read('''SELECT * FROM currencies;'''))
+			_reference_data_changed()
 
 class CharityCategory(EntityMixin, IdMixin):
 
+	_table = 'charity_categories'
+	_is_reference_data = True
+
 	def __init__(self, row):
 		self.id = row['id']
 		self.name = row['name']
@@ -74,13 +266,17 @@ class CharityCategory(EntityMixin, IdMixin):
 
 	@classmethod
 	def _load_entity_impl(cls, entity):
-		cls._by_id[entity.id] = entity
+		cls._staged('_by_id')[entity.id] = entity
+
+	def _forget(self):
+		self._staged('_by_id').pop(self.id, None)
 
 	@classmethod
 	def load(cls, db):
-		cls._by_id = {}
-		for row in db.read('''SELECT * FROM charity_categories;'''):
-			cls._load_entity(row)
+		with _writing():
+			cls._stage('_by_id', {})
+			cls._load_rows(db.read('''SELECT * FROM charity_categories;'''))
+			_reference_data_changed()
 
 	@classmethod
 	def create(cls, db, name):
@@ -92,7 +288,9 @@ class CharityCategory(EntityMixin, IdMixin):
 		row = db.read_one(query,
 			name=name)
 		db.written = True
-		return cls._load_entity(row)
+		entity = cls._load_entity(row)
+		_reference_data_changed()
+		return entity
 
 	def save(self, db):
 		query = '''
@@ -102,16 +300,21 @@ class CharityCategory(EntityMixin, IdMixin):
 		db.write(query,
 			id=self.id,
 			name=self.name)
+		_reference_data_changed()
 
 	def delete(self, db):
 		query = '''
 			DELETE FROM charity_categories
 			WHERE id=%(id)s'''
 		db.write(query, id=self.id)
-		self._by_id.pop(self.id, None)
+		self._remove()
+		_reference_data_changed()
 
 class Charity(EntityMixin, IdMixin):
 
+	_table = 'charities'
+	_is_reference_data = True
+
 	def __init__(self, row):
 		self.id = row['id']
 		self.name = row['name']
@@ -120,17 +323,24 @@ class Charity(EntityMixin, IdMixin):
 	def __repr__(self):
 		return '{id}:{name}:{category_id}'.format(**self.__dict__)
 
+	_by_name = {}
+
 	@classmethod
 	def _load_entity_impl(cls, entity):
-		cls._by_id[entity.id] = entity
-		cls._by_name[entity.name] = entity
+		cls._staged('_by_id')[entity.id] = entity
+		cls._staged('_by_name')[entity.name] = entity
+
+	def _forget(self):
+		self._staged('_by_id').pop(self.id, None)
+		self._staged('_by_name').pop(self.name, None)
 
 	@classmethod
 	def load(cls, db):
-		cls._by_id = {}
-		cls._by_name = {}
-		for row in db.read('''SELECT * FROM charities;'''):
-			cls._load_entity(row)
+		with _writing():
+			cls._stage('_by_id', {})
+			cls._stage('_by_name', {})
+			cls._load_rows(db.read('''SELECT * FROM charities;'''))
+			_reference_data_changed()
 
 	@classmethod
 	def by_name(cls, name):
@@ -151,7 +361,9 @@ class Charity(EntityMixin, IdMixin):
 			name=name,
 			category_id=category_id)
 		db.written = True
-		return cls._load_entity(row)
+		entity = cls._load_entity(row)
+		_reference_data_changed()
+		return entity
 
 	def save(self, db):
 		query = '''
@@ -162,17 +374,21 @@ class Charity(EntityMixin, IdMixin):
 			id=self.id,
 			name=self.name,
 			category_id=self.category_id)
+		_reference_data_changed()
 
 	def delete(self, db):
 		query = '''
 			DELETE FROM charities
 			WHERE id=%(id)s'''
 		db.write(query, id=self.id)
-		self._by_id.pop(self.id, None)
-		self._by_name.pop(self.name, None)
+		self._remove()
+		_reference_data_changed()
 
 class Country(EntityMixin, IdMixin):
 
+	_table = 'countries'
+	_is_reference_data = True
+
 	def __init__(self, row):
 		self.id = row['id']
 		self.name = row['name']
@@ -186,17 +402,24 @@ class Country(EntityMixin, IdMixin):
 	def __repr__(self):
 		return '{id}:{name}:{iso_name}:{currency_id}'.format(**self.__dict__)
 
+	_by_iso_name = {}
+
 	@classmethod
 	def _load_entity_impl(cls, entity):
-		cls._by_id[entity.id] = entity
-		cls._by_iso_name[entity.iso_name] = entity
+		cls._staged('_by_id')[entity.id] = entity
+		cls._staged('_by_iso_name')[entity.iso_name] = entity
+
+	def _forget(self):
+		self._staged('_by_id').pop(self.id, None)
+		self._staged('_by_iso_name').pop(self.iso_name, None)
 
 	@classmethod
 	def load(cls, db):
-		cls._by_id = {}
-		cls._by_iso_name = {}
-		for row in db.read('''SELECT * FROM countries;'''):
-			cls._load_entity(row)
+		with _writing():
+			cls._stage('_by_id', {})
+			cls._stage('_by_iso_name', {})
+			cls._load_rows(db.read('''SELECT * FROM countries;'''))
+			_reference_data_changed()
 
 	@property
 	def currency(self):
@@ -230,7 +453,9 @@ class Country(EntityMixin, IdMixin):
 			min_donation_currency_id=min_donation_currency_id,
 			gift_aid=gift_aid)
 		db.written = True
-		return cls._load_entity(row)
+		entity = cls._load_entity(row)
+		_reference_data_changed()
+		return entity
 
 	def save(self, db):
 		query = '''
@@ -246,17 +471,21 @@ class Country(EntityMixin, IdMixin):
 			min_donation_amount=self.min_donation_amount,
 			min_donation_currency_id=self.min_donation_currency_id,
 			gift_aid=self.gift_aid)
+		_reference_data_changed()
 
 	def delete(self, db):
 		query = '''
 			DELETE FROM countries
 			WHERE id=%(id)s'''
 		db.write(query, id=self.id)
-		self._by_id.pop(self.id, None)
-		self._by_iso_name.pop(self.iso_name, None)
+		self._remove()
+		_reference_data_changed()
 
 class CharityInCountry(EntityMixin):
 
+	_table = 'charities_in_countries'
+	_is_reference_data = True
+
 	def __init__(self, row):
 		self.charity_id = row['charity_id']
 		self.country_id = row['country_id']
@@ -265,17 +494,56 @@ class CharityInCountry(EntityMixin):
 	def __repr__(self):
 		return '{charity_id}:{country_id}'.format(**self.__dict__)
 
+	_all = []
+	_by_charity_and_country_id = {} # (charity id, country id) -> entity
+	_country_mask_by_charity_id = {}
+	_charity_mask_by_country_id = {}
+
 	@classmethod
 	def _load_entity_impl(cls, entity):
-		cls._all.append(entity)
-		cls._by_charity_and_country_id.setdefault(entity.charity_id, {})[entity.country_id] = entity
+		cls._staged('_all').append(entity)
+		cls._staged('_by_charity_and_country_id')[(entity.charity_id, entity.country_id)] = entity
+		cls._set_bits(entity.charity_id, entity.country_id, True)
+
+	@staticmethod
+	def _key(row):
+		return (row['charity_id'], row['country_id'])
+
+	@classmethod
+	def _cached(cls, row):
+		return cls._current('_by_charity_and_country_id').get(cls._key(row), None)
+
+	def _forget(self):
+		self._staged('_all').remove(self)
+		self._staged('_by_charity_and_country_id').pop((self.charity_id, self.country_id), None)
+		self._set_bits(self.charity_id, self.country_id, False)
+
+	@classmethod
+	def _set_bits(cls, charity_id, country_id, value):
+		# Bit n of a mask stands for the country (or charity) with id n,
+		# so "is it tax-deductible?" is a shift and an "and".
+		country_masks = cls._staged('_country_mask_by_charity_id')
+		charity_masks = cls._staged('_charity_mask_by_country_id')
+		countries = country_masks.get(charity_id, 0)
+		charities = charity_masks.get(country_id, 0)
+		if value:
+			countries |= 1 << country_id
+			charities |= 1 << charity_id
+		else:
+			countries &= ~(1 << country_id)
+			charities &= ~(1 << charity_id)
+		country_masks[charity_id] = countries
+		charity_masks[country_id] = charities
 
 	@classmethod
 	def load(cls, db):
-		cls._all = []
-		cls._by_charity_and_country_id = {}
-		for row in db.read('''SELECT * FROM charities_in_countries;'''):
-			cls._load_entity(row)
+		with _writing():
+			cls._stage('_all', [])
+			cls._stage('_by_charity_and_country_id', {})
+			cls._stage('_country_mask_by_charity_id', {})
+			cls._stage('_charity_mask_by_country_id', {})
+			cls._load_rows(db.read('''SELECT * FROM charities_in_countries;'''))
+			_reference_data_changed()
 
 	@property
 	def charity(self):
@@ -287,13 +555,27 @@ class CharityInCountry(EntityMixin):
 
 	@classmethod
 	def by_charity_and_country_id(cls, charity_id, country_id):
-		return cls._by_charity_and_country_id.get(charity_id, {}).get(country_id, None)
+		return cls._by_charity_and_country_id.get((charity_id, country_id), None)
+
+	@classmethod
+	def country_mask(cls, charity_id):
+		'''Bit mask of the countries in which the charity is tax-deductible.'''
+		return cls._country_mask_by_charity_id.get(charity_id, 0)
+
+	@classmethod
+	def is_tax_deductible(cls, charity_id, country_id):
+		return cls._country_mask_by_charity_id.get(charity_id, 0) >> country_id & 1 == 1
+
+	@classmethod
+	def get_charity_ids(cls, country_id):
+		'''Ids of the charities that are tax-deductible in the country, ascending.'''
+		return _mask_to_ids(cls._charity_mask_by_country_id.get(country_id, 0))
 
 	@classmethod
 	def get_all(cls, callback=None):
 		if callback is None:
 			return cls._all[:]
-		return list(filter(callback, cls._all[:]))
+		return list(filter(callback, cls._all))
 
 	@classmethod
 	def create(cls, db, charity_id, country_id, instructions):
@@ -307,7 +589,9 @@ class CharityInCountry(EntityMixin):
 			country_id=country_id,
 			instructions=instructions)
 		db.written = True
-		return cls._load_entity(row)
+		entity = cls._load_entity(row)
+		_reference_data_changed()
+		return entity
 
 	def save(self, db):
 		query = '''
@@ -318,17 +602,76 @@ class CharityInCountry(EntityMixin):
 			charity_id=self.charity_id,
 			country_id=self.country_id,
 			instructions=self.instructions)
+		_reference_data_changed()
 
 	def delete(self, db):
 		query = '''
 			DELETE FROM charities_in_countries
 			WHERE charity_id=%(charity_id)s AND country_id=%(country_id)s'''
 		db.write(query, charity_id=self.charity_id, country_id=self.country_id)
-		self._all.remove(self)
-		self._by_charity_and_country_id.get(self.charity_id, {}).pop(self.country_id, None)
+		self._remove()
+		_reference_data_changed()
+
+class DeclinedMatch(EntityMixin):
+	'''A pair of offers that must not be matched again,
+	because one of the donors declined the match.'''
+
+	_table = 'declined_matches'
+
+	def __init__(self, row):
+		self.new_offer_id = row['new_offer_id']
+		self.old_offer_id = row['old_offer_id']
+
+	def __repr__(self):
+		return '{new_offer_id}:{old_offer_id}'.format(**self.__dict__)
+
+	@classmethod
+	def _load_entity_impl(cls, entity):
+		# The rows get deleted together with their offers, but offer ids
+		# are never reused, so stale pairs in here don't hurt.
+		pairs = cls._staged('_pairs')
+		pairs.add((entity.new_offer_id, entity.old_offer_id))
+		pairs.add((entity.old_offer_id, entity.new_offer_id))
+
+	@staticmethod
+	def _key(row):
+		return (row['new_offer_id'], row['old_offer_id'])
+
+	@classmethod
+	def _cached(cls, row):
+		return None # rows are never changed, only inserted
+
+	_pairs = set()
+
+	@classmethod
+	def load(cls, db):
+		with _writing():
+			cls._stage('_pairs', set())
+			cls._load_rows(db.read('''SELECT * FROM declined_matches;'''))
+
+	@classmethod
+	def is_declined(cls, offer_a_id, offer_b_id):
+		return (offer_a_id, offer_b_id) in cls._pairs
+
+	@classmethod
+	def create(cls, db, new_offer_id, old_offer_id):
+		query = '''
+			INSERT INTO declined_matches (new_offer_id, old_offer_id)
+			VALUES (%(new_offer_id)s, %(old_offer_id)s)
+			ON CONFLICT DO NOTHING;
+		'''
+		db.write(query,
+			new_offer_id=new_offer_id,
+			old_offer_id=old_offer_id)
+		return cls._load_entity({
+			'new_offer_id': new_offer_id,
+			'old_offer_id': old_offer_id,
+		})
 
 class Offer(EntityMixin, IdMixin, SecretMixin): # pylint: disable=too-many-instance-attributes
 
+	_table = 'offers'
+
 	def __init__(self, row):
 		self.id = row['id']
 		self.secret = row['secret']
@@ -345,17 +688,40 @@ class Offer(EntityMixin, IdMixin, SecretMixin): # pylint: disable=too-many-insta
 	def __repr__(self):
 		return '{id}:{name}:{email}:{amount}'.format(**self.__dict__)
 
+	_unmatched = {} # id -> offer; confirmed and not part of a match, may be expired
+
 	@classmethod
 	def _load_entity_impl(cls, entity):
-		cls._by_id[entity.id] = entity
-		cls._by_secret[entity.secret] = entity
+		cls._staged('_by_id')[entity.id] = entity
+		cls._staged('_by_secret')[entity.secret] = entity
+		cls._update_unmatched(entity.id)
+
+	def _forget(self):
+		self._staged('_by_id').pop(self.id, None)
+		self._staged('_by_secret').pop(self.secret, None)
+		self._update_unmatched(self.id)
+
+	@classmethod
+	def _update_unmatched(cls, offer_id):
+		offer = cls._current('_by_id').get(offer_id, None)
+		if offer is not None and offer.confirmed and offer_id not in Match._current('_by_offer_id'): # pylint: disable=protected-access
+			cls._staged('_unmatched')[offer_id] = offer
+		elif offer_id in cls._current('_unmatched'):
+			del cls._staged('_unmatched')[offer_id]
+
+	@classmethod
+	def _rebuild_unmatched(cls):
+		cls._stage('_unmatched', {})
+		for offer_id in cls._current('_by_id'):
+			cls._update_unmatched(offer_id)
 
 	@classmethod
 	def load(cls, db):
-		cls._by_id = {}
-		cls._by_secret = {}
-		for row in db.read('''SELECT * FROM offers ORDER BY created_ts;'''):
-			cls._load_entity(row)
+		with _writing():
+			cls._stage('_by_id', {})
+			cls._stage('_by_secret', {})
+			cls._stage('_unmatched', {})
+			cls._load_rows(db.read('''SELECT * FROM offers ORDER BY created_ts;'''))
 
 	@property
 	def charity(self):
@@ -366,37 +732,20 @@ class Offer(EntityMixin, IdMixin, SecretMixin): # pylint: disable=too-many-insta
 		return Country.by_id(self.country_id)
 
 	@classmethod
-	def get_unmatched_offers(cls, db):
-		query = '''
-			SELECT offer.id AS id
-			FROM offers offer
-			JOIN countries country ON offer.country_id = country.id
-			JOIN charities charity ON offer.charity_id = charity.id
-			WHERE
-				offer.confirmed
-				AND offer.expires_ts > now()
-				AND offer.id NOT IN (SELECT old_offer_id FROM matches)
-				AND offer.id NOT IN (SELECT new_offer_id FROM matches)
-			ORDER BY country ASC, charity ASC, expires_ts ASC;
-		'''
-		return [
-			cls.by_id(i['id'])
-			for i in db.read(query)
-		]
+	def get_unmatched_offers(cls):
+		'''Returns all offers that are confirmed and not expired
+		and not part of a match, from memory.'''
+		now = datetime.datetime.utcnow()
+		return sorted(
+			(i for i in cls._unmatched.values() if i.expires_ts > now),
+			key=lambda i: (i.country_id, i.charity_id, i.expires_ts)
+		)
 
 	@classmethod
-	def get_expired_offers(cls, db):
-		query = '''
-			SELECT offer.id AS id
-			FROM offers offer
-			WHERE offer.expires_ts < now()
-			AND offer.id NOT IN (SELECT old_offer_id FROM matches)
-			AND offer.id NOT IN (SELECT new_offer_id FROM matches);
-		'''
-		return [
-			cls.by_id(i['id'])
-			for i in db.read(query)
-		]
+	def is_unmatched(cls, offer_id):
+		'''Whether the offer would be in `get_unmatched_offers`.'''
+		offer = cls._unmatched.get(offer_id, None)
+		return offer is not None and offer.expires_ts > datetime.datetime.utcnow()
 
 	@classmethod
 	def create(cls, db, secret, name, email, country_id, amount, min_amount, charity_id, expires_ts):
@@ -426,7 +775,7 @@ class Offer(EntityMixin, IdMixin, SecretMixin): # pylint: disable=too-many-insta
 			WHERE id = %(id)s;
 		'''
 		db.write(query, id=self.id)
-		self.confirmed = True
+		return self._replace(confirmed=True)
 
 	def suspend(self, db):
 		#xxx introducing a new "suspended" column would be more honest
@@ -434,10 +783,11 @@ class Offer(EntityMixin, IdMixin, SecretMixin): # pylint: disable=too-many-insta
 		query = '''
 			UPDATE offers
 			SET confirmed = false, created_ts = now()
-			WHERE id = %(id)s;
+			WHERE id = %(id)s
+			RETURNING created_ts;
 		'''
-		db.write(query, id=self.id)
-		self.confirmed = False
+		created_ts = db.write_read_one(query, id=self.id)['created_ts']
+		return self._replace(created_ts=created_ts, confirmed=False)
 
 	def delete(self, db):
 		query = '''
@@ -445,11 +795,12 @@ class Offer(EntityMixin, IdMixin, SecretMixin): # pylint: disable=too-many-insta
 			WHERE id = %(id)s;
 		'''
 		db.write(query, id=self.id)
-		self._by_id.pop(self.id, None)
-		self._by_secret.pop(self.secret, None)
+		self._remove()
 
 class Match(EntityMixin, IdMixin, SecretMixin):
 
+	_table = 'matches'
+
 	def __init__(self, row):
 		self.id = row['id']
 		self.secret = row['secret']
@@ -465,17 +816,36 @@ class Match(EntityMixin, IdMixin, SecretMixin):
 	def __repr__(self):
 		return '{id}:{new_offer_id}:{old_offer_id}'.format(**self.__dict__)
 
+	_by_offer_id = {}
+
 	@classmethod
 	def _load_entity_impl(cls, entity):
-		cls._by_id[entity.id] = entity
-		cls._by_secret[entity.secret] = entity
+		cls._staged('_by_id')[entity.id] = entity
+		cls._staged('_by_secret')[entity.secret] = entity
+		for offer_id in (entity.new_offer_id, entity.old_offer_id):
+			cls._staged('_by_offer_id')[offer_id] = entity
+			Offer._update_unmatched(offer_id) # pylint: disable=protected-access
+
+	def _forget(self):
+		self._staged('_by_id').pop(self.id, None)
+		self._staged('_by_secret').pop(self.secret, None)
+		for offer_id in (self.new_offer_id, self.old_offer_id):
+			if self._current('_by_offer_id').get(offer_id, None) is self:
+				del self._staged('_by_offer_id')[offer_id]
+				Offer._update_unmatched(offer_id) # pylint: disable=protected-access
 
 	@classmethod
 	def load(cls, db):
-		cls._by_id = {}
-		cls._by_secret = {}
-		for row in db.read('''SELECT * FROM matches;'''):
-			cls._load_entity(row)
+		with _writing():
+			cls._stage('_by_id', {})
+			cls._stage('_by_secret', {})
+			cls._stage('_by_offer_id', {})
+			cls._load_rows(db.read('''SELECT * FROM matches;'''))
+			Offer._rebuild_unmatched() # pylint: disable=protected-access
+
+	@classmethod
+	def has_offer(cls, offer_id):
+		return offer_id in cls._by_offer_id
 
 	@property
 	def new_offer(self):
@@ -512,19 +882,6 @@ class Match(EntityMixin, IdMixin, SecretMixin):
 			for i in db.read(query)
 		]
 
-	@classmethod
-	def get_feedback_ready_matches(cls, db):
-		query = '''
-		SELECT * FROM matches
-		WHERE
-			new_agrees = True AND
-			old_agrees = True AND
-			feedback_requested = False'''
-		return [
-			cls.by_id(i['id'])
-			for i in db.read(query)
-		]
-
 	def agree_old(self, db):
 		query = '''
 		UPDATE matches
@@ -532,7 +889,7 @@ class Match(EntityMixin, IdMixin, SecretMixin):
 		WHERE id = %(id)s;
 		'''
 		db.write(query, id=self.id)
-		self.old_agrees = True
+		return self._replace(old_agrees=True)
 
 	def agree_new(self, db):
 		query = '''
@@ -541,7 +898,7 @@ class Match(EntityMixin, IdMixin, SecretMixin):
 		WHERE id = %(id)s;
 		'''
 		db.write(query, id=self.id)
-		self.new_agrees = True
+		return self._replace(new_agrees=True)
 
 	def delete(self, db):
 		query = '''
@@ -549,8 +906,7 @@ class Match(EntityMixin, IdMixin, SecretMixin):
 			WHERE id = %(id)s;
 		'''
 		db.write(query, id=self.id)
-		self._by_id.pop(self.id, None)
-		self._by_secret.pop(self.secret, None)
+		self._remove()
 
 	def set_feedback_requested(self, db):
 		query = '''
@@ -559,7 +915,7 @@ class Match(EntityMixin, IdMixin, SecretMixin):
 			WHERE id = %(id)s;
 		'''
 		db.write(query, id=self.id)
-		self.feedback_requested = True
+		return self._replace(feedback_requested=True)
 
 	def set_new_amount_suggested_requested(self, db, value):
 		query = '''
@@ -568,7 +924,7 @@ class Match(EntityMixin, IdMixin, SecretMixin):
 			WHERE id = %(id)s;
 		'''
 		db.write(query, id=self.id, val=value)
-		self.new_amount_suggested = value
+		return self._replace(new_amount_suggested=value)
 
 	def set_old_amount_suggested_requested(self, db, value):
 		query = '''
@@ -577,13 +933,109 @@ class Match(EntityMixin, IdMixin, SecretMixin):
 			WHERE id = %(id)s;
 		'''
 		db.write(query, id=self.id, val=value)
-		self.old_amount_suggested = value
+		return self._replace(old_amount_suggested=value)
+
+_ENTITY_CLASSES = (Currency, CharityCategory, Charity, Country, CharityInCountry, Offer, Match, DeclinedMatch)
+
+# Triggers send the name of a table to this channel whenever it
+# changed, see sql/upgrades/2026-10-18_notify_changes.sql.
+CHANGES_CHANNEL = 'entity_changes'
+
+# Tombstones are kept this long, so a process that has not refreshed
+# for (almost) that long must load everything again.
+TOMBSTONE_MAX_AGE = datetime.timedelta(days=7)
+
+_last_xmin = None # pylint: disable=invalid-name
+_last_refresh = None # pylint: disable=invalid-name
+
+# The rows that `refresh` merged, most recent last, so that things built
+# from the caches can follow them row by row (see `get_changes_since`).
+MAX_CHANGES = 10000
+_changes = collections.deque(maxlen=MAX_CHANGES) # (serial, entity class, key)
+_changes_lock = threading.Lock()
+_change_serial = 0 # pylint: disable=invalid-name
+_load_serial = 0 # pylint: disable=invalid-name # `_change_serial` of the last `load`
+
+def _record_changes(changes, loaded=False):
+	# pylint: disable=global-statement
+	global _change_serial, _load_serial
+	with _changes_lock:
+		if loaded:
+			_changes.clear()
+			_change_serial += 1
+			_load_serial = _change_serial
+		for cls, key in changes:
+			_change_serial += 1
+			_changes.append((_change_serial, cls, key))
+
+def get_changes_since(serial):
+	'''Returns (serial, changes). `changes` lists (entity class, key) of
+	the rows that `refresh` merged since `serial`, which is what the last
+	call returned, oldest first. It is None if the caller has to look at
+	everything again: on the first call (pass None), after everything
+	was loaded again, or if the caller fell more than MAX_CHANGES behind.'''
+	with _changes_lock:
+		if serial is None or serial < _load_serial:
+			return _change_serial, None
+		oldest = _changes[0][0] if _changes else _change_serial + 1
+		if serial < oldest - 1:
+			return _change_serial, None
+		return _change_serial, [(cls, key) for _, cls, key in itertools.islice(_changes, serial - oldest + 1, None)]
+
+def _read_xmin(db):
+	# The oldest transaction that is still running. Everything older has
+	# committed (or rolled back) and is visible from now on; rows written
+	# by this one or any later transaction may still show up, in any order,
+	# so the next refresh reads them (again).
+	return db.read_one('''SELECT txid_snapshot_xmin(txid_current_snapshot()) AS xmin;''')['xmin']
 
 def load(db):
-	Currency.load(db)
-	CharityCategory.load(db)
-	Charity.load(db)
-	Country.load(db)
-	CharityInCountry.load(db)
-	Offer.load(db)
-	Match.load(db)
+	# pylint: disable=global-statement
+	global _last_xmin, _last_refresh
+	with _write_lock:
+		with _writing():
+			xmin = _read_xmin(db)
+			for cls in _ENTITY_CLASSES:
+				cls.load(db)
+		_last_xmin = xmin
+		_last_refresh = datetime.datetime.utcnow()
+		_record_changes([], loaded=True)
+
+def refresh(db):
+	'''Merges all rows that changed since the last `load` or `refresh`,
+	also those of transactions that committed out of order.
+	Returns the number of changed rows, or None if everything
+	had to be loaded again because tombstones may be missing.'''
+	# pylint: disable=global-statement
+	global _last_xmin, _last_refresh
+	with _write_lock:
+		now = datetime.datetime.utcnow()
+		if _last_refresh is None or now - _last_refresh > TOMBSTONE_MAX_AGE - datetime.timedelta(days=1):
+			load(db)
+			return None
+		xmin = _read_xmin(db)
+		_last_refresh = now
+		with _writing():
+			changes = [
+				(cls, key)
+				for cls in _ENTITY_CLASSES
+				for key in cls.refresh(db, _last_xmin)
+			]
+		_last_xmin = xmin
+		if changes:
+			logging.info('Refreshed %s changed rows.', len(changes))
+			_record_changes(changes) # only now that they can be seen
+		return len(changes)
+
+def delete_old_tombstones(db):
+	'''Tombstones are only needed until every process has
+	refreshed past them. Returns the number of deleted rows.'''
+	query = '''
+		WITH deleted AS (
+			DELETE FROM tombstones
+			WHERE deleted_ts < now() - %(max_age)s
+			RETURNING 1
+		)
+		SELECT count(*) AS count FROM deleted;
+	'''
+	return db.write_read_one(query, max_age=TOMBSTONE_MAX_AGE)['count']
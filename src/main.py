@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
+import gzip
 import json
 import logging
 import os
@@ -9,6 +11,8 @@ import sys
 
 import tornado.httpserver # `sudo pip3 install tornado`
 import tornado.ioloop
+import tornado.netutil
+import tornado.process
 import tornado.web
 
 import donationswap
@@ -24,9 +28,39 @@ tornado.web.RequestHandler.set_default_headers = _set_default_headers
 
 class BaseHandler(tornado.web.RequestHandler): # pylint: disable=abstract-method
 
+	COMPRESS_MIN_SIZE = 1024 # bytes; compressing smaller responses isn't worth it
+
 	def initialize(self, logic): # pylint: disable=arguments-differ
 		self.logic = logic # pylint: disable=attribute-defined-outside-init
 
+	async def run_in_worker(self, func, *args):
+		'''Runs `func` in a worker thread, so that other
+		requests can be served while it is blocked.'''
+		try:
+			return await tornado.ioloop.IOLoop.current().run_in_executor(self.logic.get_worker_pool(), func, *args)
+		except util.QueueFull:
+			logging.warning('Too many requests waiting for a worker thread.')
+			raise tornado.web.HTTPError(503)
+
+	def get_accepted_encodings(self):
+		return util.get_accepted_encodings(self.request.headers.get('Accept-Encoding', ''))
+
+	def write_json(self, endpoint, result):
+		'''Sends `result` as JSON, gzipped if it is big enough
+		and the client can handle it.'''
+		self.write_json_body(endpoint, json.dumps(result).encode('utf-8'))
+
+	def write_json_body(self, endpoint, body):
+		'''Like `write_json`, for JSON that is already serialized.'''
+		raw_size = len(body)
+		self.set_header('Content-Type', 'application/json; charset=utf-8')
+		self.set_header('Vary', 'Accept-Encoding')
+		if raw_size >= self.COMPRESS_MIN_SIZE and 'gzip' in self.get_accepted_encodings():
+			body = gzip.compress(body, compresslevel=6)
+			self.set_header('Content-Encoding', 'gzip')
+		self.logic.record_response_size(endpoint, raw_size, len(body))
+		self.write(body)
+
 class CertbotHandler(tornado.web.RequestHandler): # pylint: disable=abstract-method
 	'''
 	sudo certbot renew --webroot --webroot-path /srv/web/static/
@@ -62,49 +96,63 @@ class AdminHandler(BaseHandler): # pylint: disable=abstract-method
 			self.set_status(404)
 			self.write('404 File Not Found')
 
-	def post(self, action): # pylint: disable=arguments-differ
+	async def post(self, action): # pylint: disable=arguments-differ
 		payload = json.loads(self.request.body.decode('utf-8'))
 
 		user_secret = self.get_secure_cookie('user', max_age_days=1)
 		if user_secret is not None:
 			user_secret = user_secret.decode('ascii')
 
-		success, result = self.logic.run_admin_ajax(user_secret, action, self.request.remote_ip, payload)
+		success, result = await self.run_in_worker(self.logic.run_admin_ajax, user_secret, action, self.request.remote_ip, payload)
 
-		self.set_header('Content-Type', 'application/json; charset=utf-8')
 		if success:
 			self.set_status(200)
 		else:
 			self.set_status(500)
-		self.write(json.dumps(result))
+		self.write_json('admin/%s' % action, result)
 
 class AjaxHandler(BaseHandler): # pylint: disable=abstract-method
 
-	def post(self, action): # pylint: disable=arguments-differ
+	async def post(self, action): # pylint: disable=arguments-differ
 		payload = json.loads(self.request.body.decode('utf-8'))
 
-		success, result = self.logic.run_ajax(action, self.request.remote_ip, payload)
+		success, result = await self.run_in_worker(self.logic.run_ajax, action, self.request.remote_ip, payload)
 
 		if action == 'login' and success:
 			self.set_secure_cookie('user', result, expires_days=1)
 			result = None
 
-		self.set_header('Content-Type', 'application/json; charset=utf-8')
 		if success:
 			self.set_status(200)
 		else:
 			self.set_status(400)
-		self.write(json.dumps(result))
+		self.write_json('ajax/%s' % action, result)
+
+	async def get(self, action): # pylint: disable=arguments-differ
+		'''Only for `get_info`, which browsers may cache and revalidate,
+		because it changes only when an admin edits something.'''
+		if action != 'get_info':
+			raise tornado.web.HTTPError(405)
+
+		etag, body = await self.run_in_worker(self.logic.get_info_json, self.request.remote_ip)
+
+		# the response depends on the client's IP address
+		self.set_header('Cache-Control', 'private, no-cache')
+		self.set_header('ETag', etag)
+		if self.check_etag_header():
+			self.set_status(304)
+			return
+		self.write_json_body('ajax/get_info', body)
 
 class HousekeepingHandler(BaseHandler): # pylint: disable=abstract-method
 	'''This is so a cronjob can trigger housekeeping like so:
 	`curl --insecure --request POST https://127.4.0.3:8888/housekeeping`
 	'''
 
-	def post(self): # pylint: disable=arguments-differ
+	async def post(self): # pylint: disable=arguments-differ
 		if self.request.remote_ip in ('127.0.0.1', '::1'):
 			try:
-				result = self.logic.clean_up()
+				result = await self.run_in_worker(self.logic.clean_up)
 				self.set_status(200)
 				self.write(result)
 			except Exception as e: # pylint: disable=broad-except
@@ -116,36 +164,171 @@ class HousekeepingHandler(BaseHandler): # pylint: disable=abstract-method
 			self.set_status(404)
 
 class TemplateHandler(BaseHandler): # pylint: disable=abstract-method
+	'''Serves pre-rendered pages. Browsers have to ask again every
+	time, but get a "304 Not Modified" while the page is unchanged.'''
 
 	def initialize(self, logic, page_name): # pylint: disable=arguments-differ
 		# pylint: disable=attribute-defined-outside-init
 		self.logic = logic
 		self._page_name = page_name
+		self._page = None
+
+	def compute_etag(self):
+		return self._page.etag if self._page is not None else None
 
 	def get(self): # pylint: disable=arguments-differ
-		page = self.logic.get_page(self._page_name)
-		if page:
-			self.set_header('Content-Type', 'text/html; charset=utf-8')
-			self.write(page)
-		else:
+		self._page = self.logic.get_cached_page(self._page_name)
+		if self._page is None:
 			self.set_status(404)
 			self.write('404 File Not Found')
+			return
+
+		self.set_header('Cache-Control', 'no-cache')
+		self.set_etag_header()
+		if self.check_etag_header():
+			self.set_status(304)
+			return
+
+		self.set_header('Content-Type', 'text/html; charset=utf-8')
+		self.write(self._page.body)
 
-def start(port=443, daemonize=True, http_redirect_port=None):
+class StaticHandler(BaseHandler): # pylint: disable=abstract-method
+	'''Serves files from static/ out of memory.
+	A URL with the current "?v=<hash>" of a file always returns
+	the same content, so browsers may keep it for a year.
+	Text files are sent compressed if the client accepts that.'''
+
+	MAX_AGE = 365*24*60*60 # seconds
+
+	def initialize(self, logic): # pylint: disable=arguments-differ
+		# pylint: disable=attribute-defined-outside-init
+		self.logic = logic
+		self._asset = None
+		self._etag = None
+
+	def compute_etag(self):
+		return self._etag
+
+	def get(self, path): # pylint: disable=arguments-differ
+		self._asset = self.logic.get_asset(path)
+		if self._asset is None:
+			self.set_status(404)
+			self.write('404 File Not Found')
+			return
+
+		if self.get_query_argument('v', None) == self._asset.hash:
+			self.set_header('Cache-Control', 'public, max-age=%s, immutable' % self.MAX_AGE)
+		else:
+			self.set_header('Cache-Control', 'no-cache')
+		self.set_header('Vary', 'Accept-Encoding')
+
+		encoding, body, self._etag = self._asset.get_variant(self.get_accepted_encodings())
+		self.set_etag_header()
+		if self.check_etag_header():
+			self.set_status(304)
+			return
+
+		self.set_header('Content-Type', self._asset.content_type)
+		if encoding is not None:
+			self.set_header('Content-Encoding', encoding)
+		self.logic.record_response_size('static', len(self._asset.body), len(body))
+		self.write(body)
+
+class ChangeListener:
+	'''
+	Keeps this process's entity caches in sync with the other
+	server processes: the database tells us (via LISTEN/NOTIFY)
+	whenever a cached table changed, and we merge the changed rows.
+
+	Notifications that come in while a refresh is running are
+	coalesced into one more refresh. If the listening connection
+	breaks, we connect again after RECONNECT_DELAY seconds and
+	refresh once, because we may have missed something.
+	'''
+
+	RECONNECT_DELAY = 5 # seconds
+
+	def __init__(self, logic):
+		self._logic = logic
+		self._listener = None
+		self._executor = concurrent.futures.ThreadPoolExecutor(1)
+		self._refreshing = False
+		self._pending = False
+
+	def start(self):
+		try:
+			self._listener = self._logic.listen_for_changes()
+		except Exception: # pylint: disable=broad-except
+			logging.error('Failed to listen for entity changes.', exc_info=True)
+			tornado.ioloop.IOLoop.current().call_later(self.RECONNECT_DELAY, self.start)
+			return
+		tornado.ioloop.IOLoop.current().add_handler(self._listener.fileno(), self._on_readable, tornado.ioloop.IOLoop.READ)
+		self._request_refresh() # in case we missed something while not listening
+
+	def _stop(self):
+		tornado.ioloop.IOLoop.current().remove_handler(self._listener.fileno())
+		self._listener.close()
+		self._listener = None
+
+	def _on_readable(self, fd, events): # pylint: disable=unused-argument
+		try:
+			payloads = self._listener.get_payloads()
+		except Exception: # pylint: disable=broad-except
+			logging.error('Lost the connection that listens for entity changes.', exc_info=True)
+			self._stop()
+			tornado.ioloop.IOLoop.current().call_later(self.RECONNECT_DELAY, self.start)
+			return
+		if payloads:
+			self._request_refresh()
+
+	def _request_refresh(self):
+		if self._refreshing:
+			self._pending = True
+			return
+		self._refreshing = True
+		self._pending = False
+		future = self._executor.submit(self._logic.refresh_entities)
+		tornado.ioloop.IOLoop.current().add_future(future, self._on_refreshed)
+
+	def _on_refreshed(self, future):
+		self._refreshing = False
+		if future.exception() is not None:
+			logging.error('Failed to refresh entities.', exc_info=future.exception())
+		if self._pending:
+			self._request_refresh()
+
+def start(port=443, daemonize=True, http_redirect_port=None, processes=1):
 	if port < 1024 and not os.getuid() == 0:
 		print('Port %s requires root permissions.' % port, file=sys.stderr)
 		sys.exit(1)
 
 	util.setup_logging('log/web.txt')
 
+	# Bind before forking, so that all processes share the sockets
+	# and the kernel spreads connections between them.
+	sockets = tornado.netutil.bind_sockets(port)
+	if http_redirect_port is not None:
+		redirect_sockets = tornado.netutil.bind_sockets(http_redirect_port)
+
+	if daemonize:
+		util.daemonize('/var/run/webserver-%s.pid' % port)
+
+	if processes != 1:
+		# Everything below runs once per process. Database connections
+		# must not be shared between processes, so the logic (which
+		# opens them) is created after forking.
+		tornado.process.fork_processes(processes)
+
 	if http_redirect_port is not None:
 		logging.info('Redirecting http://:%s to https://:%s', http_redirect_port, port)
-		tornado.web.Application([
+		redirect_server = tornado.httpserver.HTTPServer(tornado.web.Application([
 			(r'/.well-known/acme-challenge/(.+)', CertbotHandler),
 			(r'/.*', HttpRedirectHandler, {'https_port': port})
-		]).listen(http_redirect_port)
+		]))
+		redirect_server.add_sockets(redirect_sockets)
 
 	logic = donationswap.Donationswap('app-config.json')
+	logic.get_cached_page('discontinued.html') # render it before the first request comes in
 
 	def args(kv=None):
 		result = {
@@ -164,12 +347,13 @@ def start(port=443, daemonize=True, http_redirect_port=None):
 			(r'/charities/?', TemplateHandler, args({'page_name': 'discontinued.html'})),
 			(r'/match/?', TemplateHandler, args({'page_name': 'discontinued.html'})),
 			(r'/offer/?', TemplateHandler, args({'page_name': 'discontinued.html'})),
+			(r'/static/(.+)', StaticHandler, args()),
+			(r'/(robots\.txt|favicon\.ico)', StaticHandler, args()),
 			#(r'/ajax/(.+)', AjaxHandler, args()),
 			#(r'/special-secret-admin/(.+)', AdminHandler, args()),
 			#(r'/housekeeping/?', HousekeepingHandler, args()),
 		],
 		cookie_secret=logic.get_cookie_key(),
-		static_path=os.path.join(os.path.dirname(__file__), 'static'),
 	)
 
 	if os.path.exists('/etc/letsencrypt/live/donationswap.eahub.org/privkey.pem'):
@@ -186,14 +370,33 @@ def start(port=443, daemonize=True, http_redirect_port=None):
 
 	server = tornado.httpserver.HTTPServer(application, ssl_options=ssl_context)
 
-	server.listen(port)
-
-	if daemonize:
-		util.daemonize('/var/run/webserver-%s.pid' % port)
+	server.add_sockets(sockets)
 
 	if os.geteuid() == 0: # we don't need root privileges any more
 		util.drop_privileges()
 
+	# Other processes change offers, matches and reference data too;
+	# pick up their changes right away. A single process has its own
+	# writes already; console.py's are picked up by the refreshes in
+	# `run_deadlines` and friends, as before.
+	if processes != 1:
+		ChangeListener(logic).start()
+
+	# Deletes expired offers etc. within a minute of them becoming due,
+	# instead of waiting for the hourly cronjob. Off unless the config
+	# says `run_deadlines`, because the site is discontinued. One process
+	# is enough; it sees the offers and matches of the others through
+	# the ChangeListener.
+	if logic.should_run_deadlines() and tornado.process.task_id() in (None, 0):
+		tornado.ioloop.PeriodicCallback(lambda: logic.get_worker_pool().submit(logic.run_deadlines), 60*1000).start()
+
+	# Downloads new exchange rates in the background before anybody
+	# needs them, so no request ever waits for fixer.io. Off unless the
+	# config says `refresh_exchange_rates`. Every process keeps its own
+	# rates, so every process needs this.
+	if logic.should_refresh_exchange_rates():
+		tornado.ioloop.PeriodicCallback(logic.refresh_exchange_rates, 5*60*1000).start()
+
 	tornado.ioloop.IOLoop.current().start()
 
 def main():
@@ -201,12 +404,14 @@ def main():
 	parser.add_argument('--port', '-p', type=int, default=443)
 	parser.add_argument('--daemonize', '-d', action='store_true')
 	parser.add_argument('--no-http-redirect', action='store_true')
+	parser.add_argument('--processes', type=int, default=1, help='number of server processes; 0 means one per CPU core')
 	args = parser.parse_args()
 
 	start(
 		port=args.port,
 		daemonize=args.daemonize,
-		http_redirect_port=None if args.no_http_redirect else 80
+		http_redirect_port=None if args.no_http_redirect else 80,
+		processes=args.processes,
 	)
 
 if __name__ == '__main__':
@@ -0,0 +1,793 @@
+#!/usr/bin/env python3
+
+'''
+Batch scoring of donation offers against each other.
+
+All per-offer work (currency conversion, gift aid, tax-deductibility
+lookups) is done once per offer, so that scoring a pair of offers
+is nothing but a few comparisons and bit operations.
+
+The rules are the ones that used to live in
+`Donationswap._get_match_score`; a score of 0 means the pair
+cannot be matched, and the reason code says why.
+'''
+
+import bisect
+import time
+
+import entities
+
+BASE_CURRENCY = 'NZD'
+
+# reason codes, in the order in which the rules are checked
+SAME_OFFER = 0
+SAME_CHARITY = 1
+SAME_COUNTRY = 2
+SAME_EMAIL = 3
+AMOUNT_MISMATCH = 4
+BENEFIT_ANYWAY = 5
+NOBODY_BENEFITS = 6
+DECLINED = 7
+BOTH_BENEFIT = 8
+ONE_BENEFITS = 9
+
+REASONS = [
+	'same offer',
+	'same charity',
+	'same country',
+	'same email address',
+	'amount mismatch',
+	'both would benefit from donating to their chosen charity anyway',
+	'nobody will benefit',
+	'match declined',
+	'both benefit',
+	'only one will benefit',
+]
+
+class _Features: # pylint: disable=too-few-public-methods
+	'''Everything about an offer that scoring needs.'''
+
+	__slots__ = ['id', 'charity_id', 'country_id', 'email', 'amount', 'min_amount', 'country_bit', 'deductible_in']
+
+	def __init__(self, offer, amount, min_amount):
+		# amount and min_amount are in BASE_CURRENCY, without gift aid
+		multiplier = offer.country.gift_aid_multiplier
+		self.id = offer.id
+		self.charity_id = offer.charity_id
+		self.country_id = offer.country_id
+		self.email = offer.email.lower()
+		self.amount = amount * multiplier
+		self.min_amount = min_amount * multiplier
+		self.country_bit = 1 << offer.country_id
+		self.deductible_in = entities.CharityInCountry.country_mask(offer.charity_id)
+
+def _get_features(offers, currency):
+	'''Returns the _Features of each offer.
+	All amounts are converted in one batch.'''
+	count = len(offers)
+	isos = [offer.country.currency.iso for offer in offers]
+	amounts = currency.convert_many(
+		[offer.amount for offer in offers] + [offer.min_amount for offer in offers],
+		isos + isos,
+		BASE_CURRENCY)
+	return [_Features(offer, amounts[i], amounts[count + i]) for i, offer in enumerate(offers)]
+
+def _score(a, b):
+	'''Returns (score, reason code) for two offers' features.'''
+	# pylint: disable=too-many-return-statements
+
+	if a.id == b.id:
+		return 0, SAME_OFFER
+
+	if a.charity_id == b.charity_id:
+		return 0, SAME_CHARITY
+
+	if a.country_id == b.country_id:
+		return 0, SAME_COUNTRY
+
+	if a.email == b.email:
+		return 0, SAME_EMAIL
+
+	if a.amount < b.min_amount or b.amount < a.min_amount:
+		return 0, AMOUNT_MISMATCH
+	if a.amount <= 0 and b.amount <= 0:
+		return 0, AMOUNT_MISMATCH
+
+	#xxx only count as "benefit" if own charity isn't tax-deductible, but other donor's one is
+	#    (otherwise we would reward pointless swaps, where both donors already get their tax back)
+	if a.deductible_in & a.country_bit and b.deductible_in & b.country_bit:
+		return 0, BENEFIT_ANYWAY
+
+	a_will_benefit = b.deductible_in & a.country_bit
+	b_will_benefit = a.deductible_in & b.country_bit
+
+	if not a_will_benefit and not b_will_benefit:
+		return 0, NOBODY_BENEFITS
+
+	if entities.DeclinedMatch.is_declined(a.id, b.id):
+		return 0, DECLINED
+
+	# amounts are equal => score = 1
+	# amounts are vastly different => score = almost 0
+	score = 1 - (a.amount - b.amount)**2 / max(a.amount, b.amount)**2
+
+	if a_will_benefit and b_will_benefit:
+		factor, reason = 1, BOTH_BENEFIT
+	else:
+		factor, reason = 0.5, ONE_BENEFITS
+
+	return round(score * factor, 4), reason
+
+class OfferBook:
+	'''A set of offers, prepared for scoring.'''
+
+	def __init__(self, offers, currency):
+		self.offers = list(offers)
+		self._features = _get_features(self.offers, currency)
+		self.ids = [i.id for i in self._features]
+		self._amounts = [i.amount for i in self._features] # in BASE_CURRENCY, including gift aid
+		self._min_amounts = [i.min_amount for i in self._features]
+
+		self._index_by_id = {offer_id: i for i, offer_id in enumerate(self.ids)}
+
+		# Most pairs fail on the amounts, so we keep the offers sorted
+		# by amount and by minimum amount, see `amount_candidates`.
+		self._amount_order = sorted(range(len(self.ids)), key=lambda i: self._amounts[i])
+		self._sorted_amounts = [self._amounts[i] for i in self._amount_order]
+		self._min_amount_order = sorted(range(len(self.ids)), key=lambda i: self._min_amounts[i])
+		self._sorted_min_amounts = [self._min_amounts[i] for i in self._min_amount_order]
+
+	def __len__(self):
+		return len(self.offers)
+
+	def index_of(self, offer_id):
+		return self._index_by_id.get(offer_id, None)
+
+	def score(self, i, j):
+		'''Returns (score, reason code) for the offers at index i and j.'''
+		return _score(self._features[i], self._features[j])
+
+	def score_matrix(self):
+		'''Scores all pairs in one pass.
+		Returns two n*n lists of lists: scores and reason codes.
+		The rules are symmetric, so only one half is computed.'''
+
+		n = len(self.offers)
+		scores = [[0] * n for _ in range(n)]
+		reasons = [[SAME_OFFER] * n for _ in range(n)]
+		for i in range(n):
+			row_scores, row_reasons = scores[i], reasons[i]
+			for j in range(i + 1, n):
+				score, reason = self.score(i, j)
+				row_scores[j] = scores[j][i] = score
+				row_reasons[j] = reasons[j][i] = reason
+		return scores, reasons
+
+	def amount_candidates(self, i):
+		'''Returns the indices of the offers whose amounts fit the offer
+		at index i: their amount is at least its minimum amount, and
+		their minimum amount is at most its amount.
+		This is symmetric: j is a candidate of i iff i is one of j.
+
+		In other words, the ranges [min amount, amount] of the two offers
+		overlap. Both conditions are looked up by bisection, which tells
+		how many offers meet each of them; only the shorter of the two
+		slices is looked at, and checked for the other condition.'''
+
+		amount, min_amount = self._amounts[i], self._min_amounts[i]
+		big_enough = bisect.bisect_left(self._sorted_amounts, min_amount) # from here to the end
+		small_enough = bisect.bisect_right(self._sorted_min_amounts, amount) # from the start to here
+		if len(self._sorted_amounts) - big_enough <= small_enough:
+			min_amounts = self._min_amounts
+			return [
+				j
+				for j in self._amount_order[big_enough:]
+				if min_amounts[j] <= amount and j != i
+			]
+		amounts = self._amounts
+		return [
+			j
+			for j in self._min_amount_order[:small_enough]
+			if amounts[j] >= min_amount and j != i
+		]
+
+	def candidate_scores(self):
+		'''Like `score_matrix`, but only scores pairs whose amounts fit.
+		Returns a list with a dict {j: score} per offer, holding only
+		the pairs with a positive score.'''
+
+		result = [{} for _ in self.ids]
+		for i in range(len(self.ids)):
+			row = result[i]
+			for j in self.amount_candidates(i):
+				if j > i:
+					score, _ = self.score(i, j)
+					if score > 0:
+						row[j] = result[j][i] = score
+		return result
+
+	def top_candidates(self, k, scores=None):
+		'''Returns a dict {offer_id: [(offer_id, score, reason), ...]}
+		with the k best-scoring partners of each offer.
+		Pairs with a score of 0 are left out.'''
+
+		if scores is None:
+			scores = self.candidate_scores()
+
+		result = {}
+		for i, offer_id in enumerate(self.ids):
+			best = sorted(scores[i], key=lambda j, row=scores[i]: (-row[j], j))[:k]
+			result[offer_id] = [
+				(self.ids[j], score, REASONS[reason])
+				for score, reason, j in (self.score(i, j) + (j,) for j in best)
+			]
+		return result
+
+class CandidateGraph:
+	'''The scored, compatible pairs of all unmatched offers,
+	kept in memory between requests.
+
+	Offers are added and removed one at a time as they get confirmed,
+	matched, declined, deleted or expire. Adding an offer only scores
+	it against the offers whose amounts fit.
+	The caller rebuilds the whole graph when the exchange rates or
+	the charities and countries change (see `version`).'''
+
+	def __init__(self):
+		self.version = None
+		self._currency = None
+		self._features = {} # offer id -> _Features
+		self._edges = {} # offer id -> {offer id: (score, reason code)}
+		self._ranked = {} # offer id -> offer ids by descending score, None if outdated
+		self._sorted_amounts = [] # (amount, offer id), ascending
+		self._sorted_min_amounts = [] # (min amount, offer id), ascending
+
+	def __contains__(self, offer_id):
+		return offer_id in self._features
+
+	def rebuild(self, offers, currency, version):
+		self.version = version
+		self._currency = currency
+		self._features = {}
+		self._edges = {}
+		self._ranked = {}
+		self._sorted_amounts = []
+		self._sorted_min_amounts = []
+		offers = list(offers)
+		for features in _get_features(offers, currency):
+			self._add(features)
+
+	def sync(self, offers):
+		'''Adds and removes offers so that exactly `offers` are in the graph.'''
+		offers = {offer.id: offer for offer in offers}
+		for offer_id in [i for i in self._features if i not in offers]:
+			self.remove(offer_id)
+		new_offers = [offer for offer_id, offer in offers.items() if offer_id not in self._features]
+		if new_offers and self.version is not None:
+			for features in _get_features(new_offers, self._currency):
+				self._add(features)
+
+	def add(self, offer):
+		if self.version is None:
+			return # not built yet
+		self._add(_get_features([offer], self._currency)[0])
+
+	def _add(self, features):
+		if features.id in self._features:
+			self.remove(features.id)
+
+		edges = {}
+		for other_id in self._amount_candidates(features):
+			other = self._features[other_id]
+			score, reason = _score(features, other)
+			if score > 0:
+				edges[other_id] = self._edges[other_id][features.id] = (score, reason)
+				self._ranked[other_id] = None
+
+		self._features[features.id] = features
+		self._edges[features.id] = edges
+		self._ranked[features.id] = None
+		bisect.insort(self._sorted_amounts, (features.amount, features.id))
+		bisect.insort(self._sorted_min_amounts, (features.min_amount, features.id))
+
+	def _amount_candidates(self, features):
+		'''The ids of the offers whose amounts fit, looked up
+		like `OfferBook.amount_candidates` does.'''
+		big_enough = bisect.bisect_left(self._sorted_amounts, (features.min_amount,))
+		small_enough = bisect.bisect_right(self._sorted_min_amounts, (features.amount, float('inf')))
+		if len(self._sorted_amounts) - big_enough <= small_enough:
+			return [
+				other_id
+				for _, other_id in self._sorted_amounts[big_enough:]
+				if self._features[other_id].min_amount <= features.amount
+			]
+		return [
+			other_id
+			for _, other_id in self._sorted_min_amounts[:small_enough]
+			if self._features[other_id].amount >= features.min_amount
+		]
+
+	def remove(self, offer_id):
+		features = self._features.pop(offer_id, None)
+		if features is None:
+			return
+		for other_id in self._edges.pop(offer_id):
+			del self._edges[other_id][offer_id]
+			self._ranked[other_id] = None
+		del self._ranked[offer_id]
+		del self._sorted_amounts[bisect.bisect_left(self._sorted_amounts, (features.amount, offer_id))]
+		del self._sorted_min_amounts[bisect.bisect_left(self._sorted_min_amounts, (features.min_amount, offer_id))]
+
+	def decline(self, offer_a_id, offer_b_id):
+		if self._edges.get(offer_a_id, {}).pop(offer_b_id, None) is not None:
+			del self._edges[offer_b_id][offer_a_id]
+			self._ranked[offer_a_id] = self._ranked[offer_b_id] = None
+
+	def get_edge(self, offer_a_id, offer_b_id):
+		'''Returns (score, reason code), or None if the pair is not compatible.'''
+		return self._edges.get(offer_a_id, {}).get(offer_b_id, None)
+
+	def scores(self, offer):
+		'''Returns {offer id: (score, reason code)} of an offer against
+		every offer in the graph. Compatible pairs are read from the
+		edges; the others are only compared again to find the reason,
+		without converting any amounts.'''
+		features = self._features.get(offer.id, None)
+		if features is None:
+			features = _get_features([offer], self._currency)[0]
+		result = {}
+		for other_id, other in self._features.items():
+			edge = self.get_edge(offer.id, other_id)
+			result[other_id] = edge if edge is not None else _score(features, other)
+		return result
+
+	def top_candidates(self, offer_id, k):
+		'''Returns [(offer id, score, reason), ...] of the k best
+		partners of an offer. Sorting only happens after a change.'''
+		edges = self._edges.get(offer_id, None)
+		if edges is None:
+			return []
+		ranked = self._ranked[offer_id]
+		if ranked is None:
+			ranked = self._ranked[offer_id] = sorted(edges, key=lambda i: (-edges[i][0], i))
+		return [(i, edges[i][0], REASONS[edges[i][1]]) for i in ranked[:k]]
+
+	def candidate_scores(self):
+		'''Returns (offer ids, rows) in the shape `propose_matches` wants.'''
+		ids = list(self._features)
+		index = {offer_id: i for i, offer_id in enumerate(ids)}
+		rows = [
+			{index[other_id]: edge[0] for other_id, edge in self._edges[offer_id].items()}
+			for offer_id in ids
+		]
+		return ids, rows
+
+# scores have 4 decimals, see `_score`; the matching works on integers
+# so that no rounding errors creep into the dual variables
+WEIGHT_SCALE = 10000
+
+def _max_weight_matching(n, edges, deadline=None):
+	'''Edmonds' blossom algorithm with dual variables, as described by
+	Galil, "Efficient algorithms for finding maximum matching in graphs"
+	(1986), and implemented by Joris van Rantwijk. O(n^3).
+
+	`edges` is a list of (i, j, weight) with integer weights.
+	Returns a list with the partner of each vertex, or -1, and
+	whether it is the optimum. If `deadline` (a time.time()) passes,
+	the matching found so far is returned; each stage adds one pair.
+
+	Edge k has the endpoints 2k (vertex i) and 2k+1 (vertex j).
+	Blossoms are numbered n to 2n-1; a single vertex is its own
+	top-level blossom. Dual variables are kept at twice their value,
+	so that with integer weights they stay integers.'''
+	# pylint: disable=too-many-locals,too-many-statements,too-many-branches
+
+	if not edges:
+		return [-1] * n, True
+
+	edge_count = len(edges)
+	max_weight = max(0, max(weight for _, _, weight in edges))
+	endpoint = [edges[p // 2][p % 2] for p in range(2 * edge_count)]
+	neighbour_ends = [[] for _ in range(n)] # vertex -> remote endpoints of its edges
+	for k, (i, j, _) in enumerate(edges):
+		neighbour_ends[i].append(2 * k + 1)
+		neighbour_ends[j].append(2 * k)
+
+	mate = [-1] * n # vertex -> remote endpoint of its matched edge
+	label = [0] * (2 * n) # 0 = free, 1 = S, 2 = T; +4 = breadcrumb of `scan_blossom`
+	label_end = [-1] * (2 * n) # remote endpoint of the edge the label came through
+	in_blossom = list(range(n)) # vertex -> top-level blossom
+	blossom_parent = [-1] * (2 * n)
+	blossom_children = [None] * (2 * n) # in cyclic order, starting at the base
+	blossom_base = list(range(n)) + [-1] * n
+	blossom_ends = [None] * (2 * n) # endpoints of the edges between the children
+	best_edge = [-1] * (2 * n) # least-slack edge to an S-blossom
+	blossom_best_edges = [None] * (2 * n)
+	unused_blossoms = list(range(n, 2 * n))
+	dual = [max_weight] * n + [0] * n
+	allow_edge = [False] * edge_count # edges known to have zero slack
+	queue = [] # S-vertices whose edges have not been scanned yet
+
+	def slack(k):
+		i, j, weight = edges[k]
+		return dual[i] + dual[j] - 2 * weight
+
+	def blossom_leaves(b):
+		if b < n:
+			return [b]
+		leaves = []
+		stack = [b]
+		while stack:
+			t = stack.pop()
+			if t < n:
+				leaves.append(t)
+			else:
+				stack.extend(blossom_children[t])
+		return leaves
+
+	def assign_label(w, t, p):
+		b = in_blossom[w]
+		label[w] = label[b] = t
+		label_end[w] = label_end[b] = p
+		best_edge[w] = best_edge[b] = -1
+		if t == 1:
+			queue.extend(blossom_leaves(b))
+		else:
+			# the base of a T-blossom is matched; its mate becomes S
+			base = blossom_base[b]
+			assign_label(endpoint[mate[base]], 1, mate[base] ^ 1)
+
+	def scan_blossom(v, w):
+		'''Traces back from v and w to find a new blossom.
+		Returns its base, or -1 if there is an augmenting path.'''
+		path = []
+		base = -1
+		while v != -1 or w != -1:
+			b = in_blossom[v]
+			if label[b] & 4:
+				base = blossom_base[b]
+				break
+			path.append(b)
+			label[b] = 5
+			if label_end[b] == -1:
+				v = -1 # reached a single vertex
+			else:
+				v = endpoint[label_end[b]]
+				b = in_blossom[v]
+				v = endpoint[label_end[b]]
+			if w != -1:
+				v, w = w, v
+		for b in path:
+			label[b] = 1
+		return base
+
+	def add_blossom(base, k):
+		'''Makes a new blossom out of the S-blossoms on the cycle
+		through edge k, with the given base.'''
+		v, w, _ = edges[k]
+		base_blossom = in_blossom[base]
+		bv = in_blossom[v]
+		bw = in_blossom[w]
+		b = unused_blossoms.pop()
+		blossom_base[b] = base
+		blossom_parent[b] = -1
+		blossom_parent[base_blossom] = b
+		blossom_children[b] = path = []
+		blossom_ends[b] = ends = []
+		while bv != base_blossom:
+			blossom_parent[bv] = b
+			path.append(bv)
+			ends.append(label_end[bv])
+			v = endpoint[label_end[bv]]
+			bv = in_blossom[v]
+		path.append(base_blossom)
+		path.reverse()
+		ends.reverse()
+		ends.append(2 * k)
+		while bw != base_blossom:
+			blossom_parent[bw] = b
+			path.append(bw)
+			ends.append(label_end[bw] ^ 1)
+			w = endpoint[label_end[bw]]
+			bw = in_blossom[w]
+		label[b] = 1
+		label_end[b] = label_end[base_blossom]
+		dual[b] = 0
+		for v in blossom_leaves(b):
+			if label[in_blossom[v]] == 2:
+				# former T-vertices are S now and need scanning
+				queue.append(v)
+			in_blossom[v] = b
+
+		best_edge_to = [-1] * (2 * n)
+		for bv in path:
+			if blossom_best_edges[bv] is None:
+				edge_lists = [[p // 2 for p in neighbour_ends[v]] for v in blossom_leaves(bv)]
+			else:
+				edge_lists = [blossom_best_edges[bv]]
+			for edge_list in edge_lists:
+				for k in edge_list:
+					i, j, _ = edges[k]
+					if in_blossom[j] == b:
+						i, j = j, i
+					bj = in_blossom[j]
+					if bj != b and label[bj] == 1 and (best_edge_to[bj] == -1 or slack(k) < slack(best_edge_to[bj])):
+						best_edge_to[bj] = k
+			blossom_best_edges[bv] = None
+			best_edge[bv] = -1
+		blossom_best_edges[b] = [k for k in best_edge_to if k != -1]
+		best_edge[b] = -1
+		for k in blossom_best_edges[b]:
+			if best_edge[b] == -1 or slack(k) < slack(best_edge[b]):
+				best_edge[b] = k
+
+	def expand_blossom(b, end_stage):
+		'''Turns the children of blossom b into top-level blossoms.'''
+		for s in blossom_children[b]:
+			blossom_parent[s] = -1
+			if s < n:
+				in_blossom[s] = s
+			elif end_stage and dual[s] == 0:
+				expand_blossom(s, end_stage)
+			else:
+				for v in blossom_leaves(s):
+					in_blossom[v] = s
+
+		if not end_stage and label[b] == 2:
+			# relabel the children along the even path from the
+			# child the label came through to the base
+			entry_child = in_blossom[endpoint[label_end[b] ^ 1]]
+			j = blossom_children[b].index(entry_child)
+			if j & 1:
+				j -= len(blossom_children[b])
+				step, trick = 1, 0
+			else:
+				step, trick = -1, 1
+			p = label_end[b]
+			while j != 0:
+				label[endpoint[p ^ 1]] = 0
+				label[endpoint[blossom_ends[b][j - trick] ^ trick ^ 1]] = 0
+				assign_label(endpoint[p ^ 1], 2, p)
+				allow_edge[blossom_ends[b][j - trick] // 2] = True
+				j += step
+				p = blossom_ends[b][j - trick] ^ trick
+				allow_edge[p // 2] = True
+				j += step
+			# the base child becomes T without labelling its mate
+			bv = blossom_children[b][j]
+			label[endpoint[p ^ 1]] = label[bv] = 2
+			label_end[endpoint[p ^ 1]] = label_end[bv] = p
+			best_edge[bv] = -1
+			# the children on the odd path are only labelled
+			# if they are reachable from outside
+			j += step
+			while blossom_children[b][j] != entry_child:
+				bv = blossom_children[b][j]
+				if label[bv] == 1:
+					j += step
+					continue
+				for v in blossom_leaves(bv):
+					if label[v] != 0:
+						break
+				if label[v] != 0:
+					label[v] = 0
+					label[endpoint[mate[blossom_base[bv]]]] = 0
+					assign_label(v, 2, label_end[v])
+				j += step
+
+		label[b] = label_end[b] = -1
+		blossom_children[b] = blossom_ends[b] = None
+		blossom_base[b] = -1
+		blossom_best_edges[b] = None
+		best_edge[b] = -1
+		unused_blossoms.append(b)
+
+	def augment_blossom(b, v):
+		'''Swaps matched and unmatched edges along the even path
+		from vertex v to the base of blossom b, making v the base.'''
+		t = v
+		while blossom_parent[t] != b:
+			t = blossom_parent[t]
+		if t >= n:
+			augment_blossom(t, v)
+		i = j = blossom_children[b].index(t)
+		if i & 1:
+			j -= len(blossom_children[b])
+			step, trick = 1, 0
+		else:
+			step, trick = -1, 1
+		while j != 0:
+			j += step
+			t = blossom_children[b][j]
+			p = blossom_ends[b][j - trick] ^ trick
+			if t >= n:
+				augment_blossom(t, endpoint[p])
+			j += step
+			t = blossom_children[b][j]
+			if t >= n:
+				augment_blossom(t, endpoint[p ^ 1])
+			mate[endpoint[p]] = p ^ 1
+			mate[endpoint[p ^ 1]] = p
+		blossom_children[b] = blossom_children[b][i:] + blossom_children[b][:i]
+		blossom_ends[b] = blossom_ends[b][i:] + blossom_ends[b][:i]
+		blossom_base[b] = blossom_base[blossom_children[b][0]]
+
+	def augment_matching(k):
+		'''Swaps matched and unmatched edges along the augmenting
+		path through edge k.'''
+		v, w, _ = edges[k]
+		for s, p in ((v, 2 * k + 1), (w, 2 * k)):
+			while True:
+				bs = in_blossom[s]
+				if bs >= n:
+					augment_blossom(bs, s)
+				mate[s] = p
+				if label_end[bs] == -1:
+					break # reached a single vertex
+				t = endpoint[label_end[bs]]
+				bt = in_blossom[t]
+				s = endpoint[label_end[bt]]
+				j = endpoint[label_end[bt] ^ 1]
+				if bt >= n:
+					augment_blossom(bt, j)
+				mate[j] = label_end[bt]
+				p = label_end[bt] ^ 1
+
+	complete = False
+	for _ in range(n):
+		# each stage finds one augmenting path, or proves there is none
+		if deadline is not None and time.time() > deadline:
+			break
+		label[:] = [0] * (2 * n)
+		best_edge[:] = [-1] * (2 * n)
+		blossom_best_edges[n:] = [None] * n
+		allow_edge[:] = [False] * edge_count
+		queue[:] = []
+		for v in range(n):
+			if mate[v] == -1 and label[in_blossom[v]] == 0:
+				assign_label(v, 1, -1)
+
+		augmented = False
+		while True:
+			while queue and not augmented:
+				v = queue.pop()
+				for p in neighbour_ends[v]:
+					k = p // 2
+					w = endpoint[p]
+					if in_blossom[v] == in_blossom[w]:
+						continue
+					if not allow_edge[k]:
+						k_slack = slack(k)
+						if k_slack <= 0:
+							allow_edge[k] = True
+					if allow_edge[k]:
+						if label[in_blossom[w]] == 0:
+							assign_label(w, 2, p ^ 1)
+						elif label[in_blossom[w]] == 1:
+							base = scan_blossom(v, w)
+							if base >= 0:
+								add_blossom(base, k)
+							else:
+								augment_matching(k)
+								augmented = True
+								break
+						elif label[w] == 0:
+							# w is inside a T-blossom but not yet reached
+							label[w] = 2
+							label_end[w] = p ^ 1
+					elif label[in_blossom[w]] == 1:
+						b = in_blossom[v]
+						if best_edge[b] == -1 or k_slack < slack(best_edge[b]):
+							best_edge[b] = k
+					elif label[w] == 0:
+						if best_edge[w] == -1 or k_slack < slack(best_edge[w]):
+							best_edge[w] = k
+			if augmented:
+				break
+
+			# No tight edge left to follow: change the dual variables
+			# by the largest delta that keeps all slacks >= 0.
+			delta_type = 1 # an S-vertex's dual reaches zero
+			delta = min(dual[:n])
+			delta_edge = delta_blossom = None
+			for v in range(n):
+				if label[in_blossom[v]] == 0 and best_edge[v] != -1:
+					d = slack(best_edge[v])
+					if d < delta:
+						delta, delta_type, delta_edge = d, 2, best_edge[v]
+			for b in range(2 * n):
+				if blossom_parent[b] == -1 and label[b] == 1 and best_edge[b] != -1:
+					d = slack(best_edge[b]) // 2
+					if d < delta:
+						delta, delta_type, delta_edge = d, 3, best_edge[b]
+			for b in range(n, 2 * n):
+				if blossom_base[b] >= 0 and blossom_parent[b] == -1 and label[b] == 2 and dual[b] < delta:
+					delta, delta_type, delta_blossom = dual[b], 4, b
+
+			for v in range(n):
+				if label[in_blossom[v]] == 1:
+					dual[v] -= delta
+				elif label[in_blossom[v]] == 2:
+					dual[v] += delta
+			for b in range(n, 2 * n):
+				if blossom_base[b] >= 0 and blossom_parent[b] == -1:
+					if label[b] == 1:
+						dual[b] += delta
+					elif label[b] == 2:
+						dual[b] -= delta
+
+			if delta_type == 1:
+				break # optimum reached
+			if delta_type == 2:
+				allow_edge[delta_edge] = True
+				i, j, _ = edges[delta_edge]
+				if label[in_blossom[i]] == 0:
+					i = j
+				queue.append(i)
+			elif delta_type == 3:
+				allow_edge[delta_edge] = True
+				queue.append(edges[delta_edge][0])
+			else:
+				expand_blossom(delta_blossom, False)
+
+		if not augmented:
+			complete = True
+			break
+
+		# blossoms whose dual is zero are no use in the next stage
+		for b in range(n, 2 * n):
+			if blossom_parent[b] == -1 and blossom_base[b] >= 0 and label[b] == 1 and dual[b] == 0:
+				expand_blossom(b, True)
+
+	return [endpoint[p] if p != -1 else -1 for p in mate], complete
+
+def _greedy_matching(n, edges):
+	'''Pairs up the heaviest edges first. This is at least
+	half as good as the optimum, and takes no time at all.'''
+	mate = [-1] * n
+	for i, j, _ in sorted(edges, key=lambda edge: -edge[2]):
+		if mate[i] == -1 and mate[j] == -1:
+			mate[i], mate[j] = j, i
+	return mate
+
+def propose_matches(weights, time_budget=5.0):
+	'''Pairs up offers so that the sum of the scores of all pairs
+	is as high as possible. `weights` holds a dict {j: score}
+	for each offer i, as returned by `OfferBook.candidate_scores`.
+
+	This is a maximum-weight matching of the candidate graph,
+	found exactly by `_max_weight_matching`, which takes O(n^3).
+	If that takes longer than `time_budget` seconds, we settle for
+	the better of the matching found so far and a greedy matching,
+	and say so in the statistics.
+
+	Returns a list of (i, j) index pairs and a dict of statistics.'''
+
+	t1 = time.time()
+	n = len(weights)
+	edges = [
+		(i, j, int(round(weight * WEIGHT_SCALE)))
+		for i, row in enumerate(weights)
+		for j, weight in row.items()
+		if j > i and weight > 0
+	]
+
+	def total(mate):
+		return round(sum(weights[i][j] for i, j in enumerate(mate) if j > i), 4)
+
+	greedy = _greedy_matching(n, edges)
+	mate, complete = _max_weight_matching(n, edges, t1 + time_budget)
+	if not complete and total(greedy) > total(mate):
+		mate = greedy
+
+	pairs = [(i, j) for i, j in enumerate(mate) if j > i]
+	stats = {
+		'offers': n,
+		'candidate_pairs': len(edges),
+		'greedy_total': total(greedy),
+		'total': total(mate),
+		'pairs': len(pairs),
+		'timed_out': not complete,
+		'seconds': round(time.time() - t1, 4),
+	}
+	return pairs, stats
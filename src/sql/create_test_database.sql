@@ -8,6 +8,11 @@
 \ir upgrades/2018-11-16_admin.sql
 \ir upgrades/2018-11-18_gift_aid.sql
 \ir upgrades/2018-11-24_tax_factor.sql
+\ir upgrades/2020-01-18_eventlog_match_uncomfirmed.sql
+\ir upgrades/2020-01-25_match_feedback.sql
+\ir upgrades/2026-10-17_row_versions.sql
+\ir upgrades/2026-10-18_notify_changes.sql
+\ir upgrades/2026-10-19_row_xids.sql
 
 \ir test_data/00-currencies.sql
 \ir test_data/01-countries.sql
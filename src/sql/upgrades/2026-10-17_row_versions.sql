@@ -0,0 +1,87 @@
+-- Every insert and update stamps the row with a new value from one
+-- global sequence, and every delete leaves a copy of the row in
+-- tombstones, so that caches can fetch only what changed since the
+-- highest row_version they have seen.
+
+CREATE SEQUENCE row_version_seq;
+
+CREATE TABLE tombstones (
+	row_version BIGINT NOT NULL DEFAULT nextval('row_version_seq'),
+	table_name varchar(100) NOT NULL,
+	row_data JSON NOT NULL,
+	deleted_ts timestamp NOT NULL DEFAULT now(),
+	PRIMARY KEY (row_version)
+);
+
+CREATE INDEX tombstones_table_name_row_version ON tombstones (table_name, row_version);
+
+CREATE FUNCTION set_row_version() RETURNS trigger AS $$
+BEGIN
+	NEW.row_version := nextval('row_version_seq');
+	RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION add_tombstone() RETURNS trigger AS $$
+BEGIN
+	INSERT INTO tombstones (table_name, row_data)
+	VALUES (TG_TABLE_NAME, row_to_json(OLD));
+	RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+ALTER TABLE currencies ADD COLUMN row_version BIGINT NOT NULL DEFAULT nextval('row_version_seq');
+CREATE INDEX currencies_row_version ON currencies (row_version);
+CREATE TRIGGER currencies_row_version BEFORE INSERT OR UPDATE ON currencies
+	FOR EACH ROW EXECUTE PROCEDURE set_row_version();
+CREATE TRIGGER currencies_tombstone AFTER DELETE ON currencies
+	FOR EACH ROW EXECUTE PROCEDURE add_tombstone();
+
+ALTER TABLE charity_categories ADD COLUMN row_version BIGINT NOT NULL DEFAULT nextval('row_version_seq');
+CREATE INDEX charity_categories_row_version ON charity_categories (row_version);
+CREATE TRIGGER charity_categories_row_version BEFORE INSERT OR UPDATE ON charity_categories
+	FOR EACH ROW EXECUTE PROCEDURE set_row_version();
+CREATE TRIGGER charity_categories_tombstone AFTER DELETE ON charity_categories
+	FOR EACH ROW EXECUTE PROCEDURE add_tombstone();
+
+ALTER TABLE charities ADD COLUMN row_version BIGINT NOT NULL DEFAULT nextval('row_version_seq');
+CREATE INDEX charities_row_version ON charities (row_version);
+CREATE TRIGGER charities_row_version BEFORE INSERT OR UPDATE ON charities
+	FOR EACH ROW EXECUTE PROCEDURE set_row_version();
+CREATE TRIGGER charities_tombstone AFTER DELETE ON charities
+	FOR EACH ROW EXECUTE PROCEDURE add_tombstone();
+
+ALTER TABLE countries ADD COLUMN row_version BIGINT NOT NULL DEFAULT nextval('row_version_seq');
+CREATE INDEX countries_row_version ON countries (row_version);
+CREATE TRIGGER countries_row_version BEFORE INSERT OR UPDATE ON countries
+	FOR EACH ROW EXECUTE PROCEDURE set_row_version();
+CREATE TRIGGER countries_tombstone AFTER DELETE ON countries
+	FOR EACH ROW EXECUTE PROCEDURE add_tombstone();
+
+ALTER TABLE charities_in_countries ADD COLUMN row_version BIGINT NOT NULL DEFAULT nextval('row_version_seq');
+CREATE INDEX charities_in_countries_row_version ON charities_in_countries (row_version);
+CREATE TRIGGER charities_in_countries_row_version BEFORE INSERT OR UPDATE ON charities_in_countries
+	FOR EACH ROW EXECUTE PROCEDURE set_row_version();
+CREATE TRIGGER charities_in_countries_tombstone AFTER DELETE ON charities_in_countries
+	FOR EACH ROW EXECUTE PROCEDURE add_tombstone();
+
+ALTER TABLE offers ADD COLUMN row_version BIGINT NOT NULL DEFAULT nextval('row_version_seq');
+CREATE INDEX offers_row_version ON offers (row_version);
+CREATE TRIGGER offers_row_version BEFORE INSERT OR UPDATE ON offers
+	FOR EACH ROW EXECUTE PROCEDURE set_row_version();
+CREATE TRIGGER offers_tombstone AFTER DELETE ON offers
+	FOR EACH ROW EXECUTE PROCEDURE add_tombstone();
+
+ALTER TABLE matches ADD COLUMN row_version BIGINT NOT NULL DEFAULT nextval('row_version_seq');
+CREATE INDEX matches_row_version ON matches (row_version);
+CREATE TRIGGER matches_row_version BEFORE INSERT OR UPDATE ON matches
+	FOR EACH ROW EXECUTE PROCEDURE set_row_version();
+CREATE TRIGGER matches_tombstone AFTER DELETE ON matches
+	FOR EACH ROW EXECUTE PROCEDURE add_tombstone();
+
+-- Declined pairs are only ever inserted (and deleted together with
+-- their offers, whose ids are never reused), so they need no tombstones.
+ALTER TABLE declined_matches ADD COLUMN row_version BIGINT NOT NULL DEFAULT nextval('row_version_seq');
+CREATE INDEX declined_matches_row_version ON declined_matches (row_version);
+CREATE TRIGGER declined_matches_row_version BEFORE INSERT OR UPDATE ON declined_matches
+	FOR EACH ROW EXECUTE PROCEDURE set_row_version();
@@ -0,0 +1,35 @@
+-- Tells every web server process that a cached table has changed,
+-- so that it can refresh its caches right away (see entities.refresh).
+-- Notifications are only sent when the transaction commits, and the
+-- same table is only reported once per transaction.
+
+CREATE FUNCTION notify_entity_change() RETURNS trigger AS $$
+BEGIN
+	PERFORM pg_notify('entity_changes', TG_TABLE_NAME);
+	RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER currencies_notify AFTER INSERT OR UPDATE OR DELETE ON currencies
+	FOR EACH STATEMENT EXECUTE PROCEDURE notify_entity_change();
+
+CREATE TRIGGER charity_categories_notify AFTER INSERT OR UPDATE OR DELETE ON charity_categories
+	FOR EACH STATEMENT EXECUTE PROCEDURE notify_entity_change();
+
+CREATE TRIGGER charities_notify AFTER INSERT OR UPDATE OR DELETE ON charities
+	FOR EACH STATEMENT EXECUTE PROCEDURE notify_entity_change();
+
+CREATE TRIGGER countries_notify AFTER INSERT OR UPDATE OR DELETE ON countries
+	FOR EACH STATEMENT EXECUTE PROCEDURE notify_entity_change();
+
+CREATE TRIGGER charities_in_countries_notify AFTER INSERT OR UPDATE OR DELETE ON charities_in_countries
+	FOR EACH STATEMENT EXECUTE PROCEDURE notify_entity_change();
+
+CREATE TRIGGER offers_notify AFTER INSERT OR UPDATE OR DELETE ON offers
+	FOR EACH STATEMENT EXECUTE PROCEDURE notify_entity_change();
+
+CREATE TRIGGER matches_notify AFTER INSERT OR UPDATE OR DELETE ON matches
+	FOR EACH STATEMENT EXECUTE PROCEDURE notify_entity_change();
+
+CREATE TRIGGER declined_matches_notify AFTER INSERT OR UPDATE OR DELETE ON declined_matches
+	FOR EACH STATEMENT EXECUTE PROCEDURE notify_entity_change();
@@ -0,0 +1,53 @@
+-- row_version says in which order rows were written, but not in which
+-- order they were committed: a transaction can take a lower version and
+-- commit after a refresh has already seen a higher one. So every row
+-- also records the id of the transaction that wrote it, and caches
+-- re-read all rows written by transactions that were not yet finished
+-- when they last looked (see entities.refresh).
+--
+-- txid_current() is called pg_current_xact_id() since postgres 13,
+-- but the old name still works.
+
+CREATE OR REPLACE FUNCTION set_row_version() RETURNS trigger AS $$
+BEGIN
+	NEW.row_version := nextval('row_version_seq');
+	NEW.row_xid := txid_current();
+	RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+ALTER TABLE currencies ADD COLUMN row_xid BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE currencies ALTER COLUMN row_xid SET DEFAULT txid_current();
+CREATE INDEX currencies_row_xid ON currencies (row_xid);
+
+ALTER TABLE charity_categories ADD COLUMN row_xid BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE charity_categories ALTER COLUMN row_xid SET DEFAULT txid_current();
+CREATE INDEX charity_categories_row_xid ON charity_categories (row_xid);
+
+ALTER TABLE charities ADD COLUMN row_xid BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE charities ALTER COLUMN row_xid SET DEFAULT txid_current();
+CREATE INDEX charities_row_xid ON charities (row_xid);
+
+ALTER TABLE countries ADD COLUMN row_xid BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE countries ALTER COLUMN row_xid SET DEFAULT txid_current();
+CREATE INDEX countries_row_xid ON countries (row_xid);
+
+ALTER TABLE charities_in_countries ADD COLUMN row_xid BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE charities_in_countries ALTER COLUMN row_xid SET DEFAULT txid_current();
+CREATE INDEX charities_in_countries_row_xid ON charities_in_countries (row_xid);
+
+ALTER TABLE offers ADD COLUMN row_xid BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE offers ALTER COLUMN row_xid SET DEFAULT txid_current();
+CREATE INDEX offers_row_xid ON offers (row_xid);
+
+ALTER TABLE matches ADD COLUMN row_xid BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE matches ALTER COLUMN row_xid SET DEFAULT txid_current();
+CREATE INDEX matches_row_xid ON matches (row_xid);
+
+ALTER TABLE declined_matches ADD COLUMN row_xid BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE declined_matches ALTER COLUMN row_xid SET DEFAULT txid_current();
+CREATE INDEX declined_matches_row_xid ON declined_matches (row_xid);
+
+ALTER TABLE tombstones ADD COLUMN row_xid BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE tombstones ALTER COLUMN row_xid SET DEFAULT txid_current();
+CREATE INDEX tombstones_table_name_row_xid ON tombstones (table_name, row_xid);
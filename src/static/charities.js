@@ -1,4 +1,4 @@
-/* globals ajax, createNode, getElementsById */
+/* globals ajax, ajaxGet, createNode, getElementsById */
 /* jshint esversion: 6 */
 (function () {
 	'use strict';
@@ -27,7 +27,7 @@
 			});
 	}
 
-	ajax('/ajax/get_info')
+	ajaxGet('/ajax/get_info')
 		.then(info => {
 			info.countries.sort2(x => x.iso_name);
 			info.charities.sort2(x => x.name);
@@ -26,6 +26,30 @@ function ajax(action, payload) {
 	});
 }
 
+// For endpoints without arguments that the server lets the
+// browser cache and revalidate (ETag), like /ajax/get_info.
+function ajaxGet(action) {
+	'use strict';
+
+	return new Promise((resolve, reject) => {
+		const request = new XMLHttpRequest();
+		request.open('GET', `${action}`, true);
+		request.onreadystatechange = () => {
+			if (request.readyState === 4) {
+				if (request.status < 300) {
+					resolve(JSON.parse(request.responseText));
+				} else {
+					reject(request.responseText);
+				}
+			}
+		};
+
+		request.setRequestHeader('X-Requested-With', 'XMLHttpRequest');
+
+		request.send();
+	});
+}
+
 function createNode(cfg) {
 	'use strict';
 
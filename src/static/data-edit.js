@@ -143,6 +143,7 @@
 
 		createRows();
 
+		ui.categories.innerHTML = '';
 		data.charity_categories.forEach(cc => {
 			ui.categories.appendChild(createNode({
 				xtype: 'li',
@@ -227,7 +228,7 @@
 			ajax('/special-secret-admin/delete_charity_category', {
 				category_id: parseInt(ui.charityCategoryId.textContent, 10),
 			})
-				.then(() => window.location.reload())
+				.then(readChanges)
 				.catch(handleError);
 		}
 	};
@@ -240,11 +241,11 @@
 		if (ui.charityCategoryId.textContent) {
 			args.category_id = parseInt(ui.charityCategoryId.textContent, 10);
 			ajax('/special-secret-admin/update_charity_category', args)
-				.then(() => window.location.reload())
+				.then(readChanges)
 				.catch(handleError);
 		} else {
 			ajax('/special-secret-admin/create_charity_category', args)
-				.then(() => window.location.reload())
+				.then(readChanges)
 				.catch(handleError);
 		}
 	};
@@ -256,7 +257,7 @@
 			ajax('/special-secret-admin/delete_charity', {
 				charity_id: parseInt(ui.charityId.textContent, 10),
 			})
-				.then(() => window.location.reload())
+				.then(readChanges)
 				.catch(handleError);
 		}
 	};
@@ -270,11 +271,11 @@
 		if (ui.charityId.textContent) {
 			args.charity_id = parseInt(ui.charityId.textContent, 10);
 			ajax('/special-secret-admin/update_charity', args)
-				.then(() => window.location.reload())
+				.then(readChanges)
 				.catch(handleError);
 		} else {
 			ajax('/special-secret-admin/create_charity', args)
-				.then(() => window.location.reload())
+				.then(readChanges)
 				.catch(handleError);
 		}
 	};
@@ -286,7 +287,7 @@
 			ajax('/special-secret-admin/delete_country', {
 				country_id: parseInt(ui.countryId.textContent, 10),
 			})
-				.then(() => window.location.reload())
+				.then(readChanges)
 				.catch(handleError);
 		}
 	};
@@ -305,11 +306,11 @@
 		if (ui.countryId.textContent) {
 			args.country_id = parseInt(ui.countryId.textContent, 10);
 			ajax('/special-secret-admin/update_country', args)
-				.then(() => window.location.reload())
+				.then(readChanges)
 				.catch(handleError);
 		} else {
 			ajax('/special-secret-admin/create_country', args)
-				.then(() => window.location.reload())
+				.then(readChanges)
 				.catch(handleError);
 		}
 	};
@@ -322,7 +323,7 @@
 				charity_id: ui.charityInCountryCharity.data,
 				country_id: ui.charityInCountryCountry.data,
 			})
-				.then(() => window.location.reload())
+				.then(readChanges)
 				.catch(handleError);
 		}
 	};
@@ -335,11 +336,11 @@
 		};
 		if (data.charities_in_countries.find(cic => cic.charity_id === args.charity_id && cic.country_id === args.country_id)) {
 			ajax('/special-secret-admin/update_charity_in_country', args)
-				.then(() => window.location.reload())
+				.then(readChanges)
 				.catch(handleError);
 		} else {
 			ajax('/special-secret-admin/create_charity_in_country', args)
-				.then(() => window.location.reload())
+				.then(readChanges)
 				.catch(handleError);
 		}
 	};
@@ -357,6 +358,48 @@
 
 	let data = {};
 
+	const keys = {
+		currencies: x => x.id,
+		charity_categories: x => x.id,
+		charities: x => x.id,
+		countries: x => x.id,
+		charities_in_countries: x => `${x.charity_id}/${x.country_id}`,
+	};
+
+	const sortKeys = {
+		currencies: x => x.iso,
+		charity_categories: x => x.name,
+		charities: x => x.name,
+		countries: x => x.iso_name,
+	};
+
+	// Merges what changed since the last read_all or read_changes_since
+	// into `data`, instead of reloading everything after each edit.
+	function readChanges() {
+		ajax('/special-secret-admin/read_changes_since', {
+			version: data.version,
+		})
+			.then(reply => {
+				Object.keys(keys).forEach(kind => {
+					const key = keys[kind];
+					const replaced = new Set(reply.deleted[kind].concat(reply.changed[kind]).map(key));
+					const records = reply.full ? [] : data[kind].filter(x => !replaced.has(key(x)));
+					data[kind] = records.concat(reply.changed[kind]);
+					if (sortKeys[kind]) {
+						data[kind].sort2(sortKeys[kind]);
+					}
+				});
+				data.version = reply.version;
+
+				ui.btnCancelCharityCategory.click();
+				ui.btnCancelCharity.click();
+				ui.btnCancelCountry.click();
+				ui.btnCancelCharityInCountry.click();
+				populateUi(data);
+			})
+			.catch(handleError);
+	}
+
 	ajax('/special-secret-admin/read_all')
 		.then(reply => {
 			data = reply;
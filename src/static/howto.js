@@ -1,11 +1,11 @@
-/* globals ajax, createNode, getElementsById */
+/* globals ajaxGet, createNode, getElementsById */
 /* jshint esversion: 6 */
 (function () {
 	'use strict';
 
 	const ui = getElementsById();
 
-	ajax('/ajax/get_info')
+	ajaxGet('/ajax/get_info')
 		.then(info => {
 			// populate charities
 			ui.lstCharities.innerHTML = '';
@@ -1,4 +1,4 @@
-/* globals ajax, createNode, getElementsById */
+/* globals ajax, ajaxGet, createNode, getElementsById */
 /* jshint esversion: 6 */
 [window.captchaGood, window.captchaBad] = (function () {
 	'use strict';
@@ -185,7 +185,7 @@
 			});
 	}
 
-	ajax('/ajax/get_info')
+	ajaxGet('/ajax/get_info')
 		.then(info => {
 			populateDropdowns(info);
 			attachEventHandlers();
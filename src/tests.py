@@ -1,10 +1,29 @@
 #!/usr/bin/env python3
 
+import datetime
+import gzip
+import json
+import logging
+import os
+import random
 import re
+import select
+import tempfile
+import threading
+import time
+import types
 import unittest
 
+import tornado.gen
+import tornado.testing
+
+import assets
+import currency
+import database
 import entities
 import donationswap
+import main as webserver
+import matchscore
 import util
 
 class MockCaptcha:
@@ -28,6 +47,16 @@ class MockCurrency:
 		self.calls.setdefault('convert', []).append(locals())
 		return int(amount / self.from_factor * self.to_factor)
 
+	def convert_many(self, amounts, from_currencies, to_currency):
+		self.calls.setdefault('convert_many', []).append(locals())
+		return [int(amount / self.from_factor * self.to_factor) for amount in amounts]
+
+	def get_version(self): # pylint: disable=no-self-use
+		return 1
+
+	def get_metrics(self): # pylint: disable=no-self-use
+		return {}
+
 class MockGeoIpCountry:
 
 	def __init__(self):
@@ -113,6 +142,178 @@ class get_page(TestBase):
 
 	def test_bad_filename_should_not_raise_exception(self):
 		self.assertEqual('', self.ds.get_page('this-file-does-not-exist'))
+		self.assertEqual(None, self.ds.get_cached_page('this-file-does-not-exist'))
+
+	def test_page_is_rendered_once(self):
+		page = self.ds.get_cached_page('start.html')
+		self.assertIs(self.ds.get_cached_page('start.html'), page)
+		self.assertTrue('{%CAPTCHA_SITE_KEY%}' not in page.content)
+		self.assertEqual(page.body, page.content.encode('utf-8'))
+		self.assertEqual(page.etag, donationswap.Page(page.content).etag)
+
+	def test_static_files_are_fingerprinted(self):
+		css = self.ds.get_asset('style.css')
+		self.assertTrue('/static/style.css?v=%s"' % css.hash in self.ds.get_page('start.html'))
+
+class database_pool(TestBase):
+
+	def test_connections_are_reused(self):
+		with self.ds._database.connect() as db:
+			db.read_one('SELECT 1;')
+		opened = self.ds._database.get_pool_metrics()['opened']
+		with self.ds._database.connect() as db:
+			db.read_one('SELECT 1;')
+		metrics = self.ds._database.get_pool_metrics()
+		self.assertEqual(metrics['opened'], opened)
+		self.assertEqual(metrics['in_use'], 0)
+
+	def test_rollback_on_exception(self):
+		with self.assertRaises(ValueError):
+			with self.ds._database.connect() as db:
+				db.write('''INSERT INTO charity_categories (id, name) VALUES (3, 'category3');''')
+				raise ValueError()
+		with self.ds._database.connect() as db:
+			self.assertEqual(db.read_one('SELECT * FROM charity_categories WHERE id = 3;'), None)
+		self.assertEqual(self.ds._database.get_pool_metrics()['in_use'], 0)
+
+class database_connection(unittest.TestCase):
+
+	def test_slot_is_released_if_cursor_fails(self):
+		released = []
+
+		class BrokenConnection:
+			def cursor(self, **_):
+				raise ValueError('no cursor')
+
+		class Pool:
+			def acquire(self):
+				return BrokenConnection()
+			def release(self, connection, discard=False):
+				released.append(discard)
+
+		with self.assertRaises(ValueError):
+			database.Connection(Pool())
+		self.assertEqual(released, [True])
+
+class refresh_entities(TestBase):
+
+	def test_nothing_changed(self):
+		with self.ds._database.connect() as db:
+			self.assertEqual(entities.refresh(db), 0)
+
+	def test_changes_written_elsewhere(self):
+		with self.ds._database.connect() as db:
+			# behind the cache's back, like console.py would
+			db.write('''UPDATE charities SET name = 'renamed' WHERE id = 1;''')
+			db.write('''DELETE FROM charities WHERE id = 2;''')
+		with self.ds._database.connect() as db:
+			self.assertEqual(entities.refresh(db), 2)
+		self.assertEqual(entities.Charity.by_id(1).name, 'renamed')
+		self.assertEqual(entities.Charity.by_name('renamed'), entities.Charity.by_id(1))
+		self.assertEqual(entities.Charity.by_id(2), None)
+
+	def test_out_of_order_commits(self):
+		with self.ds._database.connect() as slow:
+			# takes the lower row_version, but commits last
+			slow.write('''UPDATE charities SET name = 'slow' WHERE id = 1;''')
+			with self.ds._database.connect() as fast:
+				fast.write('''UPDATE charities SET name = 'fast' WHERE id = 2;''')
+			with self.ds._database.connect() as db:
+				self.assertEqual(entities.refresh(db), 1)
+			self.assertEqual(entities.Charity.by_id(2).name, 'fast')
+		with self.ds._database.connect() as db:
+			self.assertEqual(entities.refresh(db), 1)
+		self.assertEqual(entities.Charity.by_id(1).name, 'slow')
+
+	def test_own_writes_are_not_merged_again(self):
+		with self.ds._database.connect() as db:
+			entities.Offer.create(db, 'secret', 'name', 'user@test.test', 1, 10, 1, 1, '2030-01-01')
+		with self.ds._database.connect() as db:
+			self.assertEqual(entities.refresh(db), 0)
+
+class listen_for_changes(TestBase):
+
+	def test_notify_then_refresh(self):
+		listener = self.ds.listen_for_changes()
+		try:
+			with self.ds._database.connect() as db:
+				# behind the cache's back, like another process would
+				db.write('''UPDATE charities SET name = 'renamed' WHERE id = 1;''')
+			payloads = []
+			while not payloads and select.select([listener], [], [], 5)[0]:
+				payloads = listener.get_payloads()
+			self.assertEqual(payloads, ['charities'])
+		finally:
+			listener.close()
+
+		self.assertEqual(self.ds.refresh_entities(), 1)
+		self.assertEqual(entities.Charity.by_id(1).name, 'renamed')
+
+class FakeListener:
+
+	def __init__(self):
+		self.read_fd, self.write_fd = os.pipe()
+
+	def notify(self, payload):
+		os.write(self.write_fd, payload.encode('utf-8'))
+
+	def fileno(self):
+		return self.read_fd
+
+	def get_payloads(self):
+		data = os.read(self.read_fd, 1000)
+		if data == b'!':
+			raise OSError('connection lost')
+		return list(data.decode('utf-8'))
+
+	def close(self):
+		os.close(self.read_fd)
+		os.close(self.write_fd)
+
+class ChangeListener(tornado.testing.AsyncTestCase):
+
+	def setUp(self):
+		super().setUp()
+		self.listeners = []
+		self.refreshes = 0
+		self.listener = webserver.ChangeListener(self)
+		self.listener.RECONNECT_DELAY = 0.05
+
+	def listen_for_changes(self):
+		self.listeners.append(FakeListener())
+		return self.listeners[-1]
+
+	def refresh_entities(self):
+		time.sleep(0.1)
+		self.refreshes += 1
+
+	@tornado.testing.gen_test
+	def test_notifications_are_coalesced(self):
+		self.listener.start()
+		yield tornado.gen.sleep(0.02)
+		for _ in range(5): # while the first refresh is running
+			self.listeners[0].notify('a')
+			yield tornado.gen.sleep(0.01)
+		yield tornado.gen.sleep(0.5)
+		self.assertEqual(self.refreshes, 2)
+
+	@tornado.testing.gen_test
+	def test_reconnect(self):
+		self.listener.start()
+		yield tornado.gen.sleep(0.2)
+		self.listeners[0].notify('!')
+		yield tornado.gen.sleep(0.5)
+		self.assertEqual(len(self.listeners), 2)
+		self.assertEqual(self.refreshes, 2) # after connecting, and again after reconnecting
+
+class unknown_match_secret(TestBase):
+
+	def test_refreshes_at_most_once(self):
+		self.assertEqual(self.ds.get_match('x' * 48), None)
+		acquired = self.ds._database.get_pool_metrics()['acquired']
+		self.assertEqual(self.ds.get_match('x' * 48), None) # remembered as missing
+		self.assertEqual(self.ds.get_match('y' * 48), None) # refreshed too recently
+		self.assertEqual(self.ds._database.get_pool_metrics()['acquired'], acquired)
 
 class get_info(TestBase):
 
@@ -125,6 +326,77 @@ class get_info(TestBase):
 		result = self.ds.get_info()['client_country']
 		self.assertEqual(result, 1)
 
+	def test_charities_in_countries(self):
+		self.ds.create_charity_in_country(None, 2, 1, 'instructions')
+		result = self.ds.get_info()['charities_in_countries']
+		self.assertEqual(result, {1: [2], 2: []})
+		self.assertTrue(entities.CharityInCountry.is_tax_deductible(2, 1))
+
+		self.ds.delete_charity_in_country(None, 2, 1)
+		result = self.ds.get_info()['charities_in_countries']
+		self.assertEqual(result, {1: [], 2: []})
+		self.assertFalse(entities.CharityInCountry.is_tax_deductible(2, 1))
+
+	def test_cached_until_reference_data_changes(self):
+		info = self.ds._get_cached_info()
+		self.assertIs(self.ds._get_cached_info(), info)
+
+		self.ds.create_charity_in_country(None, 2, 1, 'instructions')
+		self.assertIsNot(self.ds._get_cached_info(), info)
+
+	def test_cached_until_rates_change(self):
+		info = self.ds._get_cached_info()
+		self.currency.get_version = lambda: 2
+		self.assertIsNot(self.ds._get_cached_info(), info)
+
+	def test_json(self):
+		self.geoip.country = 'c1'
+		etag, body = self.ds.get_info_json('ip')
+		info = json.loads(body.decode('utf-8'))
+		self.assertEqual(info, json.loads(json.dumps(self.ds.get_info())))
+		self.assertEqual(self.ds.get_info_json('ip')[0], etag)
+
+		self.geoip.country = 'c2'
+		self.assertNotEqual(self.ds.get_info_json('ip')[0], etag)
+
+class read_changes_since(TestBase):
+
+	def test_snapshot_is_built_once(self):
+		snapshot = self.ds._get_reference_snapshot()
+		self.assertIs(self.ds._get_reference_snapshot(), snapshot)
+		self.assertEqual(self.ds.read_all(None)['version'], snapshot.version)
+
+	def test_nothing_changed(self):
+		version = self.ds.read_all(None)['version']
+		result = self.ds.read_changes_since(None, version)
+		self.assertEqual(result['version'], version)
+		self.assertFalse(result['full'])
+		self.assertEqual(sum(len(i) for i in result['changed'].values()), 0)
+		self.assertEqual(sum(len(i) for i in result['deleted'].values()), 0)
+
+	def test_changed_and_deleted(self):
+		version = self.ds.read_all(None)['version']
+		self.ds.update_charity(None, 1, 'charity1b', 1)
+		self.ds.create_charity_in_country(None, 2, 1, 'instructions')
+
+		result = self.ds.read_changes_since(None, version)
+		self.assertNotEqual(result['version'], version)
+		self.assertFalse(result['full'])
+		self.assertEqual(result['changed']['charities'], [{'id': 1, 'name': 'charity1b', 'category_id': 1}])
+		self.assertEqual(result['changed']['charities_in_countries'], [{'charity_id': 2, 'country_id': 1, 'instructions': 'instructions'}])
+		self.assertEqual(result['changed']['countries'], [])
+
+		version = result['version']
+		self.ds.delete_charity_in_country(None, 2, 1)
+		result = self.ds.read_changes_since(None, version)
+		self.assertEqual(result['changed']['charities_in_countries'], [])
+		self.assertEqual(result['deleted']['charities_in_countries'], [{'charity_id': 2, 'country_id': 1, 'instructions': 'instructions'}])
+
+	def test_unknown_version(self):
+		result = self.ds.read_changes_since(None, 'unknown')
+		self.assertTrue(result['full'])
+		self.assertEqual(result['changed'], self.ds._get_reference_snapshot().data)
+
 class send_contact_message(TestBase):
 
 	def _send_message(self):
@@ -136,8 +408,8 @@ class send_contact_message(TestBase):
 		)
 
 	def test_happy_path(self):
-		self.ds._ip_address = 'ip'
-		self._send_message()
+		with donationswap.request_context(ip_address='ip'):
+			self._send_message()
 
 		calls = self.mail.calls['send']
 		self.assertEqual(len(calls), 1)
@@ -150,6 +422,57 @@ class send_contact_message(TestBase):
 		with self.assertRaises(donationswap.DonationException):
 			self._send_message()
 
+class run_deadlines(TestBase):
+
+	def _create_offer(self, year):
+		self.ds.create_offer(
+			captcha_response='irrelevant',
+			name='Ava of Animalia',
+			country=1,
+			amount=42,
+			min_amount=42,
+			charity=1,
+			email='user@test.test',
+			expiration={
+				'day': 28,
+				'month': 2,
+				'year': year,
+			}
+		)
+		return entities.Offer.get_all(lambda x: x.email == 'user@test.test')[0]
+
+	def test_nothing_due(self):
+		self._create_offer(2200)
+		counts = self.ds.run_deadlines()
+		self.assertEqual(sum(counts.values()), 0)
+
+	def test_expired_offer(self):
+		offer = self._create_offer(2012)
+		counts = self.ds.run_deadlines()
+		self.assertEqual(counts['expired_offers'], 1)
+		self.assertEqual(entities.Offer.by_id(offer.id), None)
+
+	def test_unconfirmed_offer_written_elsewhere(self):
+		offer = self._create_offer(2200)
+		with self.ds._database.connect() as db:
+			db.write('''UPDATE offers SET created_ts = now() - interval '2 days' WHERE id = %(id)s;''', id=offer.id)
+		counts = self.ds.run_deadlines()
+		self.assertEqual(counts['unconfirmed_offers'], 1)
+		self.assertEqual(entities.Offer.by_id(offer.id), None)
+
+	def test_only_changed_offers_are_rescheduled(self):
+		offer = self._create_offer(2200)
+		self.ds.run_deadlines() # builds the queue
+		with self.ds._database.connect() as db:
+			db.write('''UPDATE offers SET expires_ts = '2012-02-28' WHERE id = %(id)s;''', id=offer.id)
+		rebuild = self.ds._deadlines.rebuild
+		self.ds._deadlines.rebuild = lambda events: self.fail('rebuilt the whole queue')
+		try:
+			counts = self.ds.run_deadlines()
+		finally:
+			self.ds._deadlines.rebuild = rebuild
+		self.assertEqual(counts['expired_offers'], 1)
+
 class create_offer(TestBase):
 
 	def _create_offer(self, name='Ava of Animalia', country=1, amount=42, min_amount=1, charity=1, email='user@test.test'):
@@ -172,6 +495,11 @@ class create_offer(TestBase):
 		with self.ds._database.connect() as db:
 			return db.read_one('SELECT * FROM offers;')
 
+	def test_real_currency(self):
+		# MockCurrency accepts anything, the real one wants ISO codes
+		self.ds._currency = currency.HistoricCurrency({'base': 'EUR', 'timestamp': 0, 'rates': {'EUR': 1}})
+		self.assertEqual(self._create_offer(), None)
+
 	def test_happy_path(self):
 		result = self._create_offer()
 
@@ -265,7 +593,7 @@ class confirm_offer(TestBase):
 		self.assertEqual(result['amount'], 42)
 		self.assertEqual(result['charity'], 'charity1'),
 
-		self.assertTrue(offer.confirmed)
+		self.assertTrue(entities.Offer.by_id(offer.id).confirmed)
 
 	def test_invalid_secret(self):
 		result = self.ds.confirm_offer('this-secret-does-not-exist')
@@ -294,6 +622,581 @@ class delete_offer(TestBase):
 		offers = entities.Offer.get_all(lambda x: x.email == 'user@test.test')
 		self.assertEqual(len(offers), 0)
 
+class match_scores(TestBase):
+
+	@staticmethod
+	def _create_offer(db, name, country_id, charity_id):
+		offer = entities.Offer.create(db, donationswap.create_secret(), name, '%s@test.test' % name, country_id, 100, 50, charity_id, datetime.datetime(2200, 12, 31))
+		return offer.confirm(db)
+
+	def setUp(self):
+		super().setUp()
+		with self.ds._database.connect() as db:
+			db.write('''
+				INSERT INTO charities_in_countries (charity_id, country_id, instructions)
+				VALUES
+				(2, 1, 'instructions'),
+				(1, 2, 'instructions');
+				''')
+			entities.CharityInCountry.load(db)
+			self.offer_a = self._create_offer(db, 'a', 1, 1)
+			self.offer_b = self._create_offer(db, 'b', 2, 2)
+			self.offer_c = self._create_offer(db, 'c', 2, 1)
+
+	def test_get_match_scores(self):
+		scores = self.ds.get_match_scores(None, self.offer_a.id)
+		self.assertEqual(scores[self.offer_a.id], (0, 'same offer'))
+		self.assertEqual(scores[self.offer_b.id], (1, 'both benefit'))
+		self.assertEqual(scores[self.offer_c.id], (0, 'same charity'))
+
+	def test_declined_pair(self):
+		self.ds.create_match(None, self.offer_a.id, self.offer_b.id)
+		match = entities.Match.get_all()[0]
+		self.ds.decline_match(self.offer_a.secret + match.secret, 'feedback')
+		self.assertTrue(entities.DeclinedMatch.is_declined(self.offer_b.id, self.offer_a.id))
+		scores = self.ds.get_match_scores(None, self.offer_a.id)
+		self.assertEqual(scores[self.offer_b.id], (0, 'match declined'))
+
+	def test_matrix_is_symmetric(self):
+		result = self.ds.get_match_score_matrix(None)
+		scores = result['scores']
+		for i in range(len(scores)):
+			for j in range(len(scores)):
+				self.assertEqual(scores[i][j], scores[j][i])
+
+	def test_top_candidates(self):
+		result = self.ds.get_match_score_matrix(None, top_k=1)['top_candidates']
+		self.assertEqual(result[self.offer_a.id], [{'offer_id': self.offer_b.id, 'score': 1, 'reason': 'both benefit'}])
+		self.assertEqual(result[self.offer_c.id], [])
+
+	def test_top_candidates_follow_changes(self):
+		self.assertEqual(self.ds.get_top_candidates(None, self.offer_a.id), [{'offer_id': self.offer_b.id, 'score': 1, 'reason': 'both benefit'}])
+		self.ds.delete_offer(self.offer_b.secret)
+		self.assertEqual(self.ds.get_top_candidates(None, self.offer_a.id), [])
+		with self.ds._database.connect() as db:
+			offer_d = self._create_offer(db, 'd', 2, 2)
+		self.assertEqual(self.ds.get_top_candidates(None, self.offer_a.id), [{'offer_id': offer_d.id, 'score': 1, 'reason': 'both benefit'}])
+		with self.assertRaises(ValueError):
+			self.ds.get_top_candidates(None, self.offer_b.id)
+
+	def test_graph_follows_own_writes(self):
+		self.ds.get_top_candidates(None, self.offer_a.id) # builds the graph
+		self.ds.create_match(None, self.offer_a.id, self.offer_b.id)
+		# without another admin read in between
+		self.assertNotIn(self.offer_a.id, self.ds._candidates)
+		self.assertNotIn(self.offer_b.id, self.ds._candidates)
+		self.assertIn(self.offer_c.id, self.ds._candidates)
+
+	def test_unmatched_offers_written_elsewhere(self):
+		self.assertEqual(len(self.ds._get_unmatched_offers()), 3)
+		with self.ds._database.connect() as db:
+			# behind the cache's back, like console.py would
+			db.write('UPDATE offers SET confirmed = false WHERE id = %(id)s;', id=self.offer_c.id)
+		self.assertEqual(
+			[i.id for i in self.ds._get_unmatched_offers()],
+			[self.offer_a.id, self.offer_b.id])
+
+	def test_get_proposed_matches(self):
+		result = self.ds.get_proposed_matches(None)
+		self.assertEqual(len(result['matches']), 1)
+		match = result['matches'][0]
+		self.assertEqual({match['offer_a_id'], match['offer_b_id']}, {self.offer_a.id, self.offer_b.id})
+		self.assertEqual(result['stats']['total'], 1)
+
+	def test_create_matches(self):
+		match_ids = self.ds.create_matches(None, [[self.offer_a.id, self.offer_b.id]])
+		self.assertEqual(len(match_ids), 1)
+		self.assertEqual(len(self.mail.calls['send']), 2)
+		self.assertEqual(self.ds.get_proposed_matches(None)['matches'], [])
+
+	def test_create_matches_rejects_offer_used_twice(self):
+		with self.assertRaises(ValueError):
+			self.ds.create_matches(None, [[self.offer_a.id, self.offer_b.id], [self.offer_b.id, self.offer_c.id]])
+		with self.ds._database.connect() as db:
+			self.assertEqual(db.read_one('SELECT * FROM matches;'), None)
+
+def _fake_offer(offer_id, amount, min_amount):
+	country = types.SimpleNamespace(gift_aid_multiplier=1, currency=types.SimpleNamespace(iso='NZD'))
+	return types.SimpleNamespace(
+		id=offer_id,
+		charity_id=offer_id,
+		country_id=offer_id,
+		country=country,
+		email='%s@test.test' % offer_id,
+		amount=amount,
+		min_amount=min_amount)
+
+class amount_candidates(unittest.TestCase):
+
+	def setUp(self):
+		rng = random.Random(1)
+		self.offers = []
+		for i in range(300):
+			amount = rng.choice([rng.randint(1, 100), rng.randint(1, 10000)])
+			self.offers.append(_fake_offer(i, amount, rng.randint(0, amount)))
+		self.currency = MockCurrency()
+		self.currency.to_factor = 1
+
+	def _expected(self, offer):
+		return sorted(
+			other.id
+			for other in self.offers
+			if other is not offer and other.amount >= offer.min_amount and other.min_amount <= offer.amount
+		)
+
+	def test_offer_book(self):
+		book = matchscore.OfferBook(self.offers, self.currency)
+		for i, offer in enumerate(self.offers):
+			self.assertEqual(sorted(book.ids[j] for j in book.amount_candidates(i)), self._expected(offer))
+
+	def test_candidate_graph(self):
+		graph = matchscore.CandidateGraph()
+		graph.rebuild(self.offers, self.currency, 1)
+		for feature in matchscore._get_features(self.offers, self.currency):
+			graph.remove(feature.id)
+			self.assertEqual(sorted(graph._amount_candidates(feature)), [i for i in self._expected(self.offers[feature.id]) if i in graph])
+
+class propose_matches(unittest.TestCase):
+
+	@staticmethod
+	def _best_total(weights, i=0, used=frozenset()):
+		'''The best total, by trying every matching.'''
+		while i in used:
+			i += 1
+		if i >= len(weights):
+			return 0
+		best = propose_matches._best_total(weights, i + 1, used | {i})
+		for j, weight in weights[i].items():
+			if j not in used:
+				best = max(best, weight + propose_matches._best_total(weights, i + 1, used | {i, j}))
+		return best
+
+	def test_optimal(self):
+		rng = random.Random(0)
+		for _ in range(1000):
+			n = rng.randint(0, 10)
+			density = rng.random()
+			weights = [{} for _ in range(n)]
+			for i in range(n):
+				for j in range(i + 1, n):
+					if rng.random() < density:
+						weights[i][j] = weights[j][i] = rng.choice([round(rng.uniform(0.0001, 1), 4), 0.5, 1])
+
+			pairs, stats = matchscore.propose_matches(weights)
+
+			matched = [i for pair in pairs for i in pair]
+			self.assertEqual(len(matched), len(set(matched)))
+			for i, j in pairs:
+				self.assertIn(j, weights[i])
+			self.assertAlmostEqual(stats['total'], self._best_total(weights))
+
+	def test_timed_out(self):
+		# greedy takes the 0.6 in the middle, the optimum the two 0.5s
+		weights = [{1: 0.5}, {0: 0.5, 2: 0.6}, {1: 0.6, 3: 0.5}, {2: 0.5}]
+		pairs, stats = matchscore.propose_matches(weights, time_budget=-1) # over budget before starting
+		self.assertTrue(stats['timed_out'])
+		self.assertEqual(pairs, [(1, 2)])
+		self.assertEqual(stats['total'], stats['greedy_total'])
+
+		pairs, stats = matchscore.propose_matches(weights)
+		self.assertFalse(stats['timed_out'])
+		self.assertEqual(pairs, [(0, 1), (2, 3)])
+		self.assertEqual(stats['total'], 1)
+
+	def test_odd_cycle(self):
+		# a triangle with a pendant edge on each corner needs a blossom
+		weights = [{} for _ in range(6)]
+		for i, j, weight in [(0, 1, 0.6), (1, 2, 0.6), (2, 0, 0.6), (0, 3, 0.5), (1, 4, 0.5), (2, 5, 0.5)]:
+			weights[i][j] = weights[j][i] = weight
+		pairs, stats = matchscore.propose_matches(weights)
+		self.assertEqual(sorted(pairs), [(0, 3), (1, 4), (2, 5)])
+		self.assertEqual(stats['total'], 1.5)
+
+class entity_snapshots(unittest.TestCase):
+	# pylint: disable=protected-access
+
+	def setUp(self):
+		self._by_id = entities.Currency._by_id
+		with entities._writing():
+			entities.Currency._stage('_by_id', {})
+
+	def tearDown(self):
+		entities.Currency._by_id = self._by_id
+
+	def test_writes_are_published_together(self):
+		version = entities.get_reference_version()
+		with entities._writing():
+			entities.Currency._load_entity({'id': 1, 'iso': 'EUR', 'name': 'Euro'})
+			entities.Currency._load_entity({'id': 2, 'iso': 'NZD', 'name': 'New Zealand Dollar'})
+			entities._reference_data_changed()
+			self.assertEqual(entities.Currency.get_all(), [])
+			self.assertEqual(entities.get_reference_version(), version)
+		self.assertEqual(sorted(i.iso for i in entities.Currency.get_all()), ['EUR', 'NZD'])
+		self.assertEqual(entities.get_reference_version(), version + 1)
+
+	def test_failed_writes_are_not_published(self):
+		with self.assertRaises(ValueError):
+			with entities._writing():
+				entities.Currency._load_entity({'id': 1, 'iso': 'EUR', 'name': 'Euro'})
+				raise ValueError()
+		self.assertEqual(entities.Currency.get_all(), [])
+
+	def test_updates_publish_a_copy(self):
+		euro = entities.Currency._load_entity({'id': 1, 'iso': 'EUR', 'name': 'Euro'})
+		with entities._writing():
+			renamed = euro._replace(name='Euros')
+			self.assertIs(entities.Currency.by_id(1), euro)
+		self.assertEqual(euro.name, 'Euro') # whoever still holds it
+		self.assertIs(entities.Currency.by_id(1), renamed)
+		self.assertEqual(renamed.name, 'Euros')
+
+	def test_iterating_while_writing(self):
+		entities.Currency._load_entity({'id': 1, 'iso': 'EUR', 'name': 'Euro'})
+		seen = []
+		def _callback(currency):
+			entities.Currency._load_entity({'id': 2, 'iso': 'NZD', 'name': 'New Zealand Dollar'})
+			seen.append(currency.iso)
+			return True
+		self.assertEqual(len(entities.Currency.get_all(_callback)), 1)
+		self.assertEqual(seen, ['EUR'])
+		self.assertEqual(len(entities.Currency.get_all()), 2)
+
+class entity_changes(unittest.TestCase):
+
+	def test_follow_changes(self):
+		serial, changes = entities.get_changes_since(None)
+		self.assertEqual(changes, None)
+		entities._record_changes([(entities.Offer, 1), (entities.Match, 2)])
+		serial, changes = entities.get_changes_since(serial)
+		self.assertEqual(changes, [(entities.Offer, 1), (entities.Match, 2)])
+		self.assertEqual(entities.get_changes_since(serial), (serial, []))
+
+	def test_load_and_falling_behind(self):
+		serial, _ = entities.get_changes_since(None)
+		entities._record_changes([], loaded=True)
+		self.assertEqual(entities.get_changes_since(serial)[1], None)
+
+		serial, _ = entities.get_changes_since(None)
+		entities._record_changes([(entities.Offer, i) for i in range(entities.MAX_CHANGES + 1)])
+		self.assertEqual(entities.get_changes_since(serial)[1], None)
+
+class ExpiringSet(unittest.TestCase):
+
+	def test_ttl(self):
+		items = util.ExpiringSet(ttl=0, max_size=10)
+		items.add('a')
+		self.assertFalse('a' in items)
+		self.assertEqual(len(items), 0)
+
+	def test_max_size(self):
+		items = util.ExpiringSet(ttl=60, max_size=2)
+		for i in 'abc':
+			items.add(i)
+		self.assertEqual([i in items for i in 'abc'], [False, True, True])
+
+class WorkerPool(unittest.TestCase):
+
+	def test_queue_limit(self):
+		pool = util.WorkerPool(max_workers=1, max_queue=1)
+		release = threading.Event()
+		started = threading.Event()
+		def _block():
+			started.set()
+			release.wait()
+		running = pool.submit(_block)
+		started.wait()
+		waiting = pool.submit(lambda: 42)
+		with self.assertRaises(util.QueueFull):
+			pool.submit(lambda: 43)
+		metrics = pool.get_metrics()
+		self.assertEqual((metrics['running'], metrics['queued'], metrics['rejected']), (1, 1, 1))
+		release.set()
+		running.result()
+		self.assertEqual(waiting.result(), 42)
+		pool.shutdown()
+		self.assertEqual(pool.get_metrics()['completed'], 2)
+
+class request_context(unittest.TestCase):
+
+	def test_threads_have_their_own_context(self):
+		seen = {}
+		barrier = threading.Barrier(2)
+		def _serve(ip_address):
+			with donationswap.request_context(ip_address=ip_address):
+				barrier.wait() # both contexts are set now
+				seen[ip_address] = donationswap.get_request().ip_address
+		threads = [threading.Thread(target=_serve, args=(i,)) for i in ('1.1.1.1', '2.2.2.2')]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEqual(seen, {'1.1.1.1': '1.1.1.1', '2.2.2.2': '2.2.2.2'})
+		self.assertEqual(donationswap.get_request().ip_address, None)
+
+class ResponseSizes(unittest.TestCase):
+
+	def test_counts(self):
+		sizes = util.ResponseSizes(max_endpoints=2)
+		sizes.add('ajax/get_info', 3000, 500)
+		sizes.add('ajax/get_info', 100, 100)
+		sizes.add('admin/read_all', 9000, 1000)
+		sizes.add('ajax/does_not_exist', 10, 10)
+		result = sizes.get()
+		self.assertEqual(result['ajax/get_info'], {'responses': 2, 'compressed': 1, 'raw_bytes': 3100, 'sent_bytes': 600, 'saved_bytes': 2500})
+		self.assertEqual(sorted(result), ['admin/read_all', 'ajax/get_info', 'other'])
+
+class FakeLiveCurrency(currency.Currency):
+
+	def __init__(self, cache_filename):
+		super().__init__(cache_filename, 'secret')
+		self.downloads = 0
+		self.fail = False
+		self.release = threading.Event()
+		self.release.set()
+
+	def _read_live(self):
+		self.downloads += 1
+		self.release.wait()
+		if self.fail:
+			raise ValueError('offline')
+		self._data = {'success': True, 'timestamp': time.time(), 'base': 'EUR', 'rates': {'EUR': 1, 'NZD': 2}}
+
+class currency_refresh(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.currency = FakeLiveCurrency(os.path.join(self.directory.name, 'currency.json'))
+
+	def tearDown(self):
+		self.currency.release.set()
+		self.directory.cleanup()
+
+	def _wait_for_refresh(self):
+		for _ in range(100):
+			if not self.currency.get_metrics()['refreshing']:
+				return
+			time.sleep(0.01)
+		self.fail('refresh did not finish')
+
+	def test_stale_rates_are_served_while_refreshing(self):
+		self.currency._data = {'success': True, 'timestamp': 0, 'base': 'EUR', 'rates': {'EUR': 1, 'NZD': 3}}
+		self.currency.release.clear()
+		self.assertEqual(self.currency.convert(10, 'EUR', 'NZD'), 30) # does not wait
+		self.assertEqual(self.currency.convert(10, 'EUR', 'NZD'), 30)
+		self.currency.release.set()
+		self._wait_for_refresh()
+		self.assertEqual(self.currency.downloads, 1) # single flight
+		self.assertEqual(self.currency.convert(10, 'EUR', 'NZD'), 20)
+
+	def test_convert_many(self):
+		self.currency._data = {'success': True, 'timestamp': time.time(), 'base': 'EUR', 'rates': {'EUR': 1, 'NZD': 2, 'USD': 4}}
+		self.assertEqual(self.currency.convert_many([10, 20], 'NZD', 'USD'), [20, 40])
+		self.assertEqual(self.currency.convert_many([10, 20, 30], ['EUR', 'NZD', 'XXX'], 'NZD'), [20, 20, 60])
+		self.assertEqual(self.currency.convert(10, 'USD', 'EUR'), 2)
+		self.assertTrue(self.currency.is_more_money(10, 'EUR', 10, 'NZD'))
+
+	def test_backoff_after_failure(self):
+		self.currency._data = {'success': True, 'timestamp': 0, 'base': 'EUR', 'rates': {'EUR': 1, 'NZD': 3}}
+		self.currency.fail = True
+		self.assertTrue(self.currency.refresh_in_background())
+		self._wait_for_refresh()
+		self.assertFalse(self.currency.refresh_in_background())
+		metrics = self.currency.get_metrics()
+		self.assertEqual(metrics['failures'], 1)
+		self.assertGreater(metrics['retry_in_seconds'], 0)
+		self.assertEqual(self.currency.convert(10, 'EUR', 'NZD'), 30)
+
+class FakeHistoricRates(currency.HistoricRates):
+
+	def __init__(self, filename):
+		super().__init__(filename, 'secret')
+		self.downloads = []
+
+	def _download(self, day):
+		self.downloads.append(day)
+		if day == '2019-01-03':
+			return None
+		return {'base': 'EUR', 'timestamp': 0, 'rates': {'EUR': 1, 'NZD': 2}}
+
+class SlowHistoricRates(FakeHistoricRates):
+
+	def __init__(self, filename):
+		super().__init__(filename)
+		self.release = threading.Event()
+		self.release.set()
+
+	def _download(self, day):
+		self.release.wait()
+		return super()._download(day)
+
+class historic_rates(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.filename = os.path.join(self.directory.name, 'currency-history.json')
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def test_each_day_is_downloaded_once(self):
+		rates = FakeHistoricRates(self.filename)
+		self.assertEqual(rates.get(datetime.date(2019, 1, 1)).convert(10, 'EUR', 'NZD'), 20)
+		self.assertEqual(rates.get(datetime.date(2019, 1, 1)).convert(10, 'EUR', 'NZD'), 20)
+		self.assertEqual(rates.downloads, ['2019-01-01'])
+
+		rates = FakeHistoricRates(self.filename) # e.g. after a restart
+		self.assertEqual(rates.get(datetime.date(2019, 1, 1)).convert(10, 'EUR', 'NZD'), 20)
+		self.assertEqual(rates.downloads, [])
+
+	def test_backfill(self):
+		rates = FakeHistoricRates(self.filename)
+		self.assertEqual(rates.backfill(datetime.date(2019, 1, 1), datetime.date(2019, 1, 4)), 3)
+		self.assertEqual(rates.backfill(datetime.date(2019, 1, 1), datetime.date(2019, 1, 4)), 0)
+		self.assertEqual(rates.downloads, ['2019-01-01', '2019-01-02', '2019-01-03', '2019-01-04', '2019-01-03'])
+		self.assertEqual(rates.get(datetime.date(2019, 1, 3)), None)
+
+	def test_known_days_do_not_wait_for_downloads(self):
+		rates = SlowHistoricRates(self.filename)
+		rates.get(datetime.date(2019, 1, 1))
+		rates.release.clear()
+		threads = [threading.Thread(target=rates.get, args=(datetime.date(2019, 1, 2),)) for _ in range(2)]
+		for thread in threads:
+			thread.start()
+		time.sleep(0.05) # let them start downloading
+		self.assertTrue(rates._lock.acquire(timeout=1)) # not held while downloading
+		rates._lock.release()
+		self.assertNotEqual(rates.get(datetime.date(2019, 1, 1)), None)
+		rates.release.set()
+		for thread in threads:
+			thread.join()
+		self.assertEqual(rates.downloads, ['2019-01-01', '2019-01-02']) # single flight
+
+	def test_processes_keep_each_others_days(self):
+		rates_a = FakeHistoricRates(self.filename)
+		rates_b = FakeHistoricRates(self.filename)
+		rates_a.get(datetime.date(2019, 1, 1))
+		rates_b.get(datetime.date(2019, 1, 2))
+		self.assertEqual(sorted(FakeHistoricRates(self.filename)._read_file()), ['2019-01-01', '2019-01-02'])
+		self.assertEqual(os.listdir(self.directory.name), ['currency-history.json'])
+
+class template_cache(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.cache = util._TemplateCache(self.directory.name) # pylint: disable=protected-access
+		self.cache.CHECK_INTERVAL = 0
+		self._write('page.html', '<p>{%FILE=snippet.html%} {%NAME%}</p>')
+		self._write('snippet.html', 'Hi')
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def _write(self, filename, content, mtime=None):
+		path = os.path.join(self.directory.name, filename)
+		with open(path, 'w') as f:
+			f.write(content)
+		if mtime is not None:
+			os.utime(path, (mtime, mtime))
+
+	def test_includes_and_render(self):
+		entry = self.cache.get('page.html')
+		self.assertEqual(entry.content, '<p>Hi {%NAME%}</p>')
+		self.assertEqual(entry.render({'{%NAME%}': 'Bob'}), '<p>Hi Bob</p>')
+		self.assertIs(self.cache.get('page.html'), entry)
+
+	def test_values_are_not_rendered(self):
+		tmp = util.Template('contact-email.txt')
+		tmp.replace({'{%NAME%}': '{%EMAIL%}', '{%EMAIL%}': 'bob@example.com'})
+		self.assertTrue('{%EMAIL%}' in tmp.content)
+
+	def test_check(self):
+		missing, unused = util.Template('contact-email.txt').check({'{%NAME%}': 'Bob', '{%SECRET%}': 'x'})
+		self.assertEqual(missing, ['{%COUNTRY%}', '{%EMAIL%}', '{%IP_ADDRESS%}', '{%MESSAGE%}'])
+		self.assertEqual(unused, ['{%SECRET%}'])
+
+	def test_missing_values_are_logged_once(self):
+		util._warned_missing.discard(('contact-email.txt', '{%COUNTRY%}')) # pylint: disable=protected-access
+		replacements = {'{%NAME%}': 'Bob', '{%EMAIL%}': 'bob@example.com', '{%IP_ADDRESS%}': '::1', '{%MESSAGE%}': 'Hi'}
+		with self.assertLogs(level='WARNING') as logs:
+			util.Template('contact-email.txt').replace(dict(replacements))
+			util.Template('contact-email.txt').replace(dict(replacements))
+			logging.warning('end') # assertLogs needs at least one
+		self.assertEqual(len(logs.records), 2)
+		self.assertIn('{%COUNTRY%}', logs.records[0].getMessage())
+
+	def test_other_keys(self):
+		tmp = util.Template('contact-email.txt')
+		tmp.replace({'{%NAME%}': 'Bob', 'Name': 'Nom'})
+		self.assertNotIn('Name:', tmp.content)
+
+	def test_changed_include(self):
+		entry = self.cache.get('page.html')
+		self._write('snippet.html', 'Hello', mtime=time.time() + 10)
+		self.assertIsNot(self.cache.get('page.html'), entry)
+		self.assertEqual(self.cache.get('page.html').content, '<p>Hello {%NAME%}</p>')
+
+	def test_reload(self):
+		entry = self.cache.get('page.html')
+		self.cache.reload()
+		self.assertIsNot(self.cache.get('page.html'), entry)
+
+class static_assets(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self._write('logo.png', b'png')
+		self._write('style.css', b"a { background: url('/static/logo.png?v=1'); }")
+		self.assets = assets.Assets(self.directory.name)
+		self.assets.CHECK_INTERVAL = 0
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def _write(self, filename, content, mtime=None):
+		path = os.path.join(self.directory.name, filename)
+		with open(path, 'wb') as f:
+			f.write(content)
+		if mtime is not None:
+			os.utime(path, (mtime, mtime))
+
+	def test_rewrite(self):
+		logo = self.assets.get('logo.png')
+		css = self.assets.get('style.css')
+		self.assertEqual(logo.content_type, 'image/png')
+		self.assertEqual(css.body, ("a { background: url('/static/logo.png?v=%s'); }" % logo.hash).encode('utf-8'))
+		html = self.assets.rewrite('<link href="/static/style.css"><img src="/static/missing.png">')
+		self.assertEqual(html, '<link href="/static/style.css?v=%s"><img src="/static/missing.png">' % css.hash)
+
+	def test_compressed_variants(self):
+		self._write('code.js', b'var x = 1;\n' * 100)
+		code = assets.Assets(self.directory.name).get('code.js')
+		encoding, body, etag = code.get_variant(util.get_accepted_encodings('deflate, gzip;q=0.8'))
+		self.assertEqual((encoding, gzip.decompress(body)), ('gzip', code.body))
+		self.assertNotEqual(etag, code.etag)
+		self.assertEqual(code.get_variant(util.get_accepted_encodings('gzip;q=0')), (None, code.body, code.etag))
+		self.assertEqual(self.assets.get('logo.png').encodings, {}) # too small to bother
+
+	def test_changed_file(self):
+		version = self.assets.get_version()
+		css_hash = self.assets.get('style.css').hash
+		self._write('logo.png', b'new png', mtime=time.time() + 10)
+		self.assertNotEqual(self.assets.get_version(), version) # without a get() first
+		self.assertEqual(self.assets.get('logo.png').body, b'new png')
+		self.assertNotEqual(self.assets.get('style.css').hash, css_hash)
+
+	def test_only_changed_files_are_read(self):
+		self._write('code.js', b'var x = 1;\n' * 100)
+		self.assets = assets.Assets(self.directory.name)
+		self.assets.CHECK_INTERVAL = 0
+		code = self.assets.get('code.js')
+		css = self.assets.get('style.css')
+		self._write('logo.png', b'new png', mtime=time.time() + 10)
+		self.assertIs(self.assets.get('code.js'), code)
+		self.assertIsNot(self.assets.get('style.css'), css) # refers to the logo
+		self._write('other.png', b'other png', mtime=time.time() + 10)
+		self.assertIs(self.assets.get('code.js'), code)
+		self.assertIsNot(self.assets.get('other.png'), None)
+
 class Templates(unittest.TestCase):
 	'''Make sure all templates exist and contain the expected placeholders.'''
 
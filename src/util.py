@@ -1,12 +1,17 @@
 #!/usr/bin/env python3
 
+import collections
+import concurrent.futures
 import grp
+import itertools
 import json
 import logging
 import logging.handlers
 import os
 import pwd
 import re
+import threading
+import time
 
 def setup_logging(path):
 	LOG_MAX_FILESIZE = 2**20 # 1 MB
@@ -91,58 +96,348 @@ def drop_privileges(user='nobody', group='nogroup'):
 	os.setgid(group.gr_gid)
 	os.setuid(user.pw_uid)
 
+class ExpiringSet:
+	'''A set that forgets its items `ttl` seconds after they were
+	added, and forgets the oldest items first once it holds `max_size`.
+	Adding and looking up are O(1).'''
+
+	def __init__(self, ttl, max_size):
+		self._ttl = ttl
+		self._max_size = max_size
+		self._expiries = collections.OrderedDict() # item -> expiry, oldest first
+		self._lock = threading.Lock()
+
+	def add(self, item):
+		with self._lock:
+			self._expiries.pop(item, None)
+			self._expiries[item] = time.monotonic() + self._ttl
+			while len(self._expiries) > self._max_size:
+				self._expiries.popitem(last=False)
+
+	def discard(self, item):
+		with self._lock:
+			self._expiries.pop(item, None)
+
+	def __contains__(self, item):
+		with self._lock:
+			expiry = self._expiries.get(item, None)
+			if expiry is None:
+				return False
+			if expiry > time.monotonic():
+				return True
+			del self._expiries[item]
+			return False
+
+	def __len__(self):
+		return len(self._expiries)
+
+class QueueFull(Exception):
+	pass
+
+class WorkerPool(concurrent.futures.ThreadPoolExecutor):
+	'''
+	A thread pool for work that would otherwise block the web server,
+	like database queries and calls to other websites.
+
+	At most `max_queue` jobs may wait for a thread; beyond that,
+	`submit` raises QueueFull, so that an overloaded server answers
+	quickly instead of piling up requests nobody waits for any more.
+	'''
+
+	def __init__(self, max_workers, max_queue):
+		super(WorkerPool, self).__init__(max_workers=max_workers, thread_name_prefix='worker')
+		self._max_workers_count = max_workers
+		self._max_queue = max_queue
+		self._queued = 0
+		self._running = 0
+		self._lock = threading.Lock()
+		self._metrics = {
+			'submitted': 0,
+			'completed': 0,
+			'rejected': 0,
+			'max_queued': 0,
+			'wait_seconds': 0.0,
+			'max_wait_seconds': 0.0,
+			'run_seconds': 0.0,
+			'max_run_seconds': 0.0,
+		}
+
+	def submit(self, fn, *args, **kwargs): # pylint: disable=arguments-differ
+		with self._lock:
+			if self._queued >= self._max_queue:
+				self._metrics['rejected'] += 1
+				raise QueueFull('%s jobs are already waiting for a worker thread.' % self._queued)
+			self._queued += 1
+			self._metrics['submitted'] += 1
+			self._metrics['max_queued'] = max(self._metrics['max_queued'], self._queued)
+		return super(WorkerPool, self).submit(self._run, time.time(), fn, args, kwargs)
+
+	def _run(self, submitted, fn, args, kwargs):
+		t1 = time.time()
+		with self._lock:
+			self._queued -= 1
+			self._running += 1
+			self._metrics['wait_seconds'] += t1 - submitted
+			self._metrics['max_wait_seconds'] = max(self._metrics['max_wait_seconds'], t1 - submitted)
+		try:
+			return fn(*args, **kwargs)
+		finally:
+			duration = time.time() - t1
+			with self._lock:
+				self._running -= 1
+				self._metrics['completed'] += 1
+				self._metrics['run_seconds'] += duration
+				self._metrics['max_run_seconds'] = max(self._metrics['max_run_seconds'], duration)
+
+	def get_metrics(self):
+		with self._lock:
+			result = dict(self._metrics)
+			result['queued'] = self._queued
+			result['running'] = self._running
+			result['max_workers'] = self._max_workers_count
+			result['max_queue'] = self._max_queue
+		return result
+
+class ResponseSizes:
+	'''Counts response bytes before and after compression, per endpoint.
+	Only the first `max_endpoints` endpoints are counted separately,
+	all others together as "other".'''
+
+	def __init__(self, max_endpoints=100):
+		self._max_endpoints = max_endpoints
+		self._counts = {} # endpoint -> [responses, compressed, raw bytes, sent bytes]
+		self._lock = threading.Lock()
+
+	def add(self, endpoint, raw_size, sent_size):
+		with self._lock:
+			counts = self._counts.get(endpoint, None)
+			if counts is None:
+				if len(self._counts) >= self._max_endpoints:
+					endpoint = 'other'
+				counts = self._counts.setdefault(endpoint, [0, 0, 0, 0])
+			counts[0] += 1
+			counts[1] += 1 if sent_size != raw_size else 0
+			counts[2] += raw_size
+			counts[3] += sent_size
+
+	def get(self):
+		with self._lock:
+			return {
+				endpoint: {
+					'responses': responses,
+					'compressed': compressed,
+					'raw_bytes': raw_bytes,
+					'sent_bytes': sent_bytes,
+					'saved_bytes': raw_bytes - sent_bytes,
+				}
+				for endpoint, (responses, compressed, raw_bytes, sent_bytes) in self._counts.items()
+			}
+
+def get_accepted_encodings(header):
+	'''Returns the set of content codings in an Accept-Encoding header,
+	without those the client refuses with "q=0".'''
+	result = set()
+	for item in header.split(','):
+		coding, _, params = item.partition(';')
+		coding = coding.strip().lower()
+		params = params.replace(' ', '')
+		if coding and params not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+			result.add(coding)
+	return result
+
 def html_escape(txt):
 	return txt.replace('<', '&lt;').replace('>', '&gt;')
 
+class _CompiledTemplate: # pylint: disable=too-few-public-methods
+	'''A template file with all `{%FILE=...%}` references resolved,
+	split into [literal, placeholder, literal, placeholder, ..., literal].
+
+	Rendering fills in all placeholders in one pass and joins the
+	segments, so the document is copied once, no matter how many
+	placeholders there are, and inserted values are never scanned
+	for placeholders themselves.'''
+
+	__slots__ = ['version', 'content', 'segments', 'slots', 'placeholders', 'mtimes', 'checked', 'json']
+
+	def __init__(self, content, mtimes):
+		self.version = next(_template_versions) # different for every compiled template
+		self.content = content
+		self.segments = _PLACEHOLDER_RE.split(content)
+		self.slots = [(i, self.segments[i]) for i in range(1, len(self.segments), 2)]
+		self.placeholders = frozenset(name for _, name in self.slots)
+		self.mtimes = mtimes # filename -> mtime of every file involved
+		self.checked = time.monotonic()
+		self.json = None
+
+	def render(self, replacements):
+		'''Placeholders without a replacement are left as they are.'''
+		segments = self.segments[:]
+		for i, name in self.slots:
+			value = replacements.get(name, _MISSING)
+			if value is not _MISSING:
+				segments[i] = str(value)
+		return ''.join(segments)
+
+_MISSING = object()
+_template_versions = itertools.count(1)
+_PLACEHOLDER_RE = re.compile(r'({%[A-Z0-9_]+%})')
+_FILE_REFERENCE_RE = re.compile(r'{%FILE=(?P<filename>.+?)%}')
+
+class _TemplateCache:
+	'''
+	All templates of this process, parsed once.
+
+	An entry is read from disk again when the modification time of
+	its file, or of any file it includes, has changed.
+	We look at the modification times at most every CHECK_INTERVAL
+	seconds, so rendering a template usually doesn't touch the disk.
+	'''
+
+	CHECK_INTERVAL = 2 # seconds
+
+	def __init__(self, directory):
+		self._directory = directory
+		self._entries = {} # filename -> _CompiledTemplate
+		self._lock = threading.Lock()
+
+	def _get_mtime(self, filename):
+		try:
+			return os.stat(os.path.join(self._directory, filename)).st_mtime
+		except OSError:
+			return None
+
+	def _read(self, filename, mtimes):
+		mtimes[filename] = self._get_mtime(filename)
+		path = os.path.join(self._directory, filename)
+		if os.path.isfile(path):
+			with open(path, encoding='utf-8', mode='r') as f:
+				return f.read()
+		return ''
+
+	def _compile(self, filename):
+		mtimes = {}
+		content = self._read(filename, mtimes)
+
+		def _replace(match):
+			return self._read(match.groupdict()['filename'], mtimes)
+
+		for _ in range(5): # doing only 5 rounds is easier than detecting nested recursion
+			changed_content = _FILE_REFERENCE_RE.sub(_replace, content)
+			if changed_content == content:
+				break
+			content = changed_content
+
+		return _CompiledTemplate(content, mtimes)
+
+	def _is_current(self, entry):
+		now = time.monotonic()
+		if now - entry.checked < self.CHECK_INTERVAL:
+			return True
+		for filename, mtime in entry.mtimes.items():
+			if self._get_mtime(filename) != mtime:
+				return False
+		entry.checked = now
+		return True
+
+	def get(self, filename):
+		entry = self._entries.get(filename, None)
+		if entry is not None and self._is_current(entry):
+			return entry
+		entry = self._compile(filename)
+		with self._lock:
+			self._entries[filename] = entry
+		return entry
+
+	def reload(self):
+		with self._lock:
+			self._entries = {}
+
+_templates = _TemplateCache('templates')
+
+def reload_templates():
+	'''Forgets all cached templates, e.g. after a deployment.'''
+	_templates.reload()
+
+_warned_missing = set() # (filename, placeholder)
+
+def _warn_missing(filename, missing):
+	'''Logs each placeholder that a template was rendered without
+	once, not on every request. `Template.check` lists them all.'''
+	new = {(filename, i) for i in missing}.difference(_warned_missing)
+	if new:
+		_warned_missing.update(new)
+		logging.warning('Template %s has no values for %s.', filename, ', '.join(sorted(i for _, i in new)))
+
 class Template:
 
 	def __init__(self, filename):
-		self.content = self._load_file(filename)
-		self._json = None
-		self.populate_file_references()
-
-	@staticmethod
-	def _load_file(filename):
-		filename = os.path.join('templates', filename)
+		self._filename = filename
+		self._compiled = _templates.get(filename)
+		self.content = self._compiled.content
+		self.version = self._compiled.version # changes when the file is re-read
 
-		if os.path.isfile(filename):
-			with open(filename, encoding='utf-8', mode='r') as f:
-				return f.read()
-		else:
-			return ''
+	def _is_pristine(self):
+		return self.content is self._compiled.content
 
 	def json(self, key=None):
-		if self._json is None:
-			self._json = json.loads(self.content)
-		if key is not None:
-			return self._json.get(key, key)
-		return self._json
+		if key is None: # callers may change the result, so it can't be the cached one
+			return json.loads(self.content)
+		if not self._is_pristine():
+			return json.loads(self.content).get(key, key)
+		if self._compiled.json is None:
+			self._compiled.json = json.loads(self.content)
+		return self._compiled.json.get(key, key)
 
 	def populate_file_references(self):
 		'''Replace all occurrences of `{%FILE=...%}` with the content of that file.
-		This gets called automatically from the constructor,
-		but for deep template structures you _might_ want to call it again.
-		(In that case, you should rethink your structure because it's too deep.)'''
+		Cached templates already have all references resolved,
+		so this only matters if `replace()` inserted new ones.'''
 
 		def _replace(match):
-			filename = match.groupdict()['filename']
-			return self._load_file(filename)
+			return Template(match.groupdict()['filename']).content
 
 		for _ in range(5): # doing only 5 rounds is easier than detecting nested recursion
-			changed_content = re.sub(r'{%FILE=(?P<filename>.+?)%}', _replace, self.content)
+			changed_content = _FILE_REFERENCE_RE.sub(_replace, self.content)
 			if changed_content == self.content:
 				break
 			self.content = changed_content
 
 		return self
 
+	def check(self, replacements):
+		'''Returns (missing, unused): the placeholders in this template
+		that `replacements` has no value for, and the keys of
+		`replacements` that don't occur in this template.'''
+		placeholders = self._get_compiled().placeholders
+		missing = sorted(placeholders.difference(replacements))
+		unused = sorted(set(replacements).difference(placeholders))
+		return missing, unused
+
+	def _get_compiled(self):
+		if self._is_pristine():
+			return self._compiled
+		# replace() has been called before, so the cached template is out of date
+		return _CompiledTemplate(self.content, {})
+
 	def replace(self, replacements=None, **kwargs):
 		if not isinstance(replacements, dict):
 			replacements = {}
 
-		replacements.update(kwargs)
-
-		for k, v in replacements.items():
-			self.content = self.content.replace(k, str(v))
+		if kwargs:
+			replacements.update(kwargs)
+
+		compiled = self._get_compiled()
+		placeholders = compiled.placeholders
+		missing = placeholders.difference(replacements)
+		if missing:
+			_warn_missing(self._filename, missing)
+		self.content = compiled.render(replacements)
+
+		# keys that don't look like {%PLACEHOLDERS%} are replaced the old way;
+		# usually all keys are placeholders of this template, and we are done
+		if len(replacements) > len(placeholders) - len(missing):
+			for k, v in replacements.items():
+				if k not in placeholders and not _PLACEHOLDER_RE.fullmatch(k):
+					self.content = self.content.replace(k, str(v))
 
 		return self
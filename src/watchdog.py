@@ -84,7 +84,7 @@ def check_entities():
 		print('Countries: %s' % len(entities.Country.get_all()))
 		print('Charities In Countries: %s' % len(entities.CharityInCountry.get_all()))
 		print('Offers: %s' % len(entities.Offer.get_all()))
-		print('Unmatched offers: %s' % len(entities.Offer.get_unmatched_offers(db)))
+		print('Unmatched offers: %s' % len(entities.Offer.get_unmatched_offers()))
 		print('Matches: %s' % len(entities.Match.get_all()))
 
 def check_exchange_rate():